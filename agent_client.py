@@ -0,0 +1,114 @@
+import threading
+import time
+from typing import Any, Dict, Iterator, NamedTuple, Optional
+
+# Client for the Azure AI Agent Service version of the movie chat (see agent-service.md), used by cli-agent.py.
+#   - one AIProjectClient per endpoint per process, sharing one DefaultAzureCredential, so the HTTP connection pool and
+#     the credential's access token are reused instead of being set up again for every question
+#   - one agent thread per conversation, reused across turns, so the agent sees the earlier turns
+#   - runs are streamed: answer tokens and tool calls are yielded as the events arrive, instead of blocking until the
+#     run has finished and then listing every message on the thread
+#   - the answer comes from the stream's completed message event. Only if the stream ended without one are the
+#     messages of that run listed, never the whole thread.
+# `project` can be anything with the same `agents` calls, such as FakeAgentProject (fakes.py) for offline benchmarks.
+# The Azure SDKs are imported when the first real client is created, so the fake works without them.
+
+# Run stream event types (values of azure.ai.agents.models.AgentStreamEvent)
+RUN_CREATED = "thread.run.created"
+RUN_FAILED = "thread.run.failed"
+RUN_STEP_EVENTS = ("thread.run.step.created", "thread.run.step.in_progress", "thread.run.step.completed",
+                   "thread.run.step.failed")
+MESSAGE_DELTA = "thread.message.delta"
+MESSAGE_COMPLETED = "thread.message.completed"
+ERROR = "error"
+
+_lock = threading.Lock()
+_credential = None
+_clients: Dict[str, Any] = {}
+
+def get_credential():
+    global _credential
+    with _lock:
+        if _credential is None:
+            from azure.identity import DefaultAzureCredential
+            _credential = DefaultAzureCredential()
+        return _credential
+
+def get_project_client(endpoint: str, credential: Optional[Any] = None):
+    with _lock:
+        client = _clients.get(endpoint)
+    if client is None:
+        from azure.ai.projects import AIProjectClient
+        client = AIProjectClient(credential=credential or get_credential(), endpoint=endpoint)
+        with _lock:
+            client = _clients.setdefault(endpoint, client)
+    return client
+
+class AgentEvent(NamedTuple):
+    # token (text delta), tool_call ({'id', 'name', 'status'}), message (the full answer) or error
+    type: str
+    data: Any
+
+def _value(value: Any) -> str:
+    # SDK enums (str subclasses) print as their class and member name
+    return str(getattr(value, 'value', value))
+
+def message_text(message) -> str:
+    return "\n".join(content.text.value for content in message.text_messages or [])
+
+def tool_call_name(call) -> str:
+    function = getattr(call, 'function', None)
+    return getattr(function, 'name', None) or _value(call.type)
+
+# One conversation with an agent. ask() creates the thread on the first turn and streams the answer of each turn.
+# `timings` has the time to the first answer token and the total time of the last turn, in seconds.
+class AgentChat:
+    def __init__(self, project, agent_id: str, thread_id: Optional[str] = None):
+        self.project = project
+        self.agent_id = agent_id
+        self.thread_id = thread_id
+        self.last_message_id: Optional[str] = None
+        self.timings: Dict[str, float] = {}
+
+    def reset(self):
+        # The next question starts a new thread
+        self.thread_id = None
+        self.last_message_id = None
+
+    def ask(self, question: str) -> Iterator[AgentEvent]:
+        start = time.perf_counter()
+        self.timings = {}
+        if self.thread_id is None:
+            self.thread_id = self.project.agents.threads.create().id
+        self.project.agents.messages.create(thread_id=self.thread_id, role="user", content=question)
+
+        run_id, answered, seen = None, False, set()
+        with self.project.agents.runs.stream(thread_id=self.thread_id, agent_id=self.agent_id) as stream:
+            for event_type, data, _ in stream:
+                if event_type == RUN_CREATED:
+                    run_id = data.id
+                elif event_type == MESSAGE_DELTA:
+                    self.timings.setdefault('time_to_first_token', time.perf_counter() - start)
+                    yield AgentEvent('token', data.text)
+                elif event_type in RUN_STEP_EVENTS and getattr(data.step_details, 'type', None) == "tool_calls":
+                    for call in data.step_details.tool_calls or []:
+                        # Each tool call is reported when it starts and when it finishes
+                        status = _value(data.status)
+                        if (call.id, status) not in seen:
+                            seen.add((call.id, status))
+                            yield AgentEvent('tool_call', {'id': call.id, 'name': tool_call_name(call), 'status': status})
+                elif event_type == MESSAGE_COMPLETED and data.role == "assistant":
+                    answered = True
+                    self.last_message_id = data.id
+                    yield AgentEvent('message', message_text(data))
+                elif event_type == RUN_FAILED:
+                    yield AgentEvent('error', str(data.last_error))
+                elif event_type == ERROR:
+                    yield AgentEvent('error', str(data))
+
+        if not answered and run_id is not None:
+            for message in self.project.agents.messages.list(thread_id=self.thread_id, run_id=run_id, order="asc"):
+                if message.role == "assistant" and message.id != self.last_message_id:
+                    self.last_message_id = message.id
+                    yield AgentEvent('message', message_text(message))
+        self.timings['total'] = time.perf_counter() - start
@@ -0,0 +1,176 @@
+import asyncio
+import hashlib
+import threading
+import time
+import uuid
+from array import array
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+import redis
+from redis.commands.search.field import NumericField, TagField, TextField, VectorField
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+from redis.commands.search.query import Query
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables import Runnable, RunnableGenerator, RunnableLambda
+
+from instrumentation import span
+
+def context_hash(movie_ids: List[str]) -> str:
+    return hashlib.sha256(','.join(sorted(movie_ids)).encode('utf-8')).hexdigest()
+
+# Semantic answer cache that sits between the question rewrite and the answer chain.
+# Rewritten (standalone) questions are stored with their embedding and final answer in a separate Redis vector index.
+# A cached answer is only returned when a new standalone question is within `threshold` cosine similarity of a cached
+# one AND the retriever returned exactly the same movies, so answers never outlive the context they were built from.
+# Entries expire after `ttl` seconds and the oldest are evicted beyond `max_entries`. Call invalidate() whenever
+# the movie index is rebuilt or synced.
+class SemanticAnswerCache:
+    def __init__(self, client: redis.Redis, embedding: Optional[Embeddings] = None, index_name: str = "answercache",
+                 threshold: float = 0.95, ttl: int = 3600, max_entries: int = 10000):
+        self.client = client
+        self.embedding = embedding
+        self.index_name = index_name
+        self.prefix = f"{index_name}:entry:"
+        self.entries_key = f"{index_name}:entries"
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._index_ready = False
+        self._lock = threading.Lock()
+
+    def _ensure_index(self, dim: int):
+        if self._index_ready:
+            return
+        try:
+            self.client.ft(self.index_name).info()
+        except redis.ResponseError:
+            schema = (
+                TextField("question"),
+                TagField("context_hash"),
+                NumericField("created"),
+                VectorField("embedding", "HNSW", {"TYPE": "FLOAT32", "DIM": dim, "DISTANCE_METRIC": "COSINE"}),
+            )
+            try:
+                self.client.ft(self.index_name).create_index(
+                    schema, definition=IndexDefinition(prefix=[self.prefix], index_type=IndexType.HASH))
+            except redis.ResponseError as e:
+                # Another process created it in the meantime
+                if 'already exists' not in str(e).lower():
+                    raise
+        self._index_ready = True
+
+    def _with_index(self, dim: int, command: Callable[[], Any]) -> Any:
+        # The index is dropped by other processes (invalidate() after every index rebuild or sync), which the
+        # _index_ready flag of this one doesn't see. A command failing on it recreates the index and runs once more.
+        self._ensure_index(dim)
+        try:
+            return command()
+        except redis.ResponseError:
+            self._index_ready = False
+            self._ensure_index(dim)
+            return command()
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def lookup(self, question: str, movie_ids: List[str]) -> Optional[str]:
+        with span('answer_cache') as fields:
+            answer = self._lookup(question, movie_ids)
+            fields['cache_hit'] = answer is not None
+        return answer
+
+    def _lookup(self, question: str, movie_ids: List[str]) -> Optional[str]:
+        vector = self.embedding.embed_query(question)
+        query = (
+            Query(f"(@context_hash:{{{context_hash(movie_ids)}}})=>[KNN 1 @embedding $vector AS distance]")
+            .sort_by("distance")
+            .return_fields("answer", "distance")
+            .dialect(2)
+        )
+        try:
+            results = self._with_index(len(vector), lambda: self.client.ft(self.index_name).search(
+                query, query_params={"vector": array('f', vector).tobytes()}))
+        except redis.RedisError:
+            self._count(False)
+            return None
+        for doc in results.docs:
+            # COSINE distance is 1 - cosine similarity
+            if 1 - float(doc.distance) >= self.threshold:
+                self._count(True)
+                return doc.answer
+        self._count(False)
+        return None
+
+    def store(self, question: str, movie_ids: List[str], answer: str):
+        vector = self.embedding.embed_query(question)
+        key = f"{self.prefix}{uuid.uuid4().hex}"
+        now = time.time()
+        def write() -> int:
+            pipeline = self.client.pipeline(transaction=False)
+            pipeline.hset(key, mapping={
+                "question": question,
+                "answer": answer,
+                "context_hash": context_hash(movie_ids),
+                "created": now,
+                "embedding": array('f', vector).tobytes(),
+            })
+            pipeline.expire(key, self.ttl)
+            pipeline.zadd(self.entries_key, {key: now})
+            pipeline.zremrangebyscore(self.entries_key, 0, now - self.ttl)
+            pipeline.zcard(self.entries_key)
+            return pipeline.execute()[-1]
+
+        try:
+            overflow = self._with_index(len(vector), write) - self.max_entries
+            if overflow > 0:
+                evicted = [key for key, _ in self.client.zpopmin(self.entries_key, overflow)]
+                self.client.delete(*evicted)
+        except redis.RedisError:
+            pass
+
+    def invalidate(self):
+        try:
+            self.client.ft(self.index_name).dropindex(delete_documents=True)
+        except redis.ResponseError:
+            pass
+        self.client.delete(self.entries_key)
+        self._index_ready = False
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    # Wraps the answer chain: on a hit the cached answer is returned without calling the LLM, on a miss the
+    # answer chain runs (streaming is passed through) and its final answer is stored.
+    def wrap(self, answer_chain: Runnable) -> Runnable:
+        def answer(x):
+            question = x["standalone_question"]
+            movie_ids = [str(doc.metadata.get('id')) for doc in x["context"]]
+            cached = self.lookup(question, movie_ids)
+            if cached is not None:
+                return cached
+
+            def store(chunks: Iterator[str]) -> Iterator[str]:
+                parts = []
+                for chunk in chunks:
+                    parts.append(chunk)
+                    yield chunk
+                self.store(question, movie_ids, ''.join(parts))
+
+            async def astore(chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+                parts = []
+                async for chunk in chunks:
+                    parts.append(chunk)
+                    yield chunk
+                # embeds the question and writes to Redis, so it runs off the event loop
+                await asyncio.get_running_loop().run_in_executor(None, self.store, question, movie_ids, ''.join(parts))
+
+            return answer_chain | RunnableGenerator(store, astore)
+
+        return RunnableLambda(answer).with_config(run_name="semantic_answer_cache")
@@ -0,0 +1,430 @@
+import json
+import os
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+import numpy as np
+from dotenv import load_dotenv
+
+from langchain_openai import AzureOpenAIEmbeddings
+from langchain_community.vectorstores import Redis as RedisVectorStore
+from langchain_openai import AzureChatOpenAI
+from langchain_core.messages import BaseMessage
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.prompts import MessagesPlaceholder
+
+from answer_cache import SemanticAnswerCache
+from chains import build_rag_chain, build_rewrite_chain
+from chat_history import ChatHistoryManager
+from chunking import load_chunk_index
+from compression import TruncatedEmbeddings
+from context_packing import ContextPacker
+from instrumentation import Trace, TraceWriter, metrics
+from llm_governor import LLMGovernor
+from local_vectorstore import LocalVectorStore
+from question_rewrite import wants_rewrite
+from retrievers import create_retriever
+from query_embedding_cache import QueryEmbeddingCache, normalize_query
+from rate_limit import BATCH
+
+# Answers conversations from a JSONL file without the interactive prompt, for nightly jobs and evaluation runs:
+#   python batch-chat.py [input.jsonl] [output.jsonl]
+# Each input line is one conversation, {"id": ..., "questions": ["...", "..."]} (or a single "question"). Lines
+# without an id are numbered from 1. Answers are appended to the output file as they complete, one line per turn:
+#   {"id", "turn", "question", "standalone_question", "answer", "movies", "latency_ms", "duplicate_of", "error"}
+# Re-running with the same output file resumes: turns that were answered already are skipped and their answers
+# become the chat history of the turns that follow. Failed turns are retried.
+#
+# Conversations are answered in waves of one turn each. Per wave:
+#   1. follow up questions are rewritten into standalone questions, as the chain would
+#   2. identical standalone questions with the same chat history are answered once
+#   3. the query embeddings of all the distinct questions are fetched together (one request per
+#      BATCH_EMBEDDING_CHUNK_SIZE questions) and cached, so retrieval doesn't embed them one at a time
+#   4. the questions go through rag_chain.batch_as_completed, at most BATCH_CONCURRENCY at a time
+
+load_dotenv()
+
+API_KEY = os.getenv('API_KEY')
+RESOURCE_ENDPOINT = os.getenv('RESOURCE_ENDPOINT')
+DEPLOYMENT_NAME = os.getenv('DEPLOYMENT_NAME')
+REDIS_ENDPOINT = os.getenv('REDIS_ENDPOINT')
+REDIS_PASSWORD = os.getenv('REDIS_PASSWORD')
+BATCH_INPUT = sys.argv[1] if len(sys.argv) > 1 else os.getenv('BATCH_INPUT', 'batch_questions.jsonl')
+BATCH_OUTPUT = sys.argv[2] if len(sys.argv) > 2 else os.getenv('BATCH_OUTPUT', 'batch_answers.jsonl')
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '8'))
+BATCH_EMBEDDING_CHUNK_SIZE = int(os.getenv('BATCH_EMBEDDING_CHUNK_SIZE', '256'))
+QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', '1024'))
+QUERY_CACHE_TTL = int(os.getenv('QUERY_CACHE_TTL', '86400'))
+ANSWER_CACHE = os.getenv('ANSWER_CACHE', '1') == '1'
+ANSWER_CACHE_THRESHOLD = float(os.getenv('ANSWER_CACHE_THRESHOLD', '0.95'))
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', '3600'))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', '10000'))
+REWRITE_FAST_PATH = os.getenv('REWRITE_FAST_PATH', '1') == '1'
+REWRITE_HISTORY_TOKENS = int(os.getenv('REWRITE_HISTORY_TOKENS', '1000'))
+ANSWER_HISTORY_TOKENS = int(os.getenv('ANSWER_HISTORY_TOKENS', '3000'))
+HISTORY_SUMMARY = os.getenv('HISTORY_SUMMARY', '1') == '1'
+RETRIEVER_K = int(os.getenv('RETRIEVER_K', '6'))
+HYBRID_SEARCH = os.getenv('HYBRID_SEARCH', '1') == '1'
+HYBRID_CANDIDATES = int(os.getenv('HYBRID_CANDIDATES', '20'))
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '3000'))
+CONTEXT_MAX_PLOT_TOKENS = int(os.getenv('CONTEXT_MAX_PLOT_TOKENS', '400'))
+CONTEXT_MIN_SCORE = float(os.getenv('CONTEXT_MIN_SCORE', '0.25'))
+CONTEXT_MAX_SCORE_GAP = float(os.getenv('CONTEXT_MAX_SCORE_GAP', '0.2'))
+METADATA_QUERY = os.getenv('METADATA_QUERY', 'redis')
+METADATA_MAX_RESULTS = int(os.getenv('METADATA_MAX_RESULTS', '50'))
+MOVIE_LIST = os.getenv('MOVIE_LIST', 'movie_list.csv')
+VECTOR_STORE = os.getenv('VECTOR_STORE', 'redis')
+LOCAL_INDEX_PATH = os.getenv('LOCAL_INDEX_PATH', 'local_index')
+LOCAL_INDEX_PROBES = int(os.getenv('LOCAL_INDEX_PROBES', '8'))
+LOCAL_INDEX_RESCORE = int(os.getenv('LOCAL_INDEX_RESCORE', '0'))
+NEIGHBOURS_FILE = os.getenv('NEIGHBOURS_FILE', 'movie_neighbours.npz')
+# Search the plot chunk index built with PLOT_CHUNKS=1 instead of whole plots
+PLOT_CHUNKS = os.getenv('PLOT_CHUNKS', '0') == '1'
+PLOT_CHUNKS_PER_MOVIE = int(os.getenv('PLOT_CHUNKS_PER_MOVIE', '3'))
+LOCAL_CHUNK_INDEX_PATH = os.getenv('LOCAL_CHUNK_INDEX_PATH', 'local_chunk_index')
+TRACE_FILE = os.getenv('TRACE_FILE')
+# Must match the VECTOR_DIMS the Redis index was created with (0 for full width vectors)
+VECTOR_DIMS = int(os.getenv('VECTOR_DIMS', '0'))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '60'))
+# Quotas of the chat and embedding deployments (requests and tokens per minute). The batch runs at the lowest priority
+# and leaves RATE_LIMIT_RESERVE of what the rate limit headers say is left to the chat apps on the same deployments.
+LLM_RPM = int(os.getenv('LLM_RPM', '1500'))
+LLM_TPM = int(os.getenv('LLM_TPM', '250000'))
+EMBEDDING_RPM = int(os.getenv('EMBEDDING_RPM', '300'))
+EMBEDDING_TPM = int(os.getenv('EMBEDDING_TPM', '350000'))
+RATE_LIMIT_RESERVE = float(os.getenv('RATE_LIMIT_RESERVE', '0.2'))
+LLM_COALESCE = os.getenv('LLM_COALESCE', '1') == '1'
+
+def get_system_prompt():
+    return (
+        "You are a movie buff assistant who can answer questions about movies, make suggestions, summarise key facts, and provide other useful movie information."
+        "Use the following movie(s) context that and any previous chat history to answer the user's questions."
+        """If you are unsure, just say "I'm unsure". Only discuss movies from the context provided. Provide a succinct follow up prompt.  Don't discuss other topics not related to the movies."""
+        "\n\n"
+        "{context}"
+    )
+
+contextualize_q_system_prompt = (
+    "Given a chat history and the latest user question "
+    "which might reference context in the chat history, "
+    "formulate a standalone question which can be understood "
+    "without the chat history. Do NOT answer the question, "
+    "just reformulate it if needed and otherwise return it as is."
+)
+
+contextualize_q_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", contextualize_q_system_prompt),
+        MessagesPlaceholder("chat_history"),
+        ("human", "{input}"),
+    ]
+)
+
+qa_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", get_system_prompt()),
+        MessagesPlaceholder("chat_history"),
+        ("human", "{input}"),
+    ]
+)
+
+class Conversation:
+    def __init__(self, id: str, questions: List[str], history: ChatHistoryManager):
+        self.id = id
+        self.questions = questions
+        self.history = history
+        # index of the next turn to answer
+        self.turn = 0
+
+def read_conversations(path: str) -> List[Tuple[str, List[str]]]:
+    conversations, seen = [], set()
+    with open(path, encoding='utf-8') as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            id = str(record.get('id', record.get('request_id', n)))
+            questions = record.get('questions') or ([record['question']] if record.get('question') else [])
+            if id in seen:
+                print(f"Skipping line {n}: duplicate conversation id {id}")
+                continue
+            seen.add(id)
+            conversations.append((id, [str(question) for question in questions]))
+    return conversations
+
+# Answered turns of an earlier run, by (id, turn). Failed turns and a line cut short by a crash are left out.
+def read_results(path: str) -> Dict[Tuple[str, int], Dict]:
+    results = {}
+    if not os.path.exists(path):
+        return results
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get('error') is None:
+                results[(record['id'], record['turn'])] = record
+    return results
+
+def open_output(path: str):
+    # a run that was killed mid-write can leave a partial last line, start after it
+    needs_newline = False
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b'\n'
+    f = open(path, 'a', encoding='utf-8')
+    if needs_newline:
+        f.write('\n')
+    return f
+
+def history_key(messages: List[BaseMessage]) -> Tuple:
+    return tuple((message.type, str(message.content)) for message in messages)
+
+# one rate limit per deployment for every call of the batch, following the rate limit headers of the responses
+# (see llm_governor.py)
+governor = LLMGovernor(
+    {DEPLOYMENT_NAME: (EMBEDDING_RPM, EMBEDDING_TPM), 'gpt-4o-mini': (LLM_RPM, LLM_TPM)},
+    reserve=RATE_LIMIT_RESERVE,
+    coalesce=LLM_COALESCE)
+http_client = httpx.Client(timeout=HTTP_TIMEOUT, event_hooks=governor.event_hooks())
+
+# we will use Azure OpenAI as our embeddings provider
+# (large chunks, so the prefetched question embeddings go out in as few requests as possible)
+embedding = governor.embeddings(AzureOpenAIEmbeddings(
+    azure_endpoint=RESOURCE_ENDPOINT,
+    azure_deployment=DEPLOYMENT_NAME,
+    openai_api_key=API_KEY,
+    openai_api_version='2024-03-01-preview',
+    chunk_size=BATCH_EMBEDDING_CHUNK_SIZE,
+    http_client=http_client), DEPLOYMENT_NAME, priority=BATCH)
+
+# name of the Redis search index to create
+index_name = "movieindex"
+
+# create a connection string for the Redis Vector Store. Uses Redis-py format: https://redis-py.readthedocs.io/en/stable/connections.html#redis.Redis.from_url
+# This example assumes TLS is enabled. If not, use "redis://" instead of "rediss://
+# (not needed with the local vector store)
+redis_url = "rediss://:" + REDIS_PASSWORD + "@"+ REDIS_ENDPOINT if VECTOR_STORE == 'redis' else None
+
+# cache query embeddings in-process and in Redis, the batch prefetch fills this cache
+query_embedding = QueryEmbeddingCache(
+    embedding=embedding,
+    deployment=DEPLOYMENT_NAME,
+    redis_url=redis_url,
+    max_size=max(QUERY_CACHE_SIZE, BATCH_EMBEDDING_CHUNK_SIZE),
+    ttl=QUERY_CACHE_TTL)
+
+if VECTOR_STORE == 'redis':
+    vectorstore = RedisVectorStore.from_existing_index(
+        embedding=TruncatedEmbeddings(query_embedding, VECTOR_DIMS) if VECTOR_DIMS else query_embedding,
+        redis_url=redis_url,
+        index_name=index_name,
+        schema="redis_schema.yaml"
+    )
+else:
+    # in-process vector store created by create-local-index.py
+    vectorstore = LocalVectorStore.from_existing_index(
+        embedding=query_embedding,
+        path=LOCAL_INDEX_PATH,
+        n_probe=LOCAL_INDEX_PROBES,
+        rescore=LOCAL_INDEX_RESCORE)
+
+# Initialize the LLM
+llm = governor.chat_model(AzureChatOpenAI(
+    azure_endpoint=RESOURCE_ENDPOINT,
+    azure_deployment='gpt-4o-mini',
+    api_key=API_KEY,
+    openai_api_version="2024-09-01-preview",
+    http_client=http_client
+), 'gpt-4o-mini', priority=BATCH, stream_usage=True)
+
+# matching plot chunks instead of whole plots, collapsed to one document per movie (see chunking.py)
+chunk_vectorstore = load_chunk_index(
+    vectorstore,
+    redis_url=redis_url,
+    path=LOCAL_CHUNK_INDEX_PATH,
+    n_probe=LOCAL_INDEX_PROBES,
+    rescore=LOCAL_INDEX_RESCORE) if PLOT_CHUNKS else None
+
+retriever = create_retriever(
+    vectorstore,
+    k=RETRIEVER_K,
+    hybrid=HYBRID_SEARCH,
+    hybrid_candidates=HYBRID_CANDIDATES,
+    metadata_query=METADATA_QUERY,
+    movie_list=MOVIE_LIST,
+    max_results=METADATA_MAX_RESULTS,
+    neighbours_file=NEIGHBOURS_FILE,
+    chunk_vectorstore=chunk_vectorstore,
+    chunks_per_movie=PLOT_CHUNKS_PER_MOVIE)
+
+context_packer = ContextPacker(
+    token_budget=CONTEXT_TOKEN_BUDGET,
+    max_plot_tokens=CONTEXT_MAX_PLOT_TOKENS,
+    min_score=CONTEXT_MIN_SCORE,
+    max_score_gap=CONTEXT_MAX_SCORE_GAP)
+
+answer_cache = SemanticAnswerCache(
+    client=vectorstore.client,
+    embedding=query_embedding,
+    threshold=ANSWER_CACHE_THRESHOLD,
+    ttl=ANSWER_CACHE_TTL,
+    max_entries=ANSWER_CACHE_MAX_ENTRIES) if ANSWER_CACHE and VECTOR_STORE == 'redis' else None
+
+# the rewrite runs as its own step before the chain, which then takes the `standalone_question` as given
+rewrite_chain = build_rewrite_chain(llm, contextualize_q_prompt, rewrite_history_tokens=REWRITE_HISTORY_TOKENS)
+rag_chain = build_rag_chain(
+    llm, retriever, contextualize_q_prompt, qa_prompt,
+    answer_cache=answer_cache,
+    rewrite_fast_path=REWRITE_FAST_PATH,
+    rewrite_history_tokens=REWRITE_HISTORY_TOKENS,
+    answer_history_tokens=ANSWER_HISTORY_TOKENS,
+    context_packer=context_packer)
+
+trace_writer = TraceWriter(TRACE_FILE) if TRACE_FILE else None
+
+conversations = []
+done = read_results(BATCH_OUTPUT)
+for id, questions in read_conversations(BATCH_INPUT):
+    conversation = Conversation(id, questions, ChatHistoryManager(
+        max_tokens=ANSWER_HISTORY_TOKENS, llm=llm if HISTORY_SUMMARY else None, session_id=id))
+    # replay the answered turns of an earlier run into the chat history
+    while conversation.turn < len(questions) and (id, conversation.turn) in done:
+        conversation.history.add_turn(questions[conversation.turn], done[(id, conversation.turn)]['answer'])
+        conversation.turn += 1
+    conversations.append(conversation)
+
+total = sum(len(conversation.questions) for conversation in conversations)
+skipped = sum(conversation.turn for conversation in conversations)
+print(f"{len(conversations)} conversations, {total} questions from {BATCH_INPUT}")
+if skipped:
+    print(f"Resuming: {skipped} questions already answered in {BATCH_OUTPUT}")
+
+latencies = []
+answered = duplicates = failed = prefetched = 0
+# answers of this run by (standalone question, chat history), for duplicates in later waves
+answers: Dict[Tuple, Dict] = {}
+start = time.perf_counter()
+output = open_output(BATCH_OUTPUT)
+
+def write_result(conversation: Conversation, inputs: Dict, trace: Trace, result: Optional[Dict] = None,
+                 error: Optional[Exception] = None, duplicate_of: Optional[Dict] = None):
+    global answered, failed
+    trace.finish(error=repr(error) if error else None)
+    record = {
+        'id': conversation.id,
+        'turn': conversation.turn,
+        'question': inputs['input'],
+        'standalone_question': inputs.get('standalone_question'),
+        'answer': result['answer'] if result else None,
+        'movies': [str(document.metadata.get('id')) for document in result['context']] if result else [],
+        'latency_ms': round(trace.active * 1000, 1),
+        'duplicate_of': duplicate_of and {'id': duplicate_of['id'], 'turn': duplicate_of['turn']},
+        'error': repr(error) if error else None,
+    }
+    output.write(json.dumps(record) + '\n')
+    output.flush()
+    if error:
+        # the rest of this conversation waits for the next run
+        failed += 1
+    else:
+        answered += 1
+        conversation.history.add_turn(inputs['input'], record['answer'])
+        conversation.turn += 1
+    return record
+
+try:
+    for turn in range(max((len(conversation.questions) for conversation in conversations), default=0)):
+        wave = [c for c in conversations if c.turn == turn and turn < len(c.questions)]
+        if not wave:
+            continue
+        inputs = [{"input": c.questions[turn], "chat_history": c.history.messages()} for c in wave]
+        traces = [Trace(trace_writer, app='batch', conversation=c.id, turn=turn) for c in wave]
+        configs = [{'callbacks': trace.callbacks, 'max_concurrency': BATCH_CONCURRENCY} for trace in traces]
+
+        # 1. rewrite the follow up questions, once per distinct question and chat history
+        rewrites: Dict[Tuple, List[int]] = {}
+        for i, x in enumerate(inputs):
+            if wants_rewrite(x, REWRITE_FAST_PATH):
+                rewrites.setdefault((normalize_query(x["input"]), history_key(x["chat_history"])), []).append(i)
+        errors = {}
+        if rewrites:
+            rows = [rows[0] for rows in rewrites.values()]
+            rewritten = rewrite_chain.batch([inputs[i] for i in rows], config=[configs[i] for i in rows],
+                                            return_exceptions=True)
+            for same, standalone_question in zip(rewrites.values(), rewritten):
+                for i in same:
+                    if isinstance(standalone_question, Exception):
+                        errors[i] = standalone_question
+                    else:
+                        inputs[i]["standalone_question"] = standalone_question
+        for i, x in enumerate(inputs):
+            x.setdefault("standalone_question", x["input"])
+        for i, error in errors.items():
+            write_result(wave[i], inputs[i], traces[i], error=error)
+
+        # 2. answer each distinct question once
+        groups: Dict[Tuple, List[int]] = {}
+        for i, x in enumerate(inputs):
+            if i in errors:
+                continue
+            key = (normalize_query(x["standalone_question"]), history_key(x["chat_history"]))
+            if key in answers:
+                duplicates += 1
+                previous = answers[key]
+                write_result(wave[i], inputs[i], traces[i], duplicate_of=previous,
+                             result={'answer': previous['answer'], 'context': previous['context']})
+            else:
+                groups.setdefault(key, []).append(i)
+        keys = list(groups)
+        leaders = [groups[key][0] for key in keys]
+
+        # 3. embed the distinct questions together
+        try:
+            prefetched += query_embedding.prefetch([inputs[i]["standalone_question"] for i in leaders])
+        except Exception as e:
+            # retrieval embeds each question on its own instead
+            print(f"Query embedding prefetch failed: {e}")
+
+        # 4. run the chain, writing each answer (and its duplicates) as it completes
+        for n, result in rag_chain.batch_as_completed([inputs[i] for i in leaders],
+                                                      config=[configs[i] for i in leaders],
+                                                      return_exceptions=True):
+            rows = groups[keys[n]]
+            error = result if isinstance(result, Exception) else None
+            record = write_result(wave[rows[0]], inputs[rows[0]], traces[rows[0]],
+                                  result=None if error else result, error=error)
+            if error:
+                for i in rows[1:]:
+                    write_result(wave[i], inputs[i], traces[i], error=error)
+                continue
+            latencies.append(record['latency_ms'])
+            answers[keys[n]] = {'id': record['id'], 'turn': record['turn'], 'answer': result['answer'],
+                                'context': result['context']}
+            for i in rows[1:]:
+                duplicates += 1
+                write_result(wave[i], inputs[i], traces[i], result=result, duplicate_of=record)
+        print(f"Turn {turn + 1}: {len(wave)} questions, {len(leaders)} distinct, "
+              f"{answered} answered and {failed} failed so far")
+finally:
+    output.close()
+
+elapsed = time.perf_counter() - start
+print(f"\nAnswered {answered} questions in {elapsed:.1f}s ({answered / elapsed * 60 if elapsed else 0:.1f} questions/minute)")
+print(f"  {duplicates} answered from a duplicate question, {failed} failed, "
+      f"{prefetched} query embeddings fetched in batches")
+if latencies:
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print(f"  latency per question: p50 {p50:.0f}ms, p95 {p95:.0f}ms, p99 {p99:.0f}ms, max {max(latencies):.0f}ms")
+chat_stats = governor.stats()['chat']
+if chat_stats:
+    print(f"  {chat_stats['calls']} chat model calls, {chat_stats['coalesced']} shared with an identical request in flight")
+for stage, stats in metrics.snapshot().items():
+    if stage != 'turn' and 'count' in stats:
+        print(f"  {stage}: {stats['count']} calls, p50 {stats['p50_ms']:.0f}ms, p95 {stats['p95_ms']:.0f}ms")
+print(f"Results written to {BATCH_OUTPUT}")
+sys.exit(1 if failed else 0)
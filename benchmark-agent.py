@@ -0,0 +1,94 @@
+# Offline benchmark of the agent service client (agent_client.py) against the original blocking flow of cli-agent.py.
+#   - blocking: every question builds a new AIProjectClient and a new thread, then blocks in runs.create_and_process
+#     and lists every message of the thread. The answer is only seen when the run has finished.
+#   - streaming: one client per process and one thread per conversation, the run's events are streamed and the answer
+#     comes from the completed message event.
+# By default both talk to FakeAgentProject (fakes.py), a local stand-in of the agent service with FAKE_AGENT_*
+# latencies, so no Azure resources are needed. AGENT_MOCK=0 runs the same dialogues against AGENT_ENDPOINT/AGENT_ID.
+# Reports the time to first token (when the answer starts to show) and the total time of each turn.
+#
+#   python benchmark-agent.py
+
+import os
+import time
+from typing import Dict, List
+
+import numpy as np
+from dotenv import load_dotenv
+
+from agent_client import AgentChat, get_project_client
+from fakes import FakeAgentProject
+
+load_dotenv()
+
+AGENT_ENDPOINT = os.getenv('AGENT_ENDPOINT', "https://<your-aifoundry-resource>.services.ai.azure.com/api/projects/movie-chat-agent")
+AGENT_ID = os.getenv('AGENT_ID', "asst_xxxxxxxxxxxxxxxxxxxxxx")
+AGENT_MOCK = os.getenv('AGENT_MOCK', '1') == '1'
+BENCHMARK_REPEAT = int(os.getenv('BENCHMARK_REPEAT', '3'))
+FAKE_AGENT_CONNECT_LATENCY = float(os.getenv('FAKE_AGENT_CONNECT_LATENCY', '0.3'))
+FAKE_AGENT_REQUEST_LATENCY = float(os.getenv('FAKE_AGENT_REQUEST_LATENCY', '0.05'))
+FAKE_AGENT_QUEUE_LATENCY = float(os.getenv('FAKE_AGENT_QUEUE_LATENCY', '0.2'))
+FAKE_AGENT_TOOL_LATENCY = float(os.getenv('FAKE_AGENT_TOOL_LATENCY', '0.3'))
+FAKE_LLM_LATENCY = float(os.getenv('FAKE_LLM_LATENCY', '0.3'))
+FAKE_LLM_TOKEN_LATENCY = float(os.getenv('FAKE_LLM_TOKEN_LATENCY', '0.01'))
+FAKE_ANSWER_TOKENS = int(os.getenv('FAKE_ANSWER_TOKENS', '60'))
+
+DIALOGUES = [
+    ["Find 3 movies about aliens that are also a comedy", "Which of those is the oldest?", "Who directed it?"],
+    ["What movies has Tom Cruise been in?", "Show those with Jamie Foxx", "Tell me about Collateral"],
+]
+
+def new_project():
+    if not AGENT_MOCK:
+        # What the blocking flow did, a new client (and credential) per question
+        from azure.ai.projects import AIProjectClient
+        from azure.identity import DefaultAzureCredential
+        return AIProjectClient(credential=DefaultAzureCredential(), endpoint=AGENT_ENDPOINT)
+    return FakeAgentProject(
+        connect_latency=FAKE_AGENT_CONNECT_LATENCY,
+        request_latency=FAKE_AGENT_REQUEST_LATENCY,
+        queue_latency=FAKE_AGENT_QUEUE_LATENCY,
+        tool_latency=FAKE_AGENT_TOOL_LATENCY,
+        latency=FAKE_LLM_LATENCY,
+        token_latency=FAKE_LLM_TOKEN_LATENCY,
+        answer_tokens=FAKE_ANSWER_TOKENS)
+
+def blocking_turn(question: str) -> Dict[str, float]:
+    start = time.perf_counter()
+    project = new_project()
+    agent = project.agents.get_agent(AGENT_ID)
+    thread = project.agents.threads.create()
+    project.agents.messages.create(thread_id=thread.id, role="user", content=question)
+    run = project.agents.runs.create_and_process(thread_id=thread.id, agent_id=agent.id)
+    if run.status == "failed":
+        raise RuntimeError(f"Run failed: {run.last_error}")
+    list(project.agents.messages.list(thread_id=thread.id, order="asc"))
+    total = time.perf_counter() - start
+    return {'time_to_first_token': total, 'total': total}
+
+def run_blocking() -> List[Dict[str, float]]:
+    return [blocking_turn(question) for questions in DIALOGUES * BENCHMARK_REPEAT for question in questions]
+
+def run_streaming() -> List[Dict[str, float]]:
+    project = new_project() if AGENT_MOCK else get_project_client(AGENT_ENDPOINT)
+    turns = []
+    for questions in DIALOGUES * BENCHMARK_REPEAT:
+        chat = AgentChat(project, AGENT_ID)
+        for question in questions:
+            for event in chat.ask(question):
+                if event.type == 'error':
+                    raise RuntimeError(f"Run failed: {event.data}")
+            turns.append(chat.timings)
+    return turns
+
+def percentiles(values: List[float]) -> str:
+    p50, p95 = np.percentile(np.asarray(values) * 1000, [50, 95])
+    return f"{p50:>8.0f} {p95:>8.0f}"
+
+print(f"{'agent service' if not AGENT_MOCK else 'local agent stand-in'}: {len(DIALOGUES) * BENCHMARK_REPEAT} dialogues, "
+      f"{sum(len(questions) for questions in DIALOGUES) * BENCHMARK_REPEAT} turns per mode\n")
+print(f"{'mode':<10} {'first token p50/p95 (ms)':>26} {'turn p50/p95 (ms)':>20}")
+for mode, run in (('blocking', run_blocking), ('streaming', run_streaming)):
+    turns = run()
+    print(f"{mode:<10} {percentiles([t.get('time_to_first_token', t['total']) for t in turns]):>26} "
+          f"{percentiles([t['total'] for t in turns]):>20}")
@@ -0,0 +1,369 @@
+# Offline end-to-end benchmark and load test of the movie chat.
+# Runs the same RAG chain as movie-chat.py (question rewrite, retrieval, context packing, streamed answer, chat
+# history) through scripted multi-turn dialogues, with deterministic local stand-ins for Azure OpenAI (see fakes.py)
+# and the local vector store instead of Redis, so no network or credentials are needed. The stand-ins inject
+# FAKE_* latencies in place of the real API round trips.
+#
+# Every BENCHMARK_CONCURRENCY level runs the same work, the dialogue set repeated BENCHMARK_REPEAT times (one
+# conversation each), after one unmeasured warm-up pass. The query embedding cache is emptied before each level, so
+# every level starts cold and repeats within a level are what hits the cache. Per-stage and end-to-end latency
+# percentiles come from the instrumentation of each turn (see instrumentation.py). Results are compared with the
+# baseline in BENCHMARK_BASELINE: a drop in turns/sec or a rise in a stage's p95 beyond BENCHMARK_TOLERANCE is a
+# regression, and the script exits with status 1.
+#
+#   python benchmark-chat.py
+#   BENCHMARK_SAVE_BASELINE=1 python benchmark-chat.py     # store the results as the new baseline
+#
+# The catalogue is a synthetic one of BENCHMARK_MOVIES movies, or the movies in BENCHMARK_MOVIE_LIST (e.g.
+# movie_list.csv). The dialogues are the README sample dialogue and a few more, or the JSON list of question lists in
+# BENCHMARK_DIALOGUES. The app settings (RETRIEVER_K, REWRITE_FAST_PATH, CONTEXT_TOKEN_BUDGET, ...) apply as in the
+# apps. QUERY_CACHE_SIZE=0 disables the query embedding cache, so every turn pays the embedding latency. The fakes are
+# called through the apps' rate limits and request coalescing (see llm_governor.py), with the same settings.
+
+import asyncio
+import csv
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import pandas as pd
+from dotenv import load_dotenv
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+from chains import astream_answer, build_rag_chain, stream_answer
+from chat_history import ChatHistoryManager
+from context_packing import ContextPacker
+from fakes import FakeChatModel, FakeEmbeddings, synthetic_movies
+from llm_governor import LLMGovernor
+from instrumentation import Trace, metrics
+from local_vectorstore import LocalVectorStore
+from movie_neighbours import build_neighbour_file
+from preprocessing import load_movie_list
+from query_embedding_cache import QueryEmbeddingCache
+from rate_limit import BACKGROUND
+from retrievers import create_retriever
+
+load_dotenv()
+
+BENCHMARK_MOVIE_LIST = os.getenv('BENCHMARK_MOVIE_LIST')
+BENCHMARK_MOVIES = int(os.getenv('BENCHMARK_MOVIES', '2000'))
+BENCHMARK_DIALOGUES = os.getenv('BENCHMARK_DIALOGUES')
+BENCHMARK_CONCURRENCY = [int(level) for level in os.getenv('BENCHMARK_CONCURRENCY', '1,4,16').split(',')]
+BENCHMARK_REPEAT = int(os.getenv('BENCHMARK_REPEAT', '6'))
+# sync: threads running chain.stream, as the console and Streamlit apps do; async: chain.astream, as chat-server.py does
+BENCHMARK_MODE = os.getenv('BENCHMARK_MODE', 'sync')
+BENCHMARK_BASELINE = os.getenv('BENCHMARK_BASELINE', 'benchmark_baseline.json')
+BENCHMARK_SAVE_BASELINE = os.getenv('BENCHMARK_SAVE_BASELINE', '0') == '1'
+BENCHMARK_TOLERANCE = float(os.getenv('BENCHMARK_TOLERANCE', '0.2'))
+FAKE_LLM_LATENCY = float(os.getenv('FAKE_LLM_LATENCY', '0.3'))
+FAKE_LLM_TOKEN_LATENCY = float(os.getenv('FAKE_LLM_TOKEN_LATENCY', '0.01'))
+FAKE_ANSWER_TOKENS = int(os.getenv('FAKE_ANSWER_TOKENS', '60'))
+FAKE_EMBEDDING_LATENCY = float(os.getenv('FAKE_EMBEDDING_LATENCY', '0.05'))
+FAKE_EMBEDDING_DIMS = int(os.getenv('FAKE_EMBEDDING_DIMS', '256'))
+
+QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', '1024'))
+REWRITE_FAST_PATH = os.getenv('REWRITE_FAST_PATH', '1') == '1'
+REWRITE_SPECULATIVE = os.getenv('REWRITE_SPECULATIVE', '0') == '1'
+STREAMING = os.getenv('STREAMING', '1') == '1'
+REWRITE_HISTORY_TOKENS = int(os.getenv('REWRITE_HISTORY_TOKENS', '1000'))
+ANSWER_HISTORY_TOKENS = int(os.getenv('ANSWER_HISTORY_TOKENS', '3000'))
+HISTORY_SUMMARY = os.getenv('HISTORY_SUMMARY', '1') == '1'
+RETRIEVER_K = int(os.getenv('RETRIEVER_K', '6'))
+HYBRID_SEARCH = os.getenv('HYBRID_SEARCH', '1') == '1'
+HYBRID_CANDIDATES = int(os.getenv('HYBRID_CANDIDATES', '20'))
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '3000'))
+CONTEXT_MAX_PLOT_TOKENS = int(os.getenv('CONTEXT_MAX_PLOT_TOKENS', '400'))
+CONTEXT_MIN_SCORE = float(os.getenv('CONTEXT_MIN_SCORE', '0.25'))
+CONTEXT_MAX_SCORE_GAP = float(os.getenv('CONTEXT_MAX_SCORE_GAP', '0.2'))
+METADATA_MAX_RESULTS = int(os.getenv('METADATA_MAX_RESULTS', '50'))
+LLM_RPM = int(os.getenv('LLM_RPM', '1500'))
+LLM_TPM = int(os.getenv('LLM_TPM', '250000'))
+EMBEDDING_RPM = int(os.getenv('EMBEDDING_RPM', '300'))
+EMBEDDING_TPM = int(os.getenv('EMBEDDING_TPM', '350000'))
+RATE_LIMIT_RESERVE = float(os.getenv('RATE_LIMIT_RESERVE', '0.2'))
+LLM_COALESCE = os.getenv('LLM_COALESCE', '1') == '1'
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv('EMBEDDING_BATCH_WINDOW_MS', '10'))
+
+# The README sample dialogue, plus shorter ones that exercise the neighbour graph and plot search
+DIALOGUES = [
+    [
+        "What movies has Tom Cruise been in?",
+        "What years has he been in movies?",
+        "Show a table of his movies with year, and cast",
+        "Just display the years as a comma-separate list and nothing else",
+        "Tell me about Top Gun",
+        "Which movies did both Tom Cruise and Jamie Foxx star in?",
+        "Find me 3 sci-fi movies for this week's movie marathon, provide a short description for each choice.",
+        "Find me up to 3 movies released in 1987.",
+    ],
+    [
+        "Find me movies like Top Gun",
+        "Which of those has the best cast?",
+        "Tell me about a movie with a cyborg sent back in time",
+    ],
+    [
+        "Suggest a movie about a heist on a train",
+        "Who directed it?",
+        "Something similar to Collateral please",
+    ],
+]
+
+# Same prompts as movie-chat.py
+def get_system_prompt():
+    return (
+        "You are a movie buff assistant who can answer questions about movies, make suggestions, summarise key facts, and provide other useful movie information."
+        "Use the following movie(s) context that and any previous chat history to answer the user's questions."
+        """If you are unsure, just say "I'm unsure". Only discuss movies from the context provided. Provide a succinct follow up prompt.  Don't discuss other topics not related to the movies."""
+        "\n\n"
+        "{context}"
+    )
+
+contextualize_q_system_prompt = (
+    "Given a chat history and the latest user question "
+    "which might reference context in the chat history, "
+    "formulate a standalone question which can be understood "
+    "without the chat history. Do NOT answer the question, "
+    "just reformulate it if needed and otherwise return it as is."
+)
+
+contextualize_q_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", contextualize_q_system_prompt),
+        MessagesPlaceholder("chat_history"),
+        ("human", "{input}"),
+    ]
+)
+
+qa_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", get_system_prompt()),
+        MessagesPlaceholder("chat_history"),
+        ("human", "{input}"),
+    ]
+)
+
+def build_chain(work_dir: str):
+    movie_list = BENCHMARK_MOVIE_LIST
+    if not movie_list:
+        movie_list = os.path.join(work_dir, 'movie_list.csv')
+        pd.DataFrame(synthetic_movies(BENCHMARK_MOVIES)).to_csv(
+            movie_list, index=False, quoting=csv.QUOTE_NONNUMERIC, escapechar='\\', quotechar='"')
+    movies = load_movie_list(movie_list)
+    ids = [id for id, (plot, _) in movies.items() if isinstance(plot, str) and plot]
+
+    # The index is built without injected latency, only chat time calls are slowed down
+    index_embedding = FakeEmbeddings(dims=FAKE_EMBEDDING_DIMS)
+    vectorstore = LocalVectorStore(index_embedding, path=os.path.join(work_dir, 'local_index'))
+    vectorstore.add_texts([movies[id][0] for id in ids], [movies[id][1] for id in ids], keys=ids)
+    vectorstore.save()
+    neighbours_file = os.path.join(work_dir, 'movie_neighbours.npz')
+    build_neighbour_file(movies, index_embedding, neighbours_file)
+
+    governor = LLMGovernor(
+        {'fake-embedding': (EMBEDDING_RPM, EMBEDDING_TPM), 'fake-chat': (LLM_RPM, LLM_TPM)},
+        reserve=RATE_LIMIT_RESERVE,
+        coalesce=LLM_COALESCE,
+        batch_window=EMBEDDING_BATCH_WINDOW_MS / 1000)
+    query_embedding = QueryEmbeddingCache(
+        embedding=governor.embeddings(
+            FakeEmbeddings(dims=FAKE_EMBEDDING_DIMS, latency=FAKE_EMBEDDING_LATENCY), 'fake-embedding'),
+        deployment='fake',
+        max_size=QUERY_CACHE_SIZE)
+    vectorstore = LocalVectorStore.from_existing_index(embedding=query_embedding, path=vectorstore.path)
+    llm = governor.chat_model(
+        FakeChatModel(latency=FAKE_LLM_LATENCY, token_latency=FAKE_LLM_TOKEN_LATENCY, answer_tokens=FAKE_ANSWER_TOKENS),
+        'fake-chat', stream_usage=True)
+    retriever = create_retriever(
+        vectorstore,
+        k=RETRIEVER_K,
+        hybrid=HYBRID_SEARCH,
+        hybrid_candidates=HYBRID_CANDIDATES,
+        metadata_query='local',
+        movie_list=movie_list,
+        max_results=METADATA_MAX_RESULTS,
+        neighbours_file=neighbours_file)
+    context_packer = ContextPacker(
+        token_budget=CONTEXT_TOKEN_BUDGET,
+        max_plot_tokens=CONTEXT_MAX_PLOT_TOKENS,
+        min_score=CONTEXT_MIN_SCORE,
+        max_score_gap=CONTEXT_MAX_SCORE_GAP)
+    rag_chain = build_rag_chain(
+        llm, retriever, contextualize_q_prompt, qa_prompt,
+        rewrite_fast_path=REWRITE_FAST_PATH,
+        speculative_retrieval=REWRITE_SPECULATIVE,
+        rewrite_history_tokens=REWRITE_HISTORY_TOKENS,
+        answer_history_tokens=ANSWER_HISTORY_TOKENS,
+        context_packer=context_packer)
+    # The chat history summaries queue behind the chat turns, as in the apps
+    return rag_chain, llm.with_priority(BACKGROUND), query_embedding, governor, len(ids)
+
+def new_history(llm) -> ChatHistoryManager:
+    return ChatHistoryManager(max_tokens=ANSWER_HISTORY_TOKENS, llm=llm if HISTORY_SUMMARY else None)
+
+def run_dialogue(rag_chain, llm, questions: List[str]) -> int:
+    # Returns the number of failed turns
+    errors, chat_history = 0, new_history(llm)
+    for question in questions:
+        inputs = {"input": question, "chat_history": chat_history.messages()}
+        try:
+            with Trace() as trace:
+                config = {'callbacks': trace.callbacks}
+                if STREAMING:
+                    answer = ''.join(stream_answer(rag_chain, inputs, config=config))
+                else:
+                    answer = rag_chain.invoke(inputs, config=config)["answer"]
+        except Exception as e:
+            print(f"Error during chain execution: {e}")
+            errors += 1
+            continue
+        chat_history.add_turn(question, answer)
+    return errors
+
+async def arun_dialogue(rag_chain, llm, questions: List[str]) -> int:
+    errors, chat_history = 0, new_history(llm)
+    for question in questions:
+        inputs = {"input": question, "chat_history": chat_history.messages()}
+        try:
+            with Trace() as trace:
+                config = {'callbacks': trace.callbacks}
+                if STREAMING:
+                    answer = ''.join([token async for token in astream_answer(rag_chain, inputs, config=config)])
+                else:
+                    answer = (await rag_chain.ainvoke(inputs, config=config))["answer"]
+        except Exception as e:
+            print(f"Error during chain execution: {e}")
+            errors += 1
+            continue
+        chat_history.add_turn(question, answer)
+    return errors
+
+def run_level(rag_chain, llm, work: List[List[str]], concurrency: int) -> int:
+    # Runs the dialogues in `work`, `concurrency` at a time, and returns the number of failed turns
+    if BENCHMARK_MODE == 'async':
+        async def run_all():
+            slots = asyncio.Semaphore(concurrency)
+
+            async def run(questions):
+                async with slots:
+                    return await arun_dialogue(rag_chain, llm, questions)
+
+            return await asyncio.gather(*[run(questions) for questions in work])
+        return sum(asyncio.run(run_all()))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return sum(executor.map(lambda questions: run_dialogue(rag_chain, llm, questions), work))
+
+STAGE_ORDER = ['turn', 'first_token', 'rewrite', 'retrieval', 'query_embedding', 'vector_search', 'metadata_lookup',
+               'neighbour_lookup', 'context_assembly', 'answer_cache', 'answer']
+
+def print_stages(stages: Dict[str, Dict[str, float]]):
+    print(f"  {'stage':<18} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'tokens':>8} {'cache hits':>10}")
+    order = {stage: i for i, stage in enumerate(STAGE_ORDER)}
+    for stage, stats in sorted(stages.items(), key=lambda item: order.get(item[0], len(order))):
+        if 'count' not in stats:
+            continue
+        tokens = stats.get('prompt_tokens', 0) + stats.get('completion_tokens', 0)
+        lookups = stats.get('cache_hits', 0) + stats.get('cache_misses', 0)
+        hits = f"{stats.get('cache_hits', 0) / lookups:.0%}" if lookups else ''
+        print(f"  {stage:<18} {stats['count']:>6} {stats['p50_ms']:>9.1f} {stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f} "
+              f"{tokens or '':>8} {hits:>10}")
+
+# Calls that reached the fakes, and the ones that shared another call instead (cumulative, see LLMGovernor.stats())
+def governor_counts(governor: LLMGovernor) -> Dict[str, int]:
+    stats = governor.stats()
+    chat = stats['chat'] or {'calls': 0, 'coalesced': 0}
+    return {
+        'chat_calls': chat['calls'], 'chat_coalesced': chat['coalesced'],
+        'embedding_requests': sum(embedding['requests'] for embedding in stats['embeddings']),
+        'embedding_texts': sum(embedding['texts'] for embedding in stats['embeddings']),
+    }
+
+def compare(results: Dict, baseline: Dict) -> List[str]:
+    # Regressions against the baseline, stages faster than 1 ms are ignored as noise
+    regressions = []
+    for level, result in results['levels'].items():
+        base = baseline['levels'].get(level)
+        if base is None:
+            continue
+        change = result['turns_per_second'] / base['turns_per_second'] - 1
+        print(f"  concurrency {level}: {result['turns_per_second']:.2f} turns/s ({change:+.0%})")
+        if change < -BENCHMARK_TOLERANCE:
+            regressions.append(f"concurrency {level}: turns/s {base['turns_per_second']:.2f} -> {result['turns_per_second']:.2f}")
+        for stage, stats in result['stages'].items():
+            base_stats = base['stages'].get(stage, {})
+            if 'p95_ms' not in stats or 'p95_ms' not in base_stats or max(stats['p95_ms'], base_stats['p95_ms']) < 1:
+                continue
+            if stats['p95_ms'] > base_stats['p95_ms'] * (1 + BENCHMARK_TOLERANCE):
+                regressions.append(f"concurrency {level}: {stage} p95 {base_stats['p95_ms']:.1f} -> {stats['p95_ms']:.1f} ms")
+    return regressions
+
+with tempfile.TemporaryDirectory() as work_dir:
+    rag_chain, llm, query_embedding, governor, movie_count = build_chain(work_dir)
+    dialogues = DIALOGUES
+    if BENCHMARK_DIALOGUES:
+        with open(BENCHMARK_DIALOGUES, encoding='utf-8') as f:
+            dialogues = json.load(f)
+    turns_per_dialogue = sum(len(questions) for questions in dialogues) / len(dialogues)
+    config = {
+        'mode': BENCHMARK_MODE, 'streaming': STREAMING, 'movies': movie_count, 'dialogues': dialogues,
+        'repeat': BENCHMARK_REPEAT, 'llm_latency': FAKE_LLM_LATENCY, 'llm_token_latency': FAKE_LLM_TOKEN_LATENCY,
+        'answer_tokens': FAKE_ANSWER_TOKENS, 'embedding_latency': FAKE_EMBEDDING_LATENCY,
+        'query_cache_size': QUERY_CACHE_SIZE, 'llm_coalesce': LLM_COALESCE,
+        'embedding_batch_window_ms': EMBEDDING_BATCH_WINDOW_MS,
+    }
+    print(f"Movies: {movie_count}, dialogues: {len(dialogues)} (~{turns_per_dialogue:.1f} turns each), mode: {BENCHMARK_MODE}, "
+          f"LLM latency {FAKE_LLM_LATENCY}s + {FAKE_LLM_TOKEN_LATENCY}s/token, embedding latency {FAKE_EMBEDDING_LATENCY}s")
+
+    # Warm-up pass, loads everything the first turn would
+    run_level(rag_chain, llm, dialogues, 1)
+    # The same dialogues at every level, so turns/s and the percentiles compare across levels and with the baseline
+    work = dialogues * BENCHMARK_REPEAT
+    results = {'config': config, 'levels': {}}
+    for concurrency in BENCHMARK_CONCURRENCY:
+        if concurrency > len(work):
+            print(f"\nConcurrency {concurrency}: only {len(work)} dialogues run at once, raise BENCHMARK_REPEAT to load it fully")
+        query_embedding.clear()
+        metrics.reset()
+        before = governor_counts(governor)
+        start_time = time.perf_counter()
+        errors = run_level(rag_chain, llm, work, concurrency)
+        elapsed = time.perf_counter() - start_time
+        stages = metrics.snapshot()
+        turns = stages.get('turn', {}).get('count', 0)
+        upstream = {name: count - before[name] for name, count in governor_counts(governor).items()}
+        results['levels'][str(concurrency)] = {'turns': turns, 'errors': errors, 'seconds': round(elapsed, 2),
+                                               'turns_per_second': round(turns / elapsed, 3), 'stages': stages,
+                                               'upstream': upstream}
+        print(f"\nConcurrency {concurrency}: {turns} turns in {elapsed:.1f}s, {turns / elapsed:.2f} turns/s, {errors} errors")
+        # Chat calls are only counted by the coalescer
+        chat_calls = f"chat calls {upstream['chat_calls']} (+{upstream['chat_coalesced']} coalesced), " if LLM_COALESCE else ''
+        print(f"  {chat_calls}embedding requests {upstream['embedding_requests']} for {upstream['embedding_texts']} texts")
+        print_stages(stages)
+
+print(f"\n{'concurrency':>11} {'turns/s':>8} {'turn p50':>9} {'turn p95':>9} {'turn p99':>9} {'TTFT p95':>9}")
+for level, result in results['levels'].items():
+    turn, first_token = result['stages'].get('turn', {}), result['stages'].get('first_token', {})
+    print(f"{level:>11} {result['turns_per_second']:>8.2f} {turn.get('p50_ms', 0):>9.0f} {turn.get('p95_ms', 0):>9.0f} "
+          f"{turn.get('p99_ms', 0):>9.0f} {first_token.get('p95_ms', 0):>9.0f}")
+
+if BENCHMARK_SAVE_BASELINE:
+    with open(BENCHMARK_BASELINE, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nBaseline saved to {BENCHMARK_BASELINE}")
+elif os.path.exists(BENCHMARK_BASELINE):
+    with open(BENCHMARK_BASELINE, encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"\nCompared with {BENCHMARK_BASELINE} (tolerance {BENCHMARK_TOLERANCE:.0%}):")
+    if baseline.get('config') != config:
+        print("  Warning: the baseline was recorded with different settings, differences may not be regressions")
+    regressions = compare(results, baseline)
+    for regression in regressions:
+        print(f"  REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+    print("  No regressions")
+else:
+    print(f"\nNo baseline found, run with BENCHMARK_SAVE_BASELINE=1 to save these results to {BENCHMARK_BASELINE}")
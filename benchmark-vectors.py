@@ -0,0 +1,112 @@
+# Recall@10 and latency benchmark of compressed vector storage against exact float32 search.
+# Movie embeddings are read from the embedding cache (run create-redis-index.py or create-local-index.py first), so no
+# movie is re-embedded. Each configuration is built as a local vector index in a temporary directory and queried with
+# the same saved query set; recall@10 is measured against the exact float32 top 10.
+#
+# The query set is either the questions in BENCHMARK_QUERIES (one per line, embedded once and cached), or the plot
+# embeddings of a random sample of movies, whose ids are saved to benchmark_query_ids.npy so every run uses the same
+# queries. Sampled movies are held out of the searched index, so a query can't simply find its own vector.
+#
+#   python benchmark-vectors.py
+
+import os
+import tempfile
+import numpy as np
+from dotenv import load_dotenv
+from langchain_openai import AzureOpenAIEmbeddings
+
+from compression import bytes_per_vector, latency_percentiles, recall_at_k, timed
+from ingestion import CachedEmbeddings, EmbeddingCache, fingerprint_text
+from local_vectorstore import LocalVectorStore
+from preprocessing import load_movie_list
+
+load_dotenv()
+
+API_KEY = os.getenv('API_KEY')
+RESOURCE_ENDPOINT = os.getenv('RESOURCE_ENDPOINT')
+DEPLOYMENT_NAME = os.getenv('DEPLOYMENT_NAME')
+
+EMBEDDING_CACHE_PATH = os.getenv('EMBEDDING_CACHE_PATH', 'embedding_cache.db')
+FILE_NAME = os.getenv('MOVIE_LIST', 'movie_list.csv')
+BENCHMARK_QUERIES = os.getenv('BENCHMARK_QUERIES', 'benchmark_queries.txt')
+BENCHMARK_SAMPLE = int(os.getenv('BENCHMARK_SAMPLE', '200'))
+BENCHMARK_K = 10
+QUERY_IDS_FILE = 'benchmark_query_ids.npy'
+
+# (dtype, dims, rescore candidates), None dims keeps the full width
+CONFIGS = [
+    ('float32', None, 0),
+    ('float16', None, 0),
+    ('int8', None, 0),
+    ('int8', None, 50),
+    ('float32', 1024, 0),
+    ('float32', 512, 0),
+    ('float32', 256, 0),
+    ('int8', 512, 0),
+    ('int8', 512, 50),
+    ('int8', 256, 100),
+]
+
+movies = load_movie_list(FILE_NAME)
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH)
+keys = {id: fingerprint_text(plot, DEPLOYMENT_NAME) for id, (plot, _) in movies.items()}
+cached = embedding_cache.get_many(list(set(keys.values())))
+ids = [id for id in movies if keys[id] in cached]
+if not ids:
+    raise SystemExit(f"No movie embeddings found in {EMBEDDING_CACHE_PATH} for deployment {DEPLOYMENT_NAME}.")
+vectors = np.asarray([cached[keys[id]] for id in ids], dtype=np.float32)
+print(f"Movies: {len(ids)} of {len(movies)} with cached embeddings, {vectors.shape[1]} dimensions")
+
+if os.path.exists(BENCHMARK_QUERIES):
+    with open(BENCHMARK_QUERIES, encoding='utf-8') as f:
+        questions = [line.strip() for line in f if line.strip()]
+    embedding = AzureOpenAIEmbeddings(
+        azure_endpoint=RESOURCE_ENDPOINT,
+        azure_deployment=DEPLOYMENT_NAME,
+        openai_api_key=API_KEY,
+        openai_api_version='2024-03-01-preview')
+    # Questions go through the embedding cache too, so the query set is only embedded once
+    queries = np.asarray(CachedEmbeddings(embedding, embedding_cache, DEPLOYMENT_NAME).embed_documents(questions), dtype=np.float32)
+    print(f"Queries: {len(queries)} questions from {BENCHMARK_QUERIES}")
+else:
+    position = {id: i for i, id in enumerate(ids)}
+    if os.path.exists(QUERY_IDS_FILE):
+        query_ids = [id for id in np.load(QUERY_IDS_FILE).tolist() if id in position]
+        print(f"Queries: {len(query_ids)} plot embeddings of the movies saved in {QUERY_IDS_FILE}")
+    else:
+        rng = np.random.default_rng(0)
+        # at least one movie stays in the index
+        sample = rng.choice(len(ids), size=min(BENCHMARK_SAMPLE, len(ids) - 1), replace=False)
+        query_ids = [ids[i] for i in sample]
+        np.save(QUERY_IDS_FILE, np.asarray(query_ids))
+        print(f"Queries: {len(query_ids)} sampled plot embeddings, movie ids saved to {QUERY_IDS_FILE}")
+    queries = vectors[[position[id] for id in query_ids]]
+    # Held out of the index: otherwise every query's top match is its own vector, which inflates recall
+    held_out = set(query_ids)
+    kept = [i for i, id in enumerate(ids) if id not in held_out]
+    ids, vectors = [ids[i] for i in kept], vectors[kept]
+    print(f"Index: {len(ids)} movies, the query movies held out")
+embedding_cache.close()
+
+exact = None
+print(f"\n{'dtype':<8} {'dims':>5} {'rescore':>7} {'MB':>8} {'recall@10':>9} {'p50 ms':>7} {'p95 ms':>7}")
+for dtype, dims, rescore in CONFIGS:
+    if dims and dims > vectors.shape[1]:
+        continue
+    with tempfile.TemporaryDirectory() as path:
+        store = LocalVectorStore(None, path=path, dtype=dtype, dims=dims, keep_full=rescore > 0, rescore=rescore)
+        store.add_texts(['' for _ in ids], embeddings=vectors, keys=ids)
+        results, latencies = [], []
+        for query in queries:
+            rows, seconds = timed(store.search_by_vector, query, k=BENCHMARK_K)
+            results.append([row for row, _ in rows])
+            latencies.append(seconds)
+    if exact is None:
+        exact = results
+    # Memory of the searched vectors, the full vectors used for rescoring can stay on disk
+    size_mb = len(ids) * bytes_per_vector(dims or vectors.shape[1], dtype) / 1024 / 1024
+    latency = latency_percentiles(latencies)
+    print(f"{dtype:<8} {dims or vectors.shape[1]:>5} {rescore:>7} {size_mb:>8.1f} {recall_at_k(exact, results, BENCHMARK_K):>9.3f} "
+          f"{latency['p50']:>7.2f} {latency['p95']:>7.2f}")
+
+print("\nThe first row is the exact float32 baseline. Redis memory for the vector field scales the same way with VECTOR_DIMS.")
@@ -0,0 +1,76 @@
+import time
+from typing import AsyncIterator, Dict, Iterator, Optional
+
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import Runnable, RunnableConfig, RunnablePassthrough
+from langchain_core.language_models import BaseChatModel
+from langchain.chains.combine_documents import create_stuff_documents_chain
+
+from answer_cache import SemanticAnswerCache
+from chat_history import trim_history
+from context_packing import ContextPacker
+from question_rewrite import create_rewrite_and_retrieve_chain, create_rewrite_chain
+
+# Shared RAG chain construction for the console and Streamlit apps.
+# It follows the same flow as create_history_aware_retriever + create_retrieval_chain, but keeps the rewritten
+# question in the chain state as `standalone_question` so the stages after the rewrite can use it.
+# Output keys: input, chat_history, standalone_question, context, answer.
+# The chat history is trimmed separately for the rewrite prompt and the answer prompt, each to its own token budget,
+# and the retrieved movies can be deduped, reranked and packed into a token budget before they reach the answer prompt.
+
+def with_history_budget(runnable: Runnable, max_tokens: Optional[int]) -> Runnable:
+    if max_tokens is None:
+        return runnable
+    return RunnablePassthrough.assign(chat_history=lambda x: trim_history(x.get("chat_history") or [], max_tokens)) | runnable
+
+def build_rag_chain(llm: BaseChatModel, retriever: BaseRetriever, contextualize_q_prompt: ChatPromptTemplate,
+                    qa_prompt: ChatPromptTemplate, answer_cache: Optional[SemanticAnswerCache] = None,
+                    rewrite_fast_path: bool = True, speculative_retrieval: bool = False,
+                    rewrite_history_tokens: Optional[int] = None, answer_history_tokens: Optional[int] = None,
+                    context_packer: Optional[ContextPacker] = None) -> Runnable:
+    rewrite_and_retrieve = create_rewrite_and_retrieve_chain(
+        llm, retriever, with_history_budget(contextualize_q_prompt, rewrite_history_tokens),
+        fast_path=rewrite_fast_path, speculative=speculative_retrieval)
+
+    question_answer_chain = with_history_budget(create_stuff_documents_chain(llm, qa_prompt), answer_history_tokens)
+    if answer_cache is not None:
+        question_answer_chain = answer_cache.wrap(question_answer_chain)
+
+    if context_packer is not None:
+        rewrite_and_retrieve = rewrite_and_retrieve | RunnablePassthrough.assign(context=context_packer.as_runnable())
+
+    return (
+        rewrite_and_retrieve
+        | RunnablePassthrough.assign(answer=question_answer_chain)
+    ).with_config(run_name="retrieval_chain")
+
+# The rewrite step of build_rag_chain on its own, to rewrite a batch of questions before running the chain on them
+def build_rewrite_chain(llm: BaseChatModel, contextualize_q_prompt: ChatPromptTemplate,
+                        rewrite_history_tokens: Optional[int] = None) -> Runnable:
+    return create_rewrite_chain(llm, with_history_budget(contextualize_q_prompt, rewrite_history_tokens))
+
+# Streams the answer tokens of a RAG chain turn as they are generated.
+# `timings` (if given) is filled with the time to first token and the total time, in seconds.
+def stream_answer(chain: Runnable, inputs: Dict, config: Optional[RunnableConfig] = None,
+                  timings: Optional[Dict[str, float]] = None) -> Iterator[str]:
+    start_time = time.time()
+    for chunk in chain.stream(inputs, config=config):
+        if "answer" in chunk:
+            if timings is not None and "time_to_first_token" not in timings:
+                timings["time_to_first_token"] = time.time() - start_time
+            yield chunk["answer"]
+    if timings is not None:
+        timings["total"] = time.time() - start_time
+
+# Async version of stream_answer, used by the chat server so one slow LLM call doesn't hold up a worker
+async def astream_answer(chain: Runnable, inputs: Dict, config: Optional[RunnableConfig] = None,
+                         timings: Optional[Dict[str, float]] = None) -> AsyncIterator[str]:
+    start_time = time.time()
+    async for chunk in chain.astream(inputs, config=config):
+        if "answer" in chunk:
+            if timings is not None and "time_to_first_token" not in timings:
+                timings["time_to_first_token"] = time.time() - start_time
+            yield chunk["answer"]
+    if timings is not None:
+        timings["total"] = time.time() - start_time
@@ -0,0 +1,391 @@
+# Async HTTP chat API for the movie chat, serving many concurrent conversations from one process.
+# The RAG chain is built exactly as in the console and Streamlit apps, but runs with ainvoke/astream. All sessions
+# share one pooled HTTP client for Azure OpenAI and one Redis connection pool. A global limit caps the number of turns
+# running at once, and each session accepts a bounded number of pending turns.
+#
+#   python chat-server.py
+#
+#   POST   /chat                  {"question": "...", "session_id": "... (optional)", "stream": true}
+#                                 streams the answer as server-sent events (session, token, done or error events),
+#                                 or returns {"session_id", "answer"} as JSON with "stream": false
+#   DELETE /sessions/{session_id} ends a conversation and clears its history
+#   GET    /health                session count, turns in progress, cache stats and per-stage latency percentiles
+#   GET    /metrics               per-stage latency, token and cache metrics in the Prometheus text format
+
+import asyncio
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import redis
+from aiohttp import web
+from dotenv import load_dotenv
+from langchain_openai import AzureChatOpenAI, AzureOpenAIEmbeddings
+from langchain_community.vectorstores import Redis as RedisVectorStore
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+import debugging as debugging
+from answer_cache import SemanticAnswerCache
+from chains import astream_answer, build_rag_chain
+from chat_sessions import SessionBusy, SessionManager
+from chunking import load_chunk_index
+from compression import TruncatedEmbeddings
+from context_packing import ContextPacker
+from instrumentation import Trace, TraceWriter, metrics
+from llm_governor import LLMGovernor
+from local_vectorstore import LocalVectorStore
+from query_embedding_cache import QueryEmbeddingCache
+from rate_limit import BACKGROUND
+from session_store import InMemorySessionStore, RedisSessionStore
+from retrievers import create_retriever
+
+load_dotenv()
+
+API_KEY = os.getenv('API_KEY')
+RESOURCE_ENDPOINT = os.getenv('RESOURCE_ENDPOINT')
+DEPLOYMENT_NAME = os.getenv('DEPLOYMENT_NAME')
+REDIS_ENDPOINT = os.getenv('REDIS_ENDPOINT')
+REDIS_PASSWORD = os.getenv('REDIS_PASSWORD')
+DEBUG = os.getenv('DEBUG')
+QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', '1024'))
+QUERY_CACHE_TTL = int(os.getenv('QUERY_CACHE_TTL', '86400'))
+ANSWER_CACHE = os.getenv('ANSWER_CACHE', '1') == '1'
+ANSWER_CACHE_THRESHOLD = float(os.getenv('ANSWER_CACHE_THRESHOLD', '0.95'))
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', '3600'))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', '10000'))
+REWRITE_FAST_PATH = os.getenv('REWRITE_FAST_PATH', '1') == '1'
+REWRITE_SPECULATIVE = os.getenv('REWRITE_SPECULATIVE', '0') == '1'
+REWRITE_HISTORY_TOKENS = int(os.getenv('REWRITE_HISTORY_TOKENS', '1000'))
+ANSWER_HISTORY_TOKENS = int(os.getenv('ANSWER_HISTORY_TOKENS', '3000'))
+HISTORY_SUMMARY = os.getenv('HISTORY_SUMMARY', '1') == '1'
+RETRIEVER_K = int(os.getenv('RETRIEVER_K', '6'))
+HYBRID_SEARCH = os.getenv('HYBRID_SEARCH', '1') == '1'
+HYBRID_CANDIDATES = int(os.getenv('HYBRID_CANDIDATES', '20'))
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '3000'))
+CONTEXT_MAX_PLOT_TOKENS = int(os.getenv('CONTEXT_MAX_PLOT_TOKENS', '400'))
+CONTEXT_MIN_SCORE = float(os.getenv('CONTEXT_MIN_SCORE', '0.25'))
+CONTEXT_MAX_SCORE_GAP = float(os.getenv('CONTEXT_MAX_SCORE_GAP', '0.2'))
+METADATA_QUERY = os.getenv('METADATA_QUERY', 'redis')
+METADATA_MAX_RESULTS = int(os.getenv('METADATA_MAX_RESULTS', '50'))
+MOVIE_LIST = os.getenv('MOVIE_LIST', 'movie_list.csv')
+VECTOR_STORE = os.getenv('VECTOR_STORE', 'redis')
+LOCAL_INDEX_PATH = os.getenv('LOCAL_INDEX_PATH', 'local_index')
+LOCAL_INDEX_PROBES = int(os.getenv('LOCAL_INDEX_PROBES', '8'))
+LOCAL_INDEX_RESCORE = int(os.getenv('LOCAL_INDEX_RESCORE', '0'))
+NEIGHBOURS_FILE = os.getenv('NEIGHBOURS_FILE', 'movie_neighbours.npz')
+# Search the plot chunk index built with PLOT_CHUNKS=1 instead of whole plots
+PLOT_CHUNKS = os.getenv('PLOT_CHUNKS', '0') == '1'
+PLOT_CHUNKS_PER_MOVIE = int(os.getenv('PLOT_CHUNKS_PER_MOVIE', '3'))
+LOCAL_CHUNK_INDEX_PATH = os.getenv('LOCAL_CHUNK_INDEX_PATH', 'local_chunk_index')
+VECTOR_DIMS = int(os.getenv('VECTOR_DIMS', '0'))
+
+SERVER_HOST = os.getenv('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.getenv('SERVER_PORT', '8000'))
+# Turns running at once across all sessions, and how long a turn may wait for a slot before the server answers 503
+SERVER_MAX_CONCURRENCY = int(os.getenv('SERVER_MAX_CONCURRENCY', '64'))
+SERVER_QUEUE_TIMEOUT = float(os.getenv('SERVER_QUEUE_TIMEOUT', '10'))
+# Threads for the blocking parts of a turn (retrieval, cache lookups); the LLM calls themselves are async
+SERVER_THREADS = int(os.getenv('SERVER_THREADS', '32'))
+# Turns a session may have running or waiting, further turns get 429
+SESSION_MAX_PENDING = int(os.getenv('SESSION_MAX_PENDING', '2'))
+SESSION_IDLE_TTL = int(os.getenv('SESSION_IDLE_TTL', '3600'))
+SESSION_MAX_COUNT = int(os.getenv('SESSION_MAX_COUNT', '10000'))
+# Chat histories in Redis (shared by every replica) or in process, they expire SESSION_TTL seconds after the last turn
+SESSION_STORE = os.getenv('SESSION_STORE', 'redis' if VECTOR_STORE == 'redis' else 'memory')
+SESSION_TTL = int(os.getenv('SESSION_TTL', '86400'))
+# Shared connection pools
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', '100'))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '60'))
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', '64'))
+# Quotas of the chat and embedding deployments (requests and tokens per minute), the share of them kept for chat turns
+# when history summaries compete with them, and the time concurrent query embeddings are collected for one request
+LLM_RPM = int(os.getenv('LLM_RPM', '1500'))
+LLM_TPM = int(os.getenv('LLM_TPM', '250000'))
+EMBEDDING_RPM = int(os.getenv('EMBEDDING_RPM', '300'))
+EMBEDDING_TPM = int(os.getenv('EMBEDDING_TPM', '350000'))
+RATE_LIMIT_RESERVE = float(os.getenv('RATE_LIMIT_RESERVE', '0.2'))
+LLM_COALESCE = os.getenv('LLM_COALESCE', '1') == '1'
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv('EMBEDDING_BATCH_WINDOW_MS', '10'))
+# Per-stage timings of every turn as JSON lines
+TRACE_FILE = os.getenv('TRACE_FILE')
+
+def get_system_prompt():
+    return (
+        "You are a movie buff assistant who can answer questions about movies, make suggestions, summarise key facts, and provide other useful movie information."
+        "Use the following movie(s) context that and any previous chat history to answer the user's questions."
+        """If you are unsure, just say "I'm unsure". Only discuss movies from the context provided. Provide a succinct follow up prompt.  Don't discuss other topics not related to the movies."""
+        "\n\n"
+        "{context}"
+    )
+
+contextualize_q_system_prompt = (
+    "Given a chat history and the latest user question "
+    "which might reference context in the chat history, "
+    "formulate a standalone question which can be understood "
+    "without the chat history. Do NOT answer the question, "
+    "just reformulate it if needed and otherwise return it as is."
+)
+
+contextualize_q_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", contextualize_q_system_prompt),
+        MessagesPlaceholder("chat_history"),
+        ("human", "{input}"),
+    ]
+)
+
+qa_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", get_system_prompt()),
+        MessagesPlaceholder("chat_history"),
+        ("human", "{input}"),
+    ]
+)
+
+# One rate limit per deployment for every session: turns wait their turn locally instead of running into 429s, identical
+# chat requests in flight share one call, and query embeddings from concurrent turns are sent together (llm_governor.py)
+governor = LLMGovernor(
+    {DEPLOYMENT_NAME: (EMBEDDING_RPM, EMBEDDING_TPM), 'gpt-4o-mini': (LLM_RPM, LLM_TPM)},
+    reserve=RATE_LIMIT_RESERVE,
+    coalesce=LLM_COALESCE,
+    batch_window=EMBEDDING_BATCH_WINDOW_MS / 1000)
+
+# One keep-alive connection pool to Azure OpenAI for every session, for the async LLM calls and for the blocking
+# calls made from worker threads (query embeddings, chat history summaries). Its responses update the governor.
+http_limits = httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS)
+http_client = httpx.Client(limits=http_limits, timeout=HTTP_TIMEOUT, event_hooks=governor.event_hooks())
+http_async_client = httpx.AsyncClient(limits=http_limits, timeout=HTTP_TIMEOUT,
+                                      event_hooks=governor.event_hooks(async_=True))
+
+embedding = governor.embeddings(AzureOpenAIEmbeddings(
+    azure_endpoint=RESOURCE_ENDPOINT,
+    azure_deployment=DEPLOYMENT_NAME,
+    openai_api_key=API_KEY,
+    openai_api_version='2024-03-01-preview',
+    chunk_size=16,
+    http_client=http_client,
+    http_async_client=http_async_client), DEPLOYMENT_NAME)
+
+llm = governor.chat_model(AzureChatOpenAI(
+    azure_endpoint=RESOURCE_ENDPOINT,
+    azure_deployment='gpt-4o-mini',
+    api_key=API_KEY,
+    openai_api_version="2024-09-01-preview",
+    http_client=http_client,
+    http_async_client=http_async_client), 'gpt-4o-mini', stream_usage=True)
+
+redis_url = "rediss://:" + REDIS_PASSWORD + "@"+ REDIS_ENDPOINT if VECTOR_STORE == 'redis' else None
+
+query_embedding = QueryEmbeddingCache(
+    embedding=embedding,
+    deployment=DEPLOYMENT_NAME,
+    max_size=QUERY_CACHE_SIZE,
+    ttl=QUERY_CACHE_TTL)
+
+if VECTOR_STORE == 'redis':
+    # max_connections bounds the connection pool of the vector store's client, which all the caches share
+    vectorstore = RedisVectorStore.from_existing_index(
+        embedding=TruncatedEmbeddings(query_embedding, VECTOR_DIMS) if VECTOR_DIMS else query_embedding,
+        redis_url=redis_url,
+        index_name="movieindex",
+        schema="redis_schema.yaml",
+        max_connections=REDIS_MAX_CONNECTIONS)
+    query_embedding.client = vectorstore.client
+else:
+    vectorstore = LocalVectorStore.from_existing_index(
+        embedding=query_embedding,
+        path=LOCAL_INDEX_PATH,
+        n_probe=LOCAL_INDEX_PROBES,
+        rescore=LOCAL_INDEX_RESCORE)
+
+# matching plot chunks instead of whole plots, collapsed to one document per movie (see chunking.py)
+chunk_vectorstore = load_chunk_index(
+    vectorstore,
+    redis_url=redis_url,
+    path=LOCAL_CHUNK_INDEX_PATH,
+    n_probe=LOCAL_INDEX_PROBES,
+    rescore=LOCAL_INDEX_RESCORE) if PLOT_CHUNKS else None
+
+retriever = create_retriever(
+    vectorstore,
+    k=RETRIEVER_K,
+    hybrid=HYBRID_SEARCH,
+    hybrid_candidates=HYBRID_CANDIDATES,
+    metadata_query=METADATA_QUERY,
+    movie_list=MOVIE_LIST,
+    max_results=METADATA_MAX_RESULTS,
+    neighbours_file=NEIGHBOURS_FILE,
+    chunk_vectorstore=chunk_vectorstore,
+    chunks_per_movie=PLOT_CHUNKS_PER_MOVIE,
+    debug=bool(DEBUG))
+
+context_packer = ContextPacker(
+    token_budget=CONTEXT_TOKEN_BUDGET,
+    max_plot_tokens=CONTEXT_MAX_PLOT_TOKENS,
+    min_score=CONTEXT_MIN_SCORE,
+    max_score_gap=CONTEXT_MAX_SCORE_GAP,
+    debug=bool(DEBUG))
+
+answer_cache = SemanticAnswerCache(
+    client=vectorstore.client,
+    embedding=query_embedding,
+    threshold=ANSWER_CACHE_THRESHOLD,
+    ttl=ANSWER_CACHE_TTL,
+    max_entries=ANSWER_CACHE_MAX_ENTRIES) if ANSWER_CACHE and VECTOR_STORE == 'redis' else None
+
+rag_chain = build_rag_chain(
+    llm, retriever, contextualize_q_prompt, qa_prompt,
+    answer_cache=answer_cache,
+    rewrite_fast_path=REWRITE_FAST_PATH,
+    speculative_retrieval=REWRITE_SPECULATIVE,
+    rewrite_history_tokens=REWRITE_HISTORY_TOKENS,
+    answer_history_tokens=ANSWER_HISTORY_TOKENS,
+    context_packer=context_packer)
+
+if SESSION_STORE == 'redis':
+    session_store = RedisSessionStore(vectorstore.client if VECTOR_STORE == 'redis' else redis.Redis.from_url(
+        "rediss://:" + REDIS_PASSWORD + "@"+ REDIS_ENDPOINT, max_connections=REDIS_MAX_CONNECTIONS), ttl=SESSION_TTL)
+else:
+    session_store = InMemorySessionStore(ttl=SESSION_TTL)
+
+sessions = SessionManager(
+    llm=llm.with_priority(BACKGROUND) if HISTORY_SUMMARY else None,
+    max_history_tokens=ANSWER_HISTORY_TOKENS,
+    max_sessions=SESSION_MAX_COUNT,
+    idle_ttl=SESSION_IDLE_TTL,
+    max_pending=SESSION_MAX_PENDING,
+    store=session_store)
+
+turn_slots = asyncio.Semaphore(SERVER_MAX_CONCURRENCY)
+active_turns = 0
+trace_writer = TraceWriter(TRACE_FILE) if TRACE_FILE else None
+
+# Session ids are the hex ids the server hands out, or ids of the same shape chosen by the client
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+def sse_event(event: str, data) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode('utf-8')
+
+async def acquire_turn_slot() -> bool:
+    try:
+        await asyncio.wait_for(turn_slots.acquire(), timeout=SERVER_QUEUE_TIMEOUT)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+async def chat(request: web.Request) -> web.StreamResponse:
+    global active_turns
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(text="Expected a JSON body")
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text="Expected a JSON object")
+    question = str(body.get('question') or '').strip()
+    if not question:
+        raise web.HTTPBadRequest(text="'question' is required")
+    session_id = body.get('session_id')
+    if session_id is not None and not (isinstance(session_id, str) and SESSION_ID_PATTERN.fullmatch(session_id)):
+        raise web.HTTPBadRequest(text="'session_id' must be up to 64 letters, digits, '-' or '_'")
+    session = sessions.get(session_id)
+
+    try:
+        async with sessions.turn(session):
+            if not await acquire_turn_slot():
+                raise web.HTTPServiceUnavailable(text="Server busy, try again shortly", headers={'Retry-After': '1'})
+            active_turns += 1
+            try:
+                # The session store may be Redis, so history reads and writes run off the event loop
+                loop = asyncio.get_running_loop()
+                inputs = {"input": question, "chat_history": await loop.run_in_executor(None, session.history.messages)}
+                if not body.get('stream', True):
+                    try:
+                        with Trace(trace_writer, app='server', session_id=session.id) as trace:
+                            answer = (await rag_chain.ainvoke(inputs, config={'callbacks': trace.callbacks}))["answer"]
+                    except Exception as e:
+                        # the details stay in the server log (and the trace), not in the response
+                        print(f"Error during chain execution (trace {trace.id}): {e}")
+                        raise web.HTTPInternalServerError(text=f"Error answering the question (trace {trace.id})")
+                    if DEBUG:
+                        debugging.debug_trace(trace)
+                    await loop.run_in_executor(None, session.history.add_turn, question, answer)
+                    return web.json_response({'session_id': session.id, 'answer': answer, 'trace_id': trace.id})
+
+                response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+                await response.prepare(request)
+                await response.write(sse_event('session', {'session_id': session.id}))
+                timings, tokens = {}, []
+                try:
+                    with Trace(trace_writer, app='server', session_id=session.id) as trace:
+                        async for token in astream_answer(rag_chain, inputs, config={'callbacks': trace.callbacks},
+                                                          timings=timings):
+                            tokens.append(token)
+                            await response.write(sse_event('token', token))
+                except ConnectionResetError:
+                    # The client went away mid-answer, there is nobody to send an error event to. A cancelled handler
+                    # gets CancelledError, which isn't an Exception, so it isn't reported as a chain error either.
+                    return response
+                except Exception as e:
+                    # The status line has already been sent, so errors are reported as an event
+                    print(f"Error during chain execution (trace {trace.id}): {e}")
+                    await response.write(sse_event('error', {'message': "Error answering the question", 'trace_id': trace.id}))
+                    return response
+                if DEBUG:
+                    debugging.debug_trace(trace)
+                answer = ''.join(tokens)
+                await loop.run_in_executor(None, session.history.add_turn, question, answer)
+                try:
+                    await response.write(sse_event('done', {'answer': answer, 'trace_id': trace.id, **timings}))
+                    await response.write_eof()
+                except ConnectionResetError:
+                    pass
+                return response
+            finally:
+                active_turns -= 1
+                turn_slots.release()
+    except SessionBusy as e:
+        raise web.HTTPTooManyRequests(text=str(e), headers={'Retry-After': '1'})
+
+async def delete_session(request: web.Request) -> web.Response:
+    if not SESSION_ID_PATTERN.fullmatch(request.match_info['session_id']):
+        raise web.HTTPBadRequest(text="Invalid session id")
+    await asyncio.get_running_loop().run_in_executor(None, sessions.delete, request.match_info['session_id'])
+    return web.json_response({'deleted': request.match_info['session_id']})
+
+async def health(request: web.Request) -> web.Response:
+    return web.json_response({
+        'sessions': len(sessions),
+        'active_turns': active_turns,
+        'max_concurrency': SERVER_MAX_CONCURRENCY,
+        'query_embedding_cache': query_embedding.stats(),
+        'answer_cache': answer_cache.stats() if answer_cache else None,
+        'governor': governor.stats(),
+        'stages': metrics.snapshot(),
+    })
+
+async def prometheus_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.prometheus(), content_type='text/plain')
+
+async def on_startup(app: web.Application):
+    # LangChain runs the blocking steps of ainvoke/astream (our retrievers, the caches) in the default executor
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=SERVER_THREADS,
+                                                                       thread_name_prefix="chat-worker"))
+
+async def on_cleanup(app: web.Application):
+    await http_async_client.aclose()
+    http_client.close()
+
+app = web.Application()
+app.add_routes([
+    web.post('/chat', chat),
+    web.delete('/sessions/{session_id}', delete_session),
+    web.get('/health', health),
+    web.get('/metrics', prometheus_metrics),
+])
+app.on_startup.append(on_startup)
+app.on_cleanup.append(on_cleanup)
+
+if __name__ == "__main__":
+    web.run_app(app, host=SERVER_HOST, port=SERVER_PORT)
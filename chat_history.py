@@ -0,0 +1,93 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple, Union
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, trim_messages
+from langchain_core.messages.utils import count_tokens_approximately
+
+from session_store import InMemorySessionStore, RedisSessionStore, SessionWindow
+
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+# Rolling summaries run in the background so compaction never delays a turn
+_summarizer = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-summarizer")
+
+def trim_history(messages: List[BaseMessage], max_tokens: int) -> List[BaseMessage]:
+    # Keeps the most recent whole turns within max_tokens (plus a leading summary, if any)
+    return trim_messages(
+        messages,
+        max_tokens=max_tokens,
+        token_counter=count_tokens_approximately,
+        strategy="last",
+        start_on="human",
+        include_system=True,
+    )
+
+def summarize_prompt(summary: Optional[str], messages: List[BaseMessage]) -> List[BaseMessage]:
+    transcript = "\n".join(f"{message.type}: {message.content}" for message in messages)
+    return [
+        SystemMessage(content=(
+            "Summarise the conversation between a user and a movie buff assistant in a few sentences. "
+            "Keep the movie titles, people, years and genres that were discussed, they may be referred to later. "
+            "Only return the summary.")),
+        HumanMessage(content=(f"Existing summary: {summary}\n\n" if summary else "") + f"New messages:\n{transcript}"),
+    ]
+
+# Chat history that only persists question/answer turns (retrieved movie context never enters it) and keeps the
+# prompt size flat in long sessions. Turns that no longer fit in the answer prompt budget are either dropped or,
+# when an LLM is given, folded into a rolling summary in the background. The chain applies the per-prompt budgets
+# to messages() with trim_history().
+# The history itself lives in a session store (see session_store.py), in process by default. With a RedisSessionStore
+# any replica can serve the session: each turn appends its two messages and messages() reads only the window needed.
+class ChatHistoryManager:
+    def __init__(self, max_tokens: int = 3000, llm: Optional[BaseChatModel] = None,
+                 store: Optional[Union[InMemorySessionStore, RedisSessionStore]] = None, session_id: str = "default"):
+        self.max_tokens = max_tokens
+        self.llm = llm
+        self.store = store or InMemorySessionStore()
+        self.session_id = session_id
+        self._compacting = False
+        self._lock = threading.Lock()
+
+    def _window(self) -> Tuple[SessionWindow, List[BaseMessage]]:
+        window = self.store.load(self.session_id, self.max_tokens)
+        return window, trim_history(window.messages, self.max_tokens)
+
+    def messages(self) -> List[BaseMessage]:
+        window, kept = self._window()
+        summary = [SystemMessage(content=SUMMARY_PREFIX + window.summary)] if window.summary else []
+        return summary + kept
+
+    def add_turn(self, question: str, answer: str):
+        self.store.append(self.session_id, [HumanMessage(content=question), AIMessage(content=answer)])
+        window, kept = self._window()
+        # Messages before `keep_from` no longer fit the budget and aren't covered by the summary yet
+        keep_from = window.total - len(kept)
+        if keep_from <= window.summarized:
+            return
+        if self.llm is None:
+            self.store.set_summary(self.session_id, None, keep_from, window.generation)
+            return
+        with self._lock:
+            if self._compacting:
+                return
+            self._compacting = True
+        _summarizer.submit(self._compact, window, keep_from)
+
+    def _compact(self, window: SessionWindow, keep_from: int):
+        try:
+            dropped = self.store.range(self.session_id, window.summarized, keep_from)
+            new_summary = self.llm.invoke(summarize_prompt(window.summary, dropped)).content
+        except Exception as e:
+            print(f"Error summarising chat history: {e}")
+            new_summary = None
+        try:
+            # Ignored if the conversation was reset, or another replica summarised further, in the meantime
+            self.store.set_summary(self.session_id, new_summary or None, keep_from, window.generation)
+        finally:
+            with self._lock:
+                self._compacting = False
+
+    def reset(self):
+        self.store.reset(self.session_id)
@@ -0,0 +1,86 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional, Union
+
+from langchain_core.language_models import BaseChatModel
+
+from chat_history import ChatHistoryManager
+from session_store import InMemorySessionStore, RedisSessionStore
+
+class SessionBusy(Exception):
+    pass
+
+# One conversation of the chat server. Turns of a session run one at a time, in order, so the chat history each turn
+# sees is the one the previous turn left behind.
+class ChatSession:
+    def __init__(self, session_id: str, history: ChatHistoryManager):
+        self.id = session_id
+        self.history = history
+        self.lock = asyncio.Lock()
+        self.pending = 0
+        self.last_used = time.monotonic()
+
+# Sessions of the chat server, keyed by session id. The chat history of each session is kept in `store` (a
+# RedisSessionStore lets any replica continue any conversation), this only holds the per-session turn lock and
+# counters. Sessions idle for longer than `idle_ttl` seconds, and the least recently used ones beyond `max_sessions`,
+# are dropped from memory. Each session accepts at most `max_pending` turns (the one running plus those waiting for
+# it), further turns are rejected with SessionBusy so one client can't queue up unbounded work.
+class SessionManager:
+    def __init__(self, llm: Optional[BaseChatModel] = None, max_history_tokens: int = 3000, max_sessions: int = 10000,
+                 idle_ttl: int = 3600, max_pending: int = 2,
+                 store: Optional[Union[InMemorySessionStore, RedisSessionStore]] = None):
+        self.llm = llm
+        self.store = store or InMemorySessionStore(ttl=idle_ttl)
+        self.max_history_tokens = max_history_tokens
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.max_pending = max_pending
+        self.sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, session_id: Optional[str] = None) -> ChatSession:
+        self.evict()
+        session = self.sessions.get(session_id) if session_id else None
+        if session is None:
+            session_id = session_id or uuid.uuid4().hex
+            history = ChatHistoryManager(max_tokens=self.max_history_tokens, llm=self.llm, store=self.store,
+                                         session_id=session_id)
+            session = ChatSession(session_id, history)
+            self.sessions[session_id] = session
+        self.sessions.move_to_end(session_id)
+        session.last_used = time.monotonic()
+        return session
+
+    def delete(self, session_id: str):
+        self.sessions.pop(session_id, None)
+        self.store.reset(session_id)
+
+    def evict(self):
+        now = time.monotonic()
+        # Sessions with a turn in progress are never evicted
+        idle = [session_id for session_id, session in self.sessions.items()
+                if not session.pending and now - session.last_used > self.idle_ttl]
+        for session_id in idle:
+            del self.sessions[session_id]
+        for session_id in list(self.sessions):
+            if len(self.sessions) <= self.max_sessions:
+                break
+            if not self.sessions[session_id].pending:
+                del self.sessions[session_id]
+
+    @asynccontextmanager
+    async def turn(self, session: ChatSession) -> AsyncIterator[ChatSession]:
+        if session.pending >= self.max_pending:
+            raise SessionBusy(f"Session {session.id} already has {session.pending} turns in progress")
+        session.pending += 1
+        try:
+            async with session.lock:
+                yield session
+        finally:
+            session.pending -= 1
+            session.last_used = time.monotonic()
@@ -0,0 +1,105 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+from langchain_community.vectorstores import Redis as RedisVectorStore
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from ingestion import document_fingerprint
+from local_vectorstore import LocalVectorStore
+from preprocessing import ENCODING_NAME
+
+# Plot chunk index, built next to the movie index by the index scripts when PLOT_CHUNKS=1.
+# Each plot is split into overlapping chunks of about `chunk_tokens` tokens, and every chunk is embedded and stored
+# with the metadata of its movie plus `movie_id` and `chunk` (its position in the plot). A long plot then gets one
+# focused vector per part of the story instead of one diluted vector for the whole plot, and the answer prompt gets
+# the parts of the plot that matched instead of the whole plot. Plots shorter than a chunk are a single chunk with
+# the same text as the plot, so their embeddings come from the embedding cache.
+# The movie index stays as it is: metadata lookups, the neighbour graph and the incremental sync still use it.
+
+CHUNK_INDEX_NAME = "moviechunks"
+CHUNK_SCHEMA_FILE = "redis_chunk_schema.yaml"
+
+def create_plot_splitter(chunk_tokens: int = 256, overlap_tokens: int = 32) -> RecursiveCharacterTextSplitter:
+    # Splits on sentences before falling back to words, chunk sizes are counted with the embedding model's tokenizer
+    return RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        encoding_name=ENCODING_NAME, chunk_size=chunk_tokens, chunk_overlap=overlap_tokens,
+        separators=["\n\n", "\n", ". ", "? ", "! ", "; ", ", ", " ", ""], keep_separator="end")
+
+def chunk_key(movie_id: str, chunk: int) -> str:
+    # No ':' in the key, so the Redis key "doc:moviechunks:<movie id>-<chunk>" ends with it (see with_movie_id)
+    return f"{movie_id}-{chunk}"
+
+# {chunk key: (chunk text, metadata)} for every movie in `movies` ({id: (plot, metadata)}, as from load_movie_list)
+def chunk_movies(movies: Dict[str, Tuple[str, Dict[str, Any]]],
+                 splitter: RecursiveCharacterTextSplitter) -> Dict[str, Tuple[str, Dict[str, Any]]]:
+    chunks = {}
+    for movie_id, (plot, metadata) in movies.items():
+        if not isinstance(plot, str) or not plot.strip():
+            continue
+        # The chunk's own key is its id, `movie_id` points back at the movie
+        base = {key: value for key, value in metadata.items() if key != 'id'}
+        for n, text in enumerate(splitter.split_text(plot)):
+            chunks[chunk_key(movie_id, n)] = (text.strip(), {**base, 'movie_id': str(movie_id), 'chunk': n})
+    return chunks
+
+def chunk_fingerprints(chunks: Dict[str, Tuple[str, Dict[str, Any]]]) -> Dict[str, str]:
+    return {key: document_fingerprint(text, metadata) for key, (text, metadata) in chunks.items()}
+
+# Opens the chunk index that goes with `vectorstore`: the `moviechunks` Redis index, or the local index at `path`
+def load_chunk_index(vectorstore: VectorStore, redis_url: Optional[str] = None, path: str = "local_chunk_index",
+                     n_probe: int = 8, rescore: int = 0) -> VectorStore:
+    if isinstance(vectorstore, RedisVectorStore):
+        return RedisVectorStore.from_existing_index(
+            embedding=vectorstore.embeddings,
+            redis_url=redis_url,
+            index_name=CHUNK_INDEX_NAME,
+            schema=CHUNK_SCHEMA_FILE)
+    return LocalVectorStore.from_existing_index(embedding=vectorstore.embeddings, path=path, n_probe=n_probe,
+                                                rescore=rescore)
+
+def _join(a: str, b: str) -> str:
+    # Consecutive chunks overlap, the overlapping text is kept once
+    for size in range(min(len(a), len(b)), 0, -1):
+        if a.endswith(b[:size]):
+            return a + b[size:]
+    return a + " " + b
+
+def merge_chunks(chunks: List[Tuple[int, str]]) -> str:
+    parts, previous = [], None
+    for n, text in sorted(chunks):
+        if previous is not None and n == previous + 1:
+            parts[-1] = _join(parts[-1], text)
+        else:
+            parts.append(text)
+        previous = n
+    # Gaps between the matching parts of the plot are marked, as with truncated plots in the packed context
+    return " ... ".join(parts)
+
+# Collapses ranked chunk hits into one document per movie, in the order of each movie's best chunk. The document has
+# the movie's metadata, the best chunk score, and only the matching chunks of the plot (in plot order) as its content.
+# Whole-movie documents (e.g. from the local BM25 index) are passed through, unless chunks of the movie were found.
+def collapse_chunks(docs: List[Document], k: int) -> List[Document]:
+    movies: Dict[str, List[Document]] = {}
+    for doc in docs:
+        movies.setdefault(str(doc.metadata.get('movie_id', doc.metadata.get('id'))), []).append(doc)
+
+    collapsed = []
+    for movie_id, hits in list(movies.items())[:k]:
+        chunk_hits = [doc for doc in hits if 'chunk' in doc.metadata]
+        if not chunk_hits:
+            collapsed.append(hits[0])
+            continue
+        metadata = {key: value for key, value in hits[0].metadata.items() if key not in ('movie_id', 'chunk')}
+        scores = [doc.metadata['score'] for doc in hits if 'score' in doc.metadata]
+        if scores:
+            metadata['score'] = max(scores)
+        seen, chunks = set(), []
+        for doc in chunk_hits:
+            n = int(doc.metadata['chunk'])
+            if n not in seen:
+                seen.add(n)
+                chunks.append((n, doc.page_content))
+        metadata.update(id=movie_id, match='chunk', chunks=sorted(seen))
+        collapsed.append(Document(page_content=merge_chunks(chunks), metadata=metadata))
+    return collapsed
@@ -1,31 +1,60 @@
-from azure.ai.projects import AIProjectClient
-from azure.identity import DefaultAzureCredential
-from azure.ai.agents.models import ListSortOrder
+# Console chat with the movie agent in the Azure AI Agent Service (see agent-service.md).
+# Answers are streamed as the agent generates them, tool calls are shown as they run, and the conversation keeps one
+# agent thread until an empty question starts a new one (see agent_client.py).
+# AGENT_MOCK=1 talks to a local stand-in of the agent service instead (FakeAgentProject in fakes.py), no Azure needed.
 
-project = AIProjectClient(
-    credential=DefaultAzureCredential(),
-    endpoint="https://<your-aifoundry-resource>.services.ai.azure.com/api/projects/movie-chat-agent")
+import os
+from dotenv import load_dotenv
+from rich.console import Console
+from rich.prompt import Prompt
 
-agent = project.agents.get_agent("asst_xxxxxxxxxxxxxxxxxxxxxx")
+from agent_client import AgentChat, get_project_client
 
-thread = project.agents.threads.create()
-print(f"Created thread, ID: {thread.id}")
+load_dotenv()
 
-message = project.agents.messages.create(
-    thread_id=thread.id,
-    role="user",
-    content="Find 3 movies about aliens that are also a comedy"
-)
+AGENT_ENDPOINT = os.getenv('AGENT_ENDPOINT', "https://<your-aifoundry-resource>.services.ai.azure.com/api/projects/movie-chat-agent")
+AGENT_ID = os.getenv('AGENT_ID', "asst_xxxxxxxxxxxxxxxxxxxxxx")
+AGENT_MOCK = os.getenv('AGENT_MOCK', '0') == '1'
+DEBUG = os.getenv('DEBUG')
 
-run = project.agents.runs.create_and_process(
-    thread_id=thread.id,
-    agent_id=agent.id)
+console = Console()
 
-if run.status == "failed":
-    print(f"Run failed: {run.last_error}")
+if AGENT_MOCK:
+    from fakes import FakeAgentProject
+    project = FakeAgentProject()
 else:
-    messages = project.agents.messages.list(thread_id=thread.id, order=ListSortOrder.ASCENDING)
+    project = get_project_client(AGENT_ENDPOINT)
 
-    for message in messages:
-        if message.text_messages:
-            print(f"{message.role}: {message.text_messages[-1].text.value}")
\ No newline at end of file
+chat = AgentChat(project, AGENT_ID)
+
+while True:
+    question = Prompt.ask("\n[yellow]What's your question about movie(s)?[/yellow]")
+    if question == 'q':
+        print('Bye!')
+        break
+    if question == '':
+        chat.reset()
+        console.print('Starting a new conversation...', style="yellow")
+        continue
+
+    console.print('\nAnswer:', style="yellow")
+    streamed = False
+    try:
+        for event in chat.ask(question):
+            if event.type == 'token':
+                console.print(event.data, style="white", end="", markup=False, highlight=False)
+                streamed = True
+            elif event.type == 'tool_call':
+                console.print(f"({event.data['name']} {event.data['status']})", style="dim")
+            elif event.type == 'message' and not streamed:
+                console.print(event.data, style="white", markup=False, highlight=False)
+            elif event.type == 'error':
+                console.print(f"Run failed: {event.data}", style="red")
+        console.print()
+    except Exception as e:
+        print(f"Error during agent run: {e}")
+        continue
+
+    if DEBUG:
+        print(f"(Thread {chat.thread_id}, time to first token {chat.timings.get('time_to_first_token', 0):.2f}s, "
+              f"total {chat.timings['total']:.2f}s)")
@@ -0,0 +1,68 @@
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# Vector compression shared by the indexing scripts, the local vector store and benchmark-vectors.py:
+#   - truncated dimensions: text-embedding-3 models are trained so that the first N components of an embedding,
+#     renormalised, are a usable lower dimensional embedding (what the API's `dimensions` parameter returns)
+#   - float16: half precision storage
+#   - int8: scalar quantization, each vector is stored as int8 codes plus one float32 scale
+
+VECTOR_DTYPES = ('float32', 'float16', 'int8')
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+def truncate(vectors: np.ndarray, dims: Optional[int]) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dims and dims < vectors.shape[-1]:
+        vectors = vectors[..., :dims]
+    return normalize(vectors)
+
+def quantize_int8(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    scales = np.abs(vectors).max(axis=-1) / 127
+    scales = np.where(scales == 0, 1, scales).astype(np.float32)
+    codes = np.clip(np.rint(vectors / scales[..., None]), -127, 127).astype(np.int8)
+    return codes, scales
+
+def compress(vectors: np.ndarray, dtype: str = 'float32', dims: Optional[int] = None) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    # Returns the stored vectors, and the per-vector scales for int8
+    vectors = truncate(vectors, dims)
+    if dtype == 'int8':
+        return quantize_int8(vectors)
+    return vectors.astype(dtype), None
+
+def bytes_per_vector(dims: int, dtype: str) -> int:
+    return dims * np.dtype(dtype).itemsize + (4 if dtype == 'int8' else 0)
+
+# Embeddings truncated to the first `dims` components and renormalised, used to index and query a Redis index built
+# with VECTOR_DIMS. The embedding cache keeps the full vectors, so changing `dims` never needs new embedding calls.
+class TruncatedEmbeddings(Embeddings):
+    def __init__(self, embedding: Embeddings, dims: int):
+        self.embedding = embedding
+        self.dims = dims
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return truncate(np.asarray(self.embedding.embed_documents(texts)), self.dims).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return truncate(np.asarray(self.embedding.embed_query(text)), self.dims).tolist()
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return truncate(np.asarray(await self.embedding.aembed_query(text)), self.dims).tolist()
+
+def recall_at_k(exact: List[List[int]], approximate: List[List[int]], k: int = 10) -> float:
+    hits = sum(len(set(e[:k]) & set(a[:k])) for e, a in zip(exact, approximate))
+    return hits / max(sum(min(k, len(e)) for e in exact), 1)
+
+def latency_percentiles(seconds: List[float]) -> Dict[str, float]:
+    ms = np.asarray(seconds) * 1000
+    return {'p50': float(np.percentile(ms, 50)), 'p95': float(np.percentile(ms, 95))}
+
+def timed(function, *args, **kwargs):
+    start_time = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start_time
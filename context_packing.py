@@ -0,0 +1,160 @@
+import re
+from typing import Dict, List, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.runnables import Runnable, RunnableLambda
+
+from instrumentation import span
+
+STOP_WORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'been', 'by', 'did', 'do', 'does', 'for', 'from', 'has', 'have', 'in',
+    'is', 'it', 'me', 'movie', 'movies', 'film', 'films', 'of', 'on', 'or', 'show', 'star', 'starred', 'tell', 'that',
+    'the', 'their', 'this', 'to', 'was', 'were', 'what', 'when', 'which', 'who', 'with', 'about', 'find', 'some', 'any',
+}
+
+# Metadata fields kept in the packed context, in this order, and how they are labelled
+METADATA_FIELDS = [('Title', 'Title'), ('year', 'Year'), ('Director', 'Director'), ('Cast', 'Cast'), ('Genre', 'Genre')]
+
+def approximate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+def query_terms(text: str) -> List[str]:
+    return [word for word in re.findall(r"[a-z0-9']+", text.lower()) if word not in STOP_WORDS]
+
+def term_overlap(terms: List[str], text: str) -> float:
+    if not terms:
+        return 0.0
+    words = set(re.findall(r"[a-z0-9']+", text.lower()))
+    return sum(1 for term in terms if term in words) / len(terms)
+
+def split_sentences(text: str) -> List[str]:
+    return [sentence for sentence in re.split(r'(?<=[.!?])\s+', text) if sentence]
+
+def most_relevant_sentences(plot: str, terms: List[str], max_tokens: int) -> str:
+    if approximate_tokens(plot) <= max_tokens:
+        return plot
+    sentences = split_sentences(plot)
+    # The opening sentences usually introduce the premise and main characters, so they get a small boost
+    ranked = sorted(range(len(sentences)), key=lambda i: (term_overlap(terms, sentences[i]) + (0.5 if i < 2 else 0)), reverse=True)
+    keep, used = set(), 0
+    for i in ranked:
+        tokens = approximate_tokens(sentences[i])
+        if used + tokens > max_tokens:
+            continue
+        keep.add(i)
+        used += tokens
+    if not keep:
+        return plot[:max_tokens * 4]
+    # Keep the selected sentences in plot order, marking the gaps
+    parts, previous = [], -1
+    for i in sorted(keep):
+        if previous >= 0 and i != previous + 1:
+            parts.append("...")
+        parts.append(sentences[i])
+        previous = i
+    return " ".join(parts)
+
+def format_movie(doc: Document, plot: str) -> str:
+    lines = [f"{label}: {doc.metadata[key]}" for key, label in METADATA_FIELDS if doc.metadata.get(key) not in (None, '', 'nan')]
+    lines.append(f"Plot: {plot}")
+    return "\n".join(lines)
+
+# Context assembly stage between the retriever and the answer chain:
+#   1. dedupe movies returned more than once (same id, or same title and year)
+#   2. score cutoff with adaptive k: drop movies below `min_score` or more than `max_score_gap` below the best match,
+#      always keeping at least `min_k`
+#   3. local rerank by vector score plus query term overlap with the title/cast/director/genre and plot
+#   4. pack movies into `token_budget`, truncating long plots to their most query-relevant sentences
+#      (and to `lookup_plot_tokens` for exact metadata lookups, which are about the list rather than the plots)
+# Packed documents keep their metadata (including the score) and carry a compact header with Title, Year, Director,
+# Cast and Genre in page_content, which is what the answer prompt sees.
+class ContextPacker:
+    def __init__(self, token_budget: int = 3000, max_plot_tokens: int = 400, min_score: float = 0.25,
+                 max_score_gap: float = 0.2, min_k: int = 3, metadata_weight: float = 0.2, plot_weight: float = 0.1,
+                 lookup_plot_tokens: int = 60, debug: bool = False):
+        self.token_budget = token_budget
+        self.max_plot_tokens = max_plot_tokens
+        self.min_score = min_score
+        self.max_score_gap = max_score_gap
+        self.min_k = min_k
+        self.metadata_weight = metadata_weight
+        self.plot_weight = plot_weight
+        self.lookup_plot_tokens = lookup_plot_tokens
+        self.debug = debug
+
+    def dedupe(self, docs: List[Document]) -> List[Document]:
+        seen, unique = set(), []
+        for doc in docs:
+            keys = {('id', str(doc.metadata.get('id'))), ('title', str(doc.metadata.get('Title', '')).lower(), str(doc.metadata.get('year')))}
+            if doc.metadata.get('id') is None:
+                keys.discard(('id', 'None'))
+            if keys & seen:
+                continue
+            seen |= keys
+            unique.append(doc)
+        return unique
+
+    def cutoff(self, docs: List[Document]) -> List[Document]:
+        scored = [doc for doc in docs if 'score' in doc.metadata]
+        if not scored:
+            return docs
+        best = max(doc.metadata['score'] for doc in scored)
+        kept = [doc for doc in docs
+                if doc.metadata.get('score', best) >= max(self.min_score, best - self.max_score_gap)]
+        return kept if len(kept) >= self.min_k else docs[:self.min_k]
+
+    def rerank(self, docs: List[Document], question: str) -> List[Document]:
+        terms = query_terms(question)
+
+        def score(doc: Document) -> float:
+            metadata_text = " ".join(str(doc.metadata.get(key, '')) for key in ('Title', 'Cast', 'Director', 'Genre'))
+            return (doc.metadata.get('score', 0.0)
+                    + self.metadata_weight * term_overlap(terms, metadata_text)
+                    + self.plot_weight * term_overlap(terms, doc.page_content))
+
+        return sorted(docs, key=score, reverse=True)
+
+    def pack(self, docs: List[Document], question: str) -> Tuple[List[Document], Dict[str, int]]:
+        terms = query_terms(question)
+        packed, used = [], 0
+        for doc in docs:
+            remaining = self.token_budget - used
+            header_tokens = approximate_tokens(format_movie(doc, ""))
+            if remaining <= header_tokens:
+                break
+            # Exact metadata lookups can return long lists, so their plots are kept short to fit more of the list
+            max_plot_tokens = self.lookup_plot_tokens if doc.metadata.get('match') == 'lookup' else self.max_plot_tokens
+            plot = most_relevant_sentences(doc.page_content, terms, min(max_plot_tokens, remaining - header_tokens))
+            content = format_movie(doc, plot)
+            used += approximate_tokens(content)
+            packed.append(Document(page_content=content, metadata=doc.metadata))
+        # A lookup with more matches than were packed (at the lookup's limit or the token budget) says so, so the
+        # answer doesn't present a partial list as complete
+        matches = max([doc.metadata.get('matches', 0) for doc in packed if doc.metadata.get('match') == 'lookup'] + [0])
+        listed = sum(1 for doc in packed if doc.metadata.get('match') == 'lookup')
+        if matches > listed:
+            note = f"Note: {matches} movies match the question, only {listed} of them are listed here."
+            packed[-1] = Document(page_content=packed[-1].page_content + "\n\n" + note, metadata=packed[-1].metadata)
+            used += approximate_tokens(note)
+        return packed, {'packed': len(packed), 'packed_tokens': used}
+
+    def assemble(self, docs: List[Document], question: str) -> Tuple[List[Document], Dict[str, int]]:
+        retrieved_tokens = sum(approximate_tokens(doc.page_content) for doc in docs)
+        ranked = self.rerank(self.cutoff(self.dedupe(docs)), question)
+        packed, stats = self.pack(ranked, question)
+        return packed, {'retrieved': len(docs), 'kept': len(ranked), 'retrieved_tokens': retrieved_tokens, **stats}
+
+    def as_runnable(self) -> Runnable:
+        def assemble_context(x: Dict) -> List[Document]:
+            question = x.get("standalone_question", x["input"])
+            with span('context_assembly') as fields:
+                packed, stats = self.assemble(x["context"], question)
+                fields.update(stats)
+            if self.debug:
+                history_tokens = sum(approximate_tokens(str(message.content)) for message in x.get("chat_history") or [])
+                print(f"Context: {stats['retrieved']} -> {stats['packed']} movies, "
+                      f"~{stats['retrieved_tokens']} -> ~{stats['packed_tokens']} tokens "
+                      f"(question ~{approximate_tokens(x['input'])}, chat history ~{history_tokens} tokens)")
+            return packed
+
+        return RunnableLambda(assemble_context).with_config(run_name="assemble_context")
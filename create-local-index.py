@@ -0,0 +1,149 @@
+# Builds (or refreshes) the in-process vector index used when VECTOR_STORE=local, from movie_list.csv.
+# Embeddings come from the embedding cache, so after create-redis-index.py has run this doesn't call the embedding
+# deployment again. New or changed movies are embedded and written in place, movies no longer in the list are removed.
+#
+# Run create-redis-index.py (or `python preprocessing.py` to only create movie_list.csv) first.
+
+import os
+import time
+from dotenv import load_dotenv
+from langchain_openai import AzureOpenAIEmbeddings
+
+from chunking import chunk_movies, create_plot_splitter
+from ingestion import CachedEmbeddings, EmbeddingCache, document_fingerprint
+from local_vectorstore import LocalVectorStore
+from movie_neighbours import build_neighbour_file
+from preprocessing import load_movie_list
+from rate_limit import RateLimiter
+
+load_dotenv()
+
+API_KEY = os.getenv('API_KEY')
+RESOURCE_ENDPOINT = os.getenv('RESOURCE_ENDPOINT')
+DEPLOYMENT_NAME = os.getenv('DEPLOYMENT_NAME')
+
+EMBEDDING_CACHE_PATH = os.getenv('EMBEDDING_CACHE_PATH', 'embedding_cache.db')
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', '256'))
+EMBEDDING_CONCURRENCY = int(os.getenv('EMBEDDING_CONCURRENCY', '4'))
+EMBEDDING_RPM = int(os.getenv('EMBEDDING_RPM', '300'))
+EMBEDDING_TPM = int(os.getenv('EMBEDDING_TPM', '350000'))
+
+FILE_NAME = os.getenv('MOVIE_LIST', 'movie_list.csv')
+
+# float16 halves the size of the index for a negligible loss of accuracy, int8 quarters it (see benchmark-vectors.py)
+LOCAL_INDEX_PATH = os.getenv('LOCAL_INDEX_PATH', 'local_index')
+LOCAL_INDEX_DTYPE = os.getenv('LOCAL_INDEX_DTYPE', 'float32')
+# Keep only the first LOCAL_INDEX_DIMS dimensions of each embedding, 0 keeps the full width
+LOCAL_INDEX_DIMS = int(os.getenv('LOCAL_INDEX_DIMS', '0')) or None
+# Also store the full float32 vectors (memory mapped) so searches can rescore compressed results with LOCAL_INDEX_RESCORE
+LOCAL_INDEX_KEEP_FULL = os.getenv('LOCAL_INDEX_KEEP_FULL', '0') == '1'
+# Number of IVF partitions to build, 0 keeps exact search. Around sqrt(number of movies) is a good start.
+LOCAL_INDEX_LISTS = int(os.getenv('LOCAL_INDEX_LISTS', '0'))
+
+# "Movies like X" neighbour graph, rebuilt when the index changes (0 skips it)
+NEIGHBOURS_FILE = os.getenv('NEIGHBOURS_FILE', 'movie_neighbours.npz')
+NEIGHBOURS_N = int(os.getenv('NEIGHBOURS_N', '20'))
+
+# Also build a local index of the plots split into overlapping chunks (see chunking.py), stored like the movie index
+PLOT_CHUNKS = os.getenv('PLOT_CHUNKS', '0') == '1'
+PLOT_CHUNK_TOKENS = int(os.getenv('PLOT_CHUNK_TOKENS', '256'))
+PLOT_CHUNK_OVERLAP = int(os.getenv('PLOT_CHUNK_OVERLAP', '32'))
+LOCAL_CHUNK_INDEX_PATH = os.getenv('LOCAL_CHUNK_INDEX_PATH', 'local_chunk_index')
+
+if not os.path.exists(FILE_NAME):
+    raise FileNotFoundError(f"The movie list '{FILE_NAME}' was not found. Run create-redis-index.py first to create it.")
+
+start_time = time.time()
+print(f"Loading movie list {FILE_NAME}...")
+movies = load_movie_list(FILE_NAME)
+
+embedding = AzureOpenAIEmbeddings(
+    azure_endpoint=RESOURCE_ENDPOINT,
+    azure_deployment=DEPLOYMENT_NAME,
+    openai_api_key=API_KEY,
+    openai_api_version='2024-03-01-preview',
+    chunk_size=EMBEDDING_BATCH_SIZE)
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH)
+cached_embedding = CachedEmbeddings(
+    embedding=embedding,
+    cache=embedding_cache,
+    model=DEPLOYMENT_NAME,
+    batch_size=EMBEDDING_BATCH_SIZE,
+    max_workers=EMBEDDING_CONCURRENCY,
+    rate_limiter=RateLimiter(requests_per_minute=EMBEDDING_RPM, tokens_per_minute=EMBEDDING_TPM))
+
+vectorstore = LocalVectorStore(cached_embedding, path=LOCAL_INDEX_PATH, dtype=LOCAL_INDEX_DTYPE, dims=LOCAL_INDEX_DIMS,
+                               keep_full=LOCAL_INDEX_KEEP_FULL)
+# Changing the compression settings rebuilds the index, the embeddings all come from the cache
+if vectorstore.ids:
+    dims = LOCAL_INDEX_DIMS or len(cached_embedding.embed_documents([vectorstore.contents[0]])[0])
+    if vectorstore.compression() != (LOCAL_INDEX_DTYPE, dims, LOCAL_INDEX_KEEP_FULL):
+        print(f"Compression changed from {vectorstore.compression()} to {(LOCAL_INDEX_DTYPE, dims, LOCAL_INDEX_KEEP_FULL)}, rebuilding the index...")
+        vectorstore.clear(dtype=LOCAL_INDEX_DTYPE, dims=LOCAL_INDEX_DIMS, keep_full=LOCAL_INDEX_KEEP_FULL)
+
+# Movies are compared using the same content fingerprint sync-redis-index.py uses
+upserts = [id for id, (plot, metadata) in movies.items()
+           if id not in vectorstore.rows
+           or document_fingerprint(plot, metadata) != document_fingerprint(vectorstore.contents[vectorstore.rows[id]], vectorstore.metadatas[vectorstore.rows[id]])]
+removed = [id for id in vectorstore.ids if id not in movies]
+print(f"Movies in list: {len(movies)}, indexed: {len(vectorstore.ids)}, new or changed: {len(upserts)}, removed: {len(removed)}")
+
+if upserts:
+    texts = [movies[id][0] for id in upserts]
+    vectorstore.add_texts(texts, [movies[id][1] for id in upserts], embeddings=cached_embedding.embed_documents(texts), keys=upserts)
+if removed:
+    vectorstore.delete(ids=removed)
+if upserts or removed:
+    vectorstore.save()
+
+# The chunk index is diffed on the chunks' own fingerprints, so only the chunks of changed plots are re-embedded
+chunk_store, chunk_upserts, chunk_removed = None, [], []
+if PLOT_CHUNKS:
+    chunks = chunk_movies(movies, create_plot_splitter(PLOT_CHUNK_TOKENS, PLOT_CHUNK_OVERLAP))
+    chunk_store = LocalVectorStore(cached_embedding, path=LOCAL_CHUNK_INDEX_PATH, dtype=LOCAL_INDEX_DTYPE,
+                                   dims=LOCAL_INDEX_DIMS, keep_full=LOCAL_INDEX_KEEP_FULL)
+    if chunk_store.ids and chunk_store.compression() != vectorstore.compression():
+        chunk_store.clear(dtype=LOCAL_INDEX_DTYPE, dims=LOCAL_INDEX_DIMS, keep_full=LOCAL_INDEX_KEEP_FULL)
+    chunk_upserts = [key for key, (text, metadata) in chunks.items()
+                     if key not in chunk_store.rows
+                     or document_fingerprint(text, metadata) != document_fingerprint(chunk_store.contents[chunk_store.rows[key]], chunk_store.metadatas[chunk_store.rows[key]])]
+    chunk_removed = [key for key in chunk_store.ids if key not in chunks]
+    print(f"Plot chunks: {len(chunks)}, indexed: {len(chunk_store.ids)}, new or changed: {len(chunk_upserts)}, removed: {len(chunk_removed)}")
+    if chunk_upserts:
+        texts = [chunks[key][0] for key in chunk_upserts]
+        chunk_store.add_texts(texts, [chunks[key][1] for key in chunk_upserts], embeddings=cached_embedding.embed_documents(texts), keys=chunk_upserts)
+    if chunk_removed:
+        chunk_store.delete(ids=chunk_removed)
+    if chunk_upserts or chunk_removed:
+        chunk_store.save()
+
+if NEIGHBOURS_N and (upserts or removed or not os.path.exists(NEIGHBOURS_FILE)):
+    print(f"Building the movie neighbour graph ({NEIGHBOURS_N} neighbours per movie)...")
+    graph_start = time.time()
+    build_neighbour_file(movies, cached_embedding, path=NEIGHBOURS_FILE, n=NEIGHBOURS_N)
+    print(f"Saved {NEIGHBOURS_FILE} in {time.time() - graph_start:.1f} seconds")
+embedding_cache.close()
+
+if LOCAL_INDEX_LISTS and (upserts or removed or vectorstore.ivf is None):
+    print(f"Building {LOCAL_INDEX_LISTS} IVF partitions...")
+    vectorstore.build_ivf(n_lists=LOCAL_INDEX_LISTS)
+if chunk_store is not None and LOCAL_INDEX_LISTS and (chunk_upserts or chunk_removed or chunk_store.ivf is None):
+    # There are more chunks than movies, the partitions grow in proportion
+    chunk_lists = int(LOCAL_INDEX_LISTS * (len(chunk_store.ids) / max(len(vectorstore.ids), 1)) ** 0.5)
+    print(f"Building {chunk_lists} IVF partitions for the plot chunks...")
+    chunk_store.build_ivf(n_lists=chunk_lists)
+
+size_mb = os.path.getsize(os.path.join(LOCAL_INDEX_PATH, 'vectors.npy')) / 1024 / 1024
+print(f"Local index {LOCAL_INDEX_PATH}: {len(vectorstore.ids)} movies, {vectorstore.vectors.shape[1]} dimension {vectorstore.vectors.dtype} vectors ({size_mb:.0f} MB), "
+      f"built in {time.time() - start_time:.1f} seconds")
+if chunk_store is not None:
+    print(f"Local chunk index {LOCAL_CHUNK_INDEX_PATH}: {len(chunk_store.ids)} plot chunks of {len({m['movie_id'] for m in chunk_store.metadatas})} movies")
+
+### Run a search query
+query = "Spaceships, aliens, and heroes saving America"
+start_time = time.time()
+results = vectorstore.similarity_search_with_relevance_scores(query, k=10)
+print(f"Similarity search ({(time.time() - start_time) * 1000:.1f} ms including the query embedding):")
+for doc, score in results:
+    print(f"{doc.metadata['Title']} (Score: {score:.4f})")
@@ -1,10 +1,8 @@
 # The dataset contains descriptions of 34,886 movies from around the world from 1901 to 2017.
 # Source: https://www.kaggle.com/datasets/jrobischon/wikipedia-movie-plots
 
-import re
 import os
-import pandas as pd
-import tiktoken
+import time
 from typing import List
 from dotenv import load_dotenv
 from num2words import num2words
@@ -12,6 +10,15 @@ from langchain_openai import AzureOpenAIEmbeddings
 from langchain_community.vectorstores import Redis as RedisVectorStore
 from langchain_community.document_loaders import DataFrameLoader
 
+from answer_cache import SemanticAnswerCache
+from chunking import CHUNK_INDEX_NAME, CHUNK_SCHEMA_FILE, chunk_fingerprints, chunk_movies, create_plot_splitter
+from compression import TruncatedEmbeddings
+from ingestion import CachedEmbeddings, EmbeddingCache, document_fingerprint, save_fingerprints
+from metadata_query import movie_index_schema
+from movie_neighbours import build_neighbour_file
+from preprocessing import PreprocessStats, load_movie_list, preprocess_movies
+from rate_limit import RateLimiter
+
 load_dotenv()
 
 API_KEY = os.getenv('API_KEY')
@@ -20,6 +27,31 @@ DEPLOYMENT_NAME = os.getenv('DEPLOYMENT_NAME')
 REDIS_ENDPOINT = os.getenv('REDIS_ENDPOINT')
 REDIS_PASSWORD = os.getenv('REDIS_PASSWORD')
 
+# Embedding ingestion tuning, adjust to match the quota of your embedding deployment
+EMBEDDING_CACHE_PATH = os.getenv('EMBEDDING_CACHE_PATH', 'embedding_cache.db')
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', '256'))
+EMBEDDING_CONCURRENCY = int(os.getenv('EMBEDDING_CONCURRENCY', '4'))
+EMBEDDING_RPM = int(os.getenv('EMBEDDING_RPM', '300'))
+EMBEDDING_TPM = int(os.getenv('EMBEDDING_TPM', '350000'))
+
+# Number of dataset rows preprocessed, embedded and loaded at a time
+CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', '10000'))
+
+# Store only the first VECTOR_DIMS dimensions of each embedding (renormalised), 0 keeps the full width.
+# Redis memory for the vectors and KNN latency shrink in proportion, use benchmark-vectors.py to pick a value.
+# The chat apps and sync-redis-index.py must use the same VECTOR_DIMS.
+VECTOR_DIMS = int(os.getenv('VECTOR_DIMS', '0'))
+
+# Nearest neighbours stored per movie for "movies like X" questions (see movie_neighbours.py), 0 skips the graph
+NEIGHBOURS_FILE = os.getenv('NEIGHBOURS_FILE', 'movie_neighbours.npz')
+NEIGHBOURS_N = int(os.getenv('NEIGHBOURS_N', '20'))
+
+# Also index the plots split into overlapping chunks of about PLOT_CHUNK_TOKENS tokens (see chunking.py).
+# The chat apps search the chunks instead of whole plots when they are run with PLOT_CHUNKS=1 too.
+PLOT_CHUNKS = os.getenv('PLOT_CHUNKS', '0') == '1'
+PLOT_CHUNK_TOKENS = int(os.getenv('PLOT_CHUNK_TOKENS', '256'))
+PLOT_CHUNK_OVERLAP = int(os.getenv('PLOT_CHUNK_OVERLAP', '32'))
+
 print(f"RESOURCE_ENDPOINT: {RESOURCE_ENDPOINT}")
 print(f"REDIS_ENDPOINT: {REDIS_ENDPOINT}")
 print(f"DEPLOYMENT_NAME: {DEPLOYMENT_NAME}")
@@ -31,62 +63,14 @@ print(f"DEPLOYMENT_NAME: {DEPLOYMENT_NAME}")
 FILE_NAME = 'wiki_movie_plots_deduped.csv'
 if not os.path.exists(FILE_NAME):
     raise FileNotFoundError(f"The dataset file '{FILE_NAME}' was not found in the current directory. Please download it from https://www.kaggle.com/datasets/jrobischon/wikipedia-movie-plots and place it in the current directory.")
-print(f"Loading dataset {FILE_NAME}...")
-df=pd.read_csv(os.path.join(os.getcwd(),FILE_NAME))
 
 # Process the dataset to remove spaces in the column titles and filter the dataset to lower the size.
 # This isn't required, but is helpful in reducing the time it takes to generate embeddings and loading the index into Redis.
-# Feel free to play around with the filters, or add your own! 
-df.insert(0, 'id', range(0, len(df)))
-df['year'] = df['Release Year'].astype(int)
-df['origin'] = df['Origin/Ethnicity'].astype(str)
-del df['Release Year']
-del df['Origin/Ethnicity']
-df = df[df.year > 1970] # only movies made after 1970
-df = df[df.origin.isin(['American','British','Canadian'])] # only movies from English-speaking cinema
-
-# Remove whitespace from the `Plot` column to make it easier to generate embeddings.
-pd.options.mode.chained_assignment = None
-
-# s is input text
-def normalize_text(s, sep_token = " \n "):
-    s = re.sub(r'\s+',  ' ', s).strip()
-    s = re.sub(r". ,","",s)
-    # remove all instances of multiple spaces
-    s = s.replace("..",".")
-    s = s.replace(". .",".")
-    s = s.replace("\n", "")
-    s = s.strip()
-    
-    return s
-
-df['Plot']= df['Plot'].apply(lambda x : normalize_text(x))
-
-# Calculate the number of tokens required to generate the embeddings for this dataset. You may want to filter the dataset more stringently in order to limit the tokens required. 
-tokenizer = tiktoken.get_encoding("cl100k_base")
-df['n_tokens'] = df["Plot"].apply(lambda x: len(tokenizer.encode(x)))
-df = df[df.n_tokens<8192]
-print('Number of movies: ' + str(len(df))) # print number of movies remaining in dataset
-print('Number of tokens required: ' + str(df['n_tokens'].sum())) # print number of tokens
-
-## Load Dataframe into LangChain
-## -----------------------------
-# Using the `DataFrameLoader` class allows you to load a pandas dataframe into LangChain. That makes it easy to load your data and use it to generate embeddings using LangChain's other integrations.
-print("Loading dataframe into LangChain...")
-loader = DataFrameLoader(df, page_content_column="Plot" )
-movie_list = loader.load()
-
-## Generate CSV file with filered movies and snake_case titles
-## -----------------------------------------------------------
-print("Creating CSV file with filered movies and snake_case titles...")
-import csv
-# Write the movie list to a CSV file as a flat list of the dictionary values without the keys and these columns: id,title,director,cast,genre,wiki_page,plot,year,origin
-# update the column names to be lowercase and remove the spaces
-# On the plot, I don't want surrounding quotes
-df.columns = df.columns.str.lower().str.replace(' ', '_')
-# Don't quote the first column which is the column titles
-df.to_csv('movie_list.csv', index=False, header=True, sep=',', quoting=csv.QUOTE_NONNUMERIC, escapechar='\\', quotechar='"')
-print("CSV file created: movie_list.csv")
+# Feel free to play around with the filters in preprocessing.py, or add your own!
+# Only movies made after 1970 from English-speaking cinema are kept, plots are normalized and the number of tokens
+# required to generate each embedding is calculated. Movies with plots over the embedding model limit are dropped.
+# The dataset is streamed in chunks of CHUNK_SIZE rows: each chunk is appended to movie_list.csv (snake_case column titles)
+# and then embedded and loaded into Redis before the next chunk is read, so memory use doesn't grow with the dataset.
 
 ## Generate embeddings and Load them into Azure Managed Redis
 ## ----------------------------------------------------------
@@ -97,8 +81,22 @@ embedding = AzureOpenAIEmbeddings(
     azure_deployment=DEPLOYMENT_NAME,
     openai_api_key=API_KEY,
     openai_api_version='2024-03-01-preview',
-    show_progress_bar=True,
-    chunk_size=16)
+    chunk_size=EMBEDDING_BATCH_SIZE)
+
+# Embeddings are cached on disk keyed by a hash of the normalized plot and the model name.
+# Each batch is committed as soon as it completes, so if the load is interrupted, rerunning this script
+# resumes where it stopped, and a rebuild after a schema tweak re-embeds nothing that hasn't changed.
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH)
+cached_embedding = CachedEmbeddings(
+    embedding=embedding,
+    cache=embedding_cache,
+    model=DEPLOYMENT_NAME,
+    batch_size=EMBEDDING_BATCH_SIZE,
+    max_workers=EMBEDDING_CONCURRENCY,
+    rate_limiter=RateLimiter(requests_per_minute=EMBEDDING_RPM, tokens_per_minute=EMBEDDING_TPM))
+
+# The cache keeps full width vectors, so changing VECTOR_DIMS doesn't need new embedding calls
+index_embedding = TruncatedEmbeddings(cached_embedding, VECTOR_DIMS) if VECTOR_DIMS else cached_embedding
 
 # Name of the Redis search index to create
 index_name = "movieindex"
@@ -107,18 +105,80 @@ index_name = "movieindex"
 # This example assumes TLS is enabled. If not, use "redis://" instead of "rediss://
 redis_url = "rediss://:" + REDIS_PASSWORD + "@"+ REDIS_ENDPOINT
 
-# Create and load redis with documents
-print("Creating document index, this may take up to 30 mins to complete...")
-vectorstore = RedisVectorStore.from_documents(
-    documents=movie_list,
-    embedding=embedding,
-    index_name=index_name,
-    redis_url=redis_url
-)
+# Create and load redis with documents.
+# Each chunk's embeddings are generated (or read from the cache) first, then written to Redis in pipelined batches.
+# Documents are keyed by movie id, so reloading overwrites existing entries instead of duplicating them.
+print(f"Loading dataset {FILE_NAME} and creating document index, this may take up to 30 mins to complete on the first run...")
+stats = PreprocessStats()
+vectorstore = None
+chunk_store = None
+splitter = create_plot_splitter(PLOT_CHUNK_TOKENS, PLOT_CHUNK_OVERLAP) if PLOT_CHUNKS else None
+for df in preprocess_movies(FILE_NAME, output_csv='movie_list.csv', chunk_size=CHUNK_SIZE, stats=stats):
+    # Using the `DataFrameLoader` class allows you to load a pandas dataframe into LangChain. That makes it easy to load your data and use it to generate embeddings using LangChain's other integrations.
+    movie_list = DataFrameLoader(df, page_content_column="Plot").load()
+    keys = [str(doc.metadata['id']) for doc in movie_list]
+    if vectorstore is None:
+        # year is SORTABLE, metadata lookups are ordered by it (see metadata_query.py)
+        vectorstore = RedisVectorStore.from_documents(
+            documents=movie_list,
+            embedding=index_embedding,
+            index_name=index_name,
+            redis_url=redis_url,
+            index_schema=movie_index_schema(movie_list[0].metadata),
+            keys=keys
+        )
+    else:
+        vectorstore.add_documents(movie_list, keys=keys)
+
+    # Record a content fingerprint per movie id, used by sync-redis-index.py to apply incremental updates
+    save_fingerprints(vectorstore.client, index_name, {
+        str(doc.metadata['id']): document_fingerprint(doc.page_content, doc.metadata) for doc in movie_list
+    })
+
+    # The plot chunks of the same movies go into the `moviechunks` index, keyed by "<movie id>-<chunk>"
+    if PLOT_CHUNKS:
+        chunks = chunk_movies({str(doc.metadata['id']): (doc.page_content, doc.metadata) for doc in movie_list}, splitter)
+        texts, metadatas = [text for text, _ in chunks.values()], [metadata for _, metadata in chunks.values()]
+        if chunk_store is None:
+            chunk_store = RedisVectorStore.from_texts(
+                texts=texts,
+                embedding=index_embedding,
+                metadatas=metadatas,
+                index_name=CHUNK_INDEX_NAME,
+                redis_url=redis_url,
+                keys=list(chunks)
+            )
+        else:
+            chunk_store.add_texts(texts, metadatas, keys=list(chunks))
+        save_fingerprints(chunk_store.client, CHUNK_INDEX_NAME, chunk_fingerprints(chunks))
+        print(f"Loaded {len(chunks)} plot chunks")
+    print(f"Loaded {stats.rows_kept} movies ({stats.rows_read} rows read)")
+
+stats.report()
+if stats.rows_kept == 0:
+    # nothing was loaded, so there is no index to save a schema of
+    embedding_cache.close()
+    raise SystemExit(f"No movies left in {FILE_NAME} after filtering ({stats.rows_read} rows read), "
+                     "check the file and the filters in preprocessing.py")
+print("CSV file created: movie_list.csv")
+
+# Offline "movies like X" graph, computed from the full width embeddings that are all in the cache by now
+if NEIGHBOURS_N:
+    print(f"Building the movie neighbour graph ({NEIGHBOURS_N} neighbours per movie)...")
+    graph_start = time.time()
+    build_neighbour_file(load_movie_list('movie_list.csv'), cached_embedding, path=NEIGHBOURS_FILE, n=NEIGHBOURS_N)
+    print(f"Saved {NEIGHBOURS_FILE} in {time.time() - graph_start:.1f} seconds")
+embedding_cache.close()
+
+# Cached chat answers were generated from the previous version of the index
+SemanticAnswerCache(vectorstore.client).invalidate()
 
 # Save index schema so you can reload in the future without re-generating embeddings
 print("Saving schema to redis_schema.yaml")
 vectorstore.write_schema("redis_schema.yaml")
+if chunk_store is not None:
+    print(f"Saving schema to {CHUNK_SCHEMA_FILE}")
+    chunk_store.write_schema(CHUNK_SCHEMA_FILE)
 
 ### Run search queries
 # Using the vectorstore we just built in LangChain, we can conduct similarity searches using the `similarity_search_with_score` method. In this example, the top 10 results for a given query are returned.
@@ -1,6 +1,5 @@
 from typing import List
 from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, trim_messages
-from langchain.callbacks.base import BaseCallbackHandler
 
 def set_color(color=''):
     color_codes = {
@@ -29,14 +28,19 @@ def debug_chat_history(messages: List[HumanMessage | AIMessage | SystemMessage],
     print(f"{set_color('yellow')}############################################################################\n")
     print_color()
 
-class DebugCallbackHandler(BaseCallbackHandler):
-    def on_llm_end(self, response, **kwargs):
-        output = response.generations[0][0].text
-        truncate_length=200
-        print(f"\n{set_color('yellow')}########################## Callback - LLM End ###################################{set_color()}")
-        if len(output) > truncate_length:
-            content_preview = f"{output[:truncate_length]}{set_color('red')}...(truncated){set_color()}"
-        else:
-            content_preview = output
-        print(f"{set_color('green')}response.generations[0][0].text:\n{set_color()} {content_preview}")
-        print(f"{set_color('yellow')}############################################################################{set_color()}\n")
+# Per-stage breakdown of a chat turn (see instrumentation.Trace)
+def debug_trace(trace):
+    print(f"\n{set_color('yellow')}########################## Turn timings ###################################{set_color()}")
+    for stage, totals in trace.stages().items():
+        details = [f"{totals['duration_ms']:.0f} ms"]
+        if totals['count'] > 1:
+            details.append(f"{totals['count']} calls")
+        if 'prompt_tokens' in totals:
+            details.append(f"{totals['prompt_tokens']} prompt + {totals.get('completion_tokens', 0)} completion tokens")
+        if 'first_token_ms' in totals:
+            details.append(f"first token at {totals['first_token_ms']:.0f} ms")
+        if 'cache_hits' in totals:
+            details.append(f"{totals['cache_hits']} cache hits")
+        print(f"{set_color('green')}{stage}:{set_color()} {', '.join(details)}")
+    print(f"{set_color('green')}total:{set_color()} {trace.duration * 1000:.0f} ms")
+    print(f"{set_color('yellow')}############################################################################{set_color()}\n")
@@ -0,0 +1,294 @@
+import asyncio
+import hashlib
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from context_packing import STOP_WORDS
+
+# Deterministic local stand-ins for Azure OpenAI, used by benchmark-chat.py to run the real RAG chain offline.
+# Both inject latency, so the time spent waiting on the network is part of the measurement without any network:
+#   - FakeEmbeddings: hashed bag-of-words vectors, so questions sharing words with a plot retrieve that movie
+#   - FakeChatModel: `latency` seconds before the first token, then `token_latency` seconds per token
+# The same inputs always give the same outputs, so runs are comparable with each other.
+
+def _stable_hash(text: str) -> int:
+    # Python's hash() is salted per process
+    return int.from_bytes(hashlib.md5(text.encode('utf-8')).digest()[:8], 'little')
+
+class FakeEmbeddings(Embeddings):
+    def __init__(self, dims: int = 256, latency: float = 0.0, latency_per_text: float = 0.0):
+        self.dims = dims
+        self.latency = latency
+        self.latency_per_text = latency_per_text
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dims, dtype=np.float32)
+        for word in re.findall(r"[a-z0-9]+", text.lower()):
+            if word in STOP_WORDS:
+                continue
+            # Non-negative components keep cosine similarities, and so relevance scores, within 0..1
+            vector[_stable_hash(word) % self.dims] += 1.0
+        # A small text-specific component, so texts without content words still get distinct vectors
+        vector[_stable_hash(text) % self.dims] += 0.1
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def _delay(self, texts: List[str]) -> float:
+        return self.latency + self.latency_per_text * len(texts) if texts else 0.0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self._delay(texts))
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        await asyncio.sleep(self._delay(texts))
+        return [self._embed(text) for text in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+# Answers are built from the prompt: the rewrite prompt gets the question back unchanged, history summaries the end of
+# the transcript, and answer prompts a list of the movie titles in the context padded to `answer_tokens` words.
+# Non-streamed calls report token usage like the real API, streamed calls don't.
+class FakeChatModel(BaseChatModel):
+    latency: float = 0.3
+    token_latency: float = 0.01
+    answer_tokens: int = 60
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def _response(self, messages: List[BaseMessage]) -> str:
+        system = " ".join(str(m.content) for m in messages if m.type == 'system')
+        question = next((str(m.content) for m in reversed(messages) if m.type == 'human'), '')
+        if 'standalone question' in system:
+            return question
+        if 'summarise the conversation' in system.lower():
+            return " ".join(question.split()[-self.answer_tokens:])
+        titles = re.findall(r"^Title: (.+)$", system, re.MULTILINE)
+        words = (f"Here are the movies I found: {', '.join(titles)}." if titles else "I'm unsure.").split()
+        filler = f"This is a scripted answer to {question}".split()
+        while len(words) < self.answer_tokens:
+            words.extend(filler[:self.answer_tokens - len(words)])
+        return " ".join(words)
+
+    def _tokens(self, text: str) -> List[str]:
+        words = text.split(" ")
+        return [word if i == 0 else " " + word for i, word in enumerate(words)]
+
+    def _usage(self, messages: List[BaseMessage], text: str) -> Dict[str, int]:
+        prompt, completion = count_tokens_approximately(messages), len(self._tokens(text))
+        return {'input_tokens': prompt, 'output_tokens': completion, 'total_tokens': prompt + completion}
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        text = self._response(messages)
+        time.sleep(self.latency + self.token_latency * len(self._tokens(text)))
+        message = AIMessage(content=text, usage_metadata=self._usage(messages, text))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        text = self._response(messages)
+        await asyncio.sleep(self.latency + self.token_latency * len(self._tokens(text)))
+        message = AIMessage(content=text, usage_metadata=self._usage(messages, text))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.latency)
+        for token in self._tokens(self._response(messages)):
+            time.sleep(self.token_latency)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.latency)
+        for token in self._tokens(self._response(messages)):
+            await asyncio.sleep(self.token_latency)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+# A synthetic catalogue in the movie_list.csv format, for running without the Kaggle dataset. It starts with the
+# movies of the README sample dialogue, the rest are generated from a fixed seed.
+SAMPLE_MOVIES = [
+    ("Top Gun", "Tony Scott", "Tom Cruise, Kelly McGillis, Val Kilmer", "action", 1986,
+     "Maverick, a hotshot naval aviator, trains at the Top Gun fighter pilot school and competes with Iceman."),
+    ("Collateral", "Michael Mann", "Tom Cruise, Jamie Foxx", "crime thriller", 2004,
+     "A Los Angeles cab driver is forced to drive a contract killer to his targets during one night."),
+    ("Ray", "Taylor Hackford", "Jamie Foxx, Kerry Washington", "biography", 2004,
+     "The life of soul musician Ray Charles, from his childhood blindness to his rise to fame."),
+    ("Jerry Maguire", "Cameron Crowe", "Tom Cruise, Cuba Gooding Jr., Renee Zellweger", "comedy drama", 1996,
+     "A sports agent loses his job and starts his own agency with one client and one colleague."),
+    ("Minority Report", "Steven Spielberg", "Tom Cruise, Colin Farrell", "science fiction", 2002,
+     "In a future where police arrest murderers before they kill, a precrime officer is accused of a future murder."),
+    ("Rain Man", "Barry Levinson", "Dustin Hoffman, Tom Cruise", "drama", 1988,
+     "A selfish car dealer discovers he has an autistic older brother and takes him on a road trip."),
+    ("Alien", "Ridley Scott", "Sigourney Weaver, Tom Skerritt", "science fiction", 1979,
+     "The crew of a commercial spaceship is hunted by a deadly alien creature."),
+    ("The Terminator", "James Cameron", "Arnold Schwarzenegger, Linda Hamilton", "science fiction", 1984,
+     "A cyborg assassin is sent back in time to kill the mother of the future resistance leader."),
+    ("Withnail and I", "Bruce Robinson", "Richard E. Grant, Paul McGann", "comedy", 1987,
+     "Two unemployed actors leave London for a holiday in the countryside that goes badly wrong."),
+    ("Full Metal Jacket", "Stanley Kubrick", "Matthew Modine, R. Lee Ermey", "war", 1987,
+     "Marine recruits endure brutal basic training before being sent to fight in Vietnam."),
+]
+
+SYNTHETIC_WORDS = (
+    "agent detective pilot family city night island war love heist storm ship planet robot ghost town river school "
+    "secret journey prison kingdom desert train doctor soldier killer mystery revenge dream witness border winter "
+    "summer band dancer lawyer reporter hacker spy escape rescue treasure forest mountain ocean election hospital"
+).split()
+SYNTHETIC_NAMES = (
+    "Alex Morgan, Sam Rivera, Jordan Lee, Casey Brooks, Taylor Quinn, Morgan Hale, Jamie Cross, Riley Stone, "
+    "Avery Lane, Drew Carter, Parker Reed, Cameron Blake, Quinn Ellis, Hayden Shaw, Reese Walker"
+).split(", ")
+SYNTHETIC_GENRES = ['action', 'comedy', 'drama', 'science fiction', 'horror', 'thriller', 'romance', 'western',
+                    'animation', 'crime thriller', 'war', 'musical']
+
+def synthetic_movies(n: int = 2000, seed: int = 0) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    rows = []
+    for title, director, cast, genre, year, plot in SAMPLE_MOVIES:
+        rows.append({'title': title, 'director': director, 'cast': cast, 'genre': genre, 'plot': plot, 'year': year})
+    while len(rows) < n:
+        words = rng.sample(SYNTHETIC_WORDS, 12)
+        rows.append({
+            'title': " ".join(word.capitalize() for word in words[:rng.randint(1, 3)]),
+            'director': rng.choice(SYNTHETIC_NAMES),
+            'cast': ", ".join(rng.sample(SYNTHETIC_NAMES, 3)),
+            'genre': rng.choice(SYNTHETIC_GENRES),
+            'plot': f"A {words[3]} and a {words[4]} face a {words[5]} in the {words[6]}. "
+                    f"The {words[7]} leads to a {words[8]}, a {words[9]} and a {words[10]} near the {words[11]}.",
+            'year': rng.randint(1970, 2020),
+        })
+    return [{'id': i + 1, **row, 'wiki_page': '', 'origin': 'American', 'n_tokens': len(row['plot']) // 4 + 1}
+            for i, row in enumerate(rows)]
+
+# In-process stand-in for the AIProjectClient of the Azure AI Agent Service, covering the `agents` calls made by
+# agent_client.py and by the original blocking flow (runs.create_and_process, then messages.list). Objects have the
+# attributes of the SDK models that are read, events come in the run stream's (event type, data, None) shape.
+#   - connect_latency: paid by the first request of each client (credential token and TLS connection setup)
+#   - request_latency: every API request
+#   - queue_latency: a run waiting for the model, before its tool call
+#   - tool_latency: the search tool call of each run
+#   - latency and token_latency: as FakeChatModel, from the end of the tool call to the first and following tokens
+class FakeAgentProject:
+    def __init__(self, connect_latency: float = 0.3, request_latency: float = 0.05, queue_latency: float = 0.2,
+                 tool_latency: float = 0.3, latency: float = 0.3, token_latency: float = 0.01, answer_tokens: int = 60):
+        self.connect_latency = connect_latency
+        self.request_latency = request_latency
+        self.queue_latency = queue_latency
+        self.tool_latency = tool_latency
+        self.latency = latency
+        self.token_latency = token_latency
+        self.answer_tokens = answer_tokens
+        self.requests = 0
+        self.threads: Dict[str, List[SimpleNamespace]] = {}
+        self._lock = threading.Lock()
+        self._ids = 0
+        self.agents = SimpleNamespace(
+            get_agent=lambda agent_id: self._request(SimpleNamespace(id=agent_id)),
+            threads=SimpleNamespace(create=self._create_thread),
+            messages=SimpleNamespace(create=self._create_message, list=self._list_messages),
+            runs=SimpleNamespace(stream=self._stream, create_and_process=self._create_and_process))
+
+    def _id(self, prefix: str) -> str:
+        with self._lock:
+            self._ids += 1
+            return f"{prefix}_{self._ids:06d}"
+
+    def _request(self, result=None):
+        with self._lock:
+            self.requests += 1
+            first = self.requests == 1
+        time.sleep(self.request_latency + (self.connect_latency if first else 0.0))
+        return result
+
+    def _message(self, thread_id: str, role: str, text: str, run_id: Optional[str] = None) -> SimpleNamespace:
+        return SimpleNamespace(id=self._id("msg"), thread_id=thread_id, role=role, run_id=run_id,
+                               text_messages=[SimpleNamespace(text=SimpleNamespace(value=text))])
+
+    def _create_thread(self, **kwargs) -> SimpleNamespace:
+        thread = SimpleNamespace(id=self._id("thread"))
+        self.threads[thread.id] = []
+        return self._request(thread)
+
+    def _create_message(self, thread_id: str, role: str, content: str, **kwargs) -> SimpleNamespace:
+        message = self._message(thread_id, role, content)
+        self.threads[thread_id].append(message)
+        return self._request(message)
+
+    def _list_messages(self, thread_id: str, run_id: Optional[str] = None, order: str = "desc", **kwargs):
+        messages = [m for m in self.threads[thread_id] if run_id is None or m.run_id == run_id]
+        return self._request(messages if str(getattr(order, 'value', order)) == "asc" else messages[::-1])
+
+    def _answer(self, thread_id: str) -> str:
+        question = self.threads[thread_id][-1].text_messages[0].text.value
+        words = set(re.findall(r"[a-z0-9]+", question.lower())) - STOP_WORDS
+        titles = [title for title, director, cast, genre, year, plot in SAMPLE_MOVIES
+                  if words & set(re.findall(r"[a-z0-9]+", f"{title} {cast} {genre} {plot}".lower()))][:3]
+        words = (f"Here are the movies I found: {', '.join(titles)}." if titles else "I'm unsure.").split()
+        filler = f"This is a scripted answer to {question}".split()
+        while len(words) < self.answer_tokens:
+            words.extend(filler[:self.answer_tokens - len(words)])
+        return " ".join(words)
+
+    def _events(self, thread_id: str) -> Iterator[tuple]:
+        run = SimpleNamespace(id=self._id("run"), thread_id=thread_id, status="queued", last_error=None)
+        yield "thread.run.created", run, None
+        time.sleep(self.queue_latency)
+        call = SimpleNamespace(id=self._id("call"), type="azure_ai_search")
+        step = SimpleNamespace(id=self._id("step"), status="in_progress",
+                               step_details=SimpleNamespace(type="tool_calls", tool_calls=[call]))
+        yield "thread.run.step.created", step, None
+        time.sleep(self.tool_latency)
+        step.status = "completed"
+        yield "thread.run.step.completed", step, None
+        time.sleep(self.latency)
+        text = self._answer(thread_id)
+        for i, word in enumerate(text.split(" ")):
+            time.sleep(self.token_latency)
+            yield "thread.message.delta", SimpleNamespace(text=word if i == 0 else " " + word), None
+        message = self._message(thread_id, "assistant", text, run_id=run.id)
+        self.threads[thread_id].append(message)
+        yield "thread.message.completed", message, None
+        run.status = "completed"
+        yield "thread.run.completed", run, None
+        yield "done", "[DONE]", None
+
+    @contextmanager
+    def _stream(self, thread_id: str, agent_id: str, **kwargs) -> Iterator[Iterator[tuple]]:
+        self._request()
+        yield self._events(thread_id)
+
+    def _create_and_process(self, thread_id: str, agent_id: str, **kwargs) -> SimpleNamespace:
+        # Blocks until the run is done, polling like the SDK does
+        self._request()
+        run = None
+        for event_type, data, _ in self._events(thread_id):
+            if event_type == "thread.run.completed":
+                run = data
+        return self._request(run)
@@ -0,0 +1,173 @@
+import hashlib
+import json
+import math
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from rate_limit import RateLimiter
+
+def normalize_for_hash(text: str) -> str:
+    return re.sub(r'\s+', ' ', text).strip()
+
+def fingerprint_text(text: str, model: str) -> str:
+    # The model name is part of the key so switching embedding deployments never serves stale vectors
+    return hashlib.sha256(f"{model}\n{normalize_for_hash(text)}".encode('utf-8')).hexdigest()
+
+# Converts pandas/numpy values to plain Python so a row fingerprints the same whether it came from
+# the Kaggle dataframe or was read back from movie_list.csv (where ints may come back as floats).
+def _plain(value: Any) -> Any:
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float):
+        if math.isnan(value):
+            return None
+        if value.is_integer():
+            return int(value)
+    return value
+
+def document_fingerprint(text: str, metadata: Dict[str, Any]) -> str:
+    row = {key: _plain(value) for key, value in metadata.items()}
+    row['content'] = normalize_for_hash(text)
+    return hashlib.sha256(json.dumps(row, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+# Per-movie content fingerprints are kept in a single Redis hash next to the index (id -> fingerprint),
+# so a sync can diff the catalogue against Redis without reading back any documents.
+def fingerprints_key(index_name: str) -> str:
+    return f"{index_name}:fingerprints"
+
+def load_fingerprints(client, index_name: str) -> Dict[str, str]:
+    return {
+        (key.decode() if isinstance(key, bytes) else key): (value.decode() if isinstance(value, bytes) else value)
+        for key, value in client.hgetall(fingerprints_key(index_name)).items()
+    }
+
+def save_fingerprints(client, index_name: str, fingerprints: Dict[str, str], batch_size: int = 1000):
+    items = list(fingerprints.items())
+    pipeline = client.pipeline(transaction=False)
+    for i in range(0, len(items), batch_size):
+        pipeline.hset(fingerprints_key(index_name), mapping=dict(items[i:i + batch_size]))
+    pipeline.execute()
+
+def delete_fingerprints(client, index_name: str, ids: List[str]):
+    if ids:
+        client.hdel(fingerprints_key(index_name), *ids)
+
+def approximate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+# On-disk embedding cache (SQLite) keyed by fingerprint_text(). Every completed batch is committed,
+# so the cache doubles as the ingestion checkpoint: a crashed or re-run load only embeds what is missing.
+class EmbeddingCache:
+    def __init__(self, path: str = 'embedding_cache.db'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._conn.commit()
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        with self._lock:
+            # SQLite limits the number of bound parameters per statement
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk)
+                for key, blob in rows:
+                    found[key] = array('f', blob).tolist()
+        return found
+
+    # As get_many, as float32 arrays over the stored bytes rather than lists of Python floats
+    def get_arrays(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk)
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put_many(self, vectors: Dict[str, List[float]]):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, array('f', vector).tobytes()) for key, vector in vectors.items()])
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+# Wraps an Embeddings instance so embed_documents() serves cached vectors and embeds the rest
+# in large concurrent batches under a rate limit. Vectors come back in input order, so it can be
+# passed straight to RedisVectorStore.from_documents(), which embeds everything before it starts
+# the pipelined Redis writes.
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embedding: Embeddings, cache: EmbeddingCache, model: str,
+                 batch_size: int = 256, max_workers: int = 4, rate_limiter: Optional[RateLimiter] = None):
+        self.embedding = embedding
+        self.cache = cache
+        self.model = model
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.rate_limiter = rate_limiter
+
+    def _embed_batch(self, batch: List[tuple]) -> Dict[str, List[float]]:
+        texts = [text for _, text in batch]
+        if self.rate_limiter:
+            self.rate_limiter.acquire(sum(approximate_tokens(text) for text in texts))
+        embedded = self.embedding.embed_documents(texts)
+        vectors = {key: vector for (key, _), vector in zip(batch, embedded)}
+        self.cache.put_many(vectors)
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [fingerprint_text(text, self.model) for text in texts]
+        vectors = self.cache.get_many(list(set(keys)))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        print(f"Embedding cache: {len(vectors)} cached, {len(missing)} to embed")
+
+        pending = list(missing.items())
+        batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+        if batches:
+            start_time = time.time()
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [executor.submit(self._embed_batch, batch) for batch in batches]
+                for done, future in enumerate(as_completed(futures), 1):
+                    vectors.update(future.result())
+                    print(f"Embedded batch {done}/{len(batches)} ({time.time() - start_time:.1f}s)")
+
+        return [vectors[key] for key in keys]
+
+    # As embed_documents, as one float32 array. Cached vectors are read straight from their stored bytes, only the
+    # missing ones go through embed_documents.
+    def embed_array(self, texts: List[str]) -> np.ndarray:
+        keys = [fingerprint_text(text, self.model) for text in texts]
+        vectors = self.cache.get_arrays(list(set(keys)))
+        missing = {key: text for key, text in zip(keys, texts) if key not in vectors}
+        if missing:
+            embedded = self.embed_documents(list(missing.values()))
+            vectors.update((key, np.asarray(vector, dtype=np.float32)) for key, vector in zip(missing, embedded))
+        return np.stack([vectors[key] for key in keys]) if keys else np.zeros((0, 0), dtype=np.float32)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embedding.embed_query(text)
@@ -0,0 +1,371 @@
+import contextvars
+import json
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Optional
+from uuid import UUID
+
+import numpy as np
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.outputs import LLMResult
+
+# Per-stage latency, token and cache instrumentation of chat turns.
+# Each turn runs inside a Trace. The stages LangChain runs as named runnables (question rewrite, retrieval, answer
+# generation) are timed by the trace's callback handler, which also counts the prompt and completion tokens of their
+# LLM calls. The stages that run inside our own code (query embedding, vector search, metadata and neighbour lookups,
+# context assembly, answer cache) are timed with span(), which finds the current trace through a context variable.
+# Every span goes into the process wide `metrics` (p50/p95/p99 per stage, token and cache counters, served in the
+# Prometheus text format) and, if the trace has a TraceWriter, into a JSONL trace file with one line per turn.
+
+# Named runnables of the RAG chain (see chains.py and question_rewrite.py) and the stage they are timed as
+STAGE_RUN_NAMES = {
+    'rewrite_question': 'rewrite',
+    'retrieve_documents': 'retrieval',
+    'speculative_retrieve_documents': 'retrieval',
+    'stuff_documents_chain': 'answer',
+}
+QUANTILES = (0.5, 0.95, 0.99)
+METRIC_PREFIX = 'movie_chat'
+
+class Metrics:
+    # Quantiles are computed over the last `max_samples` durations of each stage, counts and sums over all of them
+    def __init__(self, max_samples: int = 2048):
+        self.max_samples = max_samples
+        self._samples: Dict[str, deque] = defaultdict(lambda: deque(maxlen=self.max_samples))
+        self._counts: Dict[str, int] = defaultdict(int)
+        self._sums: Dict[str, float] = defaultdict(float)
+        self._errors: Dict[str, int] = defaultdict(int)
+        self._tokens: Dict[tuple, int] = defaultdict(int)
+        self._cache: Dict[tuple, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float, error: bool = False):
+        with self._lock:
+            self._samples[stage].append(seconds)
+            self._counts[stage] += 1
+            self._sums[stage] += seconds
+            if error:
+                self._errors[stage] += 1
+
+    def add_tokens(self, stage: str, prompt: int = 0, completion: int = 0):
+        with self._lock:
+            self._tokens[(stage, 'prompt')] += prompt
+            self._tokens[(stage, 'completion')] += completion
+
+    def cache_result(self, stage: str, hit: bool):
+        with self._lock:
+            self._cache[(stage, 'hit' if hit else 'miss')] += 1
+
+    def reset(self):
+        with self._lock:
+            for values in (self._samples, self._counts, self._sums, self._errors, self._tokens, self._cache):
+                values.clear()
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        # {stage: {count, p50_ms, p95_ms, p99_ms, prompt_tokens, completion_tokens, cache_hits, cache_misses}}
+        with self._lock:
+            stages = {}
+            for stage, samples in self._samples.items():
+                ms = np.percentile(np.asarray(samples) * 1000, [q * 100 for q in QUANTILES])
+                stages[stage] = {'count': self._counts[stage],
+                                 **{f"p{round(q * 100)}_ms": round(float(value), 2) for q, value in zip(QUANTILES, ms)}}
+            for (stage, kind), tokens in self._tokens.items():
+                stages.setdefault(stage, {})[f"{kind}_tokens"] = tokens
+            for (stage, result), count in self._cache.items():
+                stages.setdefault(stage, {})['cache_hits' if result == 'hit' else 'cache_misses'] = count
+            return stages
+
+    def prometheus(self) -> str:
+        with self._lock:
+            lines = [f"# HELP {METRIC_PREFIX}_stage_seconds Duration of each stage of a chat turn",
+                     f"# TYPE {METRIC_PREFIX}_stage_seconds summary"]
+            for stage, samples in sorted(self._samples.items()):
+                for q, value in zip(QUANTILES, np.percentile(np.asarray(samples), [q * 100 for q in QUANTILES])):
+                    lines.append(f'{METRIC_PREFIX}_stage_seconds{{stage="{stage}",quantile="{q}"}} {value:.6f}')
+                lines.append(f'{METRIC_PREFIX}_stage_seconds_sum{{stage="{stage}"}} {self._sums[stage]:.6f}')
+                lines.append(f'{METRIC_PREFIX}_stage_seconds_count{{stage="{stage}"}} {self._counts[stage]}')
+            lines += [f"# HELP {METRIC_PREFIX}_stage_errors_total Failed runs of each stage",
+                      f"# TYPE {METRIC_PREFIX}_stage_errors_total counter"]
+            lines += [f'{METRIC_PREFIX}_stage_errors_total{{stage="{stage}"}} {count}'
+                      for stage, count in sorted(self._errors.items())]
+            lines += [f"# HELP {METRIC_PREFIX}_tokens_total LLM tokens used by each stage",
+                      f"# TYPE {METRIC_PREFIX}_tokens_total counter"]
+            lines += [f'{METRIC_PREFIX}_tokens_total{{stage="{stage}",type="{kind}"}} {count}'
+                      for (stage, kind), count in sorted(self._tokens.items())]
+            lines += [f"# HELP {METRIC_PREFIX}_cache_requests_total Cache lookups of each stage",
+                      f"# TYPE {METRIC_PREFIX}_cache_requests_total counter"]
+            lines += [f'{METRIC_PREFIX}_cache_requests_total{{stage="{stage}",result="{result}"}} {count}'
+                      for (stage, result), count in sorted(self._cache.items())]
+            return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+# Appends one JSON line per finished turn, safe to share between threads
+class TraceWriter:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, record: Dict[str, Any]):
+        line = json.dumps(record, separators=(',', ':'), ensure_ascii=False, default=str)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + "\n")
+
+_current_trace: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar('trace', default=None)
+
+def current_trace() -> Optional["Trace"]:
+    return _current_trace.get()
+
+def record_span(stage: str, start: float, duration: float, trace: Optional["Trace"] = None, **fields):
+    # `start` is a time.perf_counter() value. Token counts and cache_hit in `fields` also go into the counters.
+    # The span is added to `trace`, or to the current trace if there is one.
+    metrics.observe(stage, duration, error=bool(fields.get('error')))
+    if 'prompt_tokens' in fields or 'completion_tokens' in fields:
+        metrics.add_tokens(stage, fields.get('prompt_tokens', 0), fields.get('completion_tokens', 0))
+    if 'cache_hit' in fields:
+        metrics.cache_result(stage, fields['cache_hit'])
+    trace = trace or current_trace()
+    if trace is not None:
+        trace.add_span(stage, start, duration, **fields)
+
+# Times the block as `stage`. The yielded dict can be filled in with span fields (cache_hit, result counts, ...).
+@contextmanager
+def span(stage: str, **fields) -> Iterator[Dict[str, Any]]:
+    start = time.perf_counter()
+    try:
+        yield fields
+    except BaseException as e:
+        fields['error'] = repr(e)
+        raise
+    finally:
+        record_span(stage, start, time.perf_counter() - start, **fields)
+
+# One chat turn. Used as a context manager around the chain call, with `callbacks` passed in the chain config:
+#
+#   with Trace(trace_writer, session_id=...) as trace:
+#       answer = rag_chain.invoke(inputs, config={'callbacks': trace.callbacks})
+class Trace:
+    def __init__(self, writer: Optional[TraceWriter] = None, **attributes):
+        self.id = uuid.uuid4().hex
+        self.writer = writer
+        self.attributes = attributes
+        self.started = time.time()
+        self.spans: List[Dict[str, Any]] = []
+        self.duration: Optional[float] = None
+        # Time spent in chain runs, less than the duration when the trace's runs are queued (e.g. batch items)
+        self.active = 0.0
+        self.error: Optional[str] = None
+        self.callbacks = [StageCallbackHandler(self)]
+        self._start = time.perf_counter()
+        self._token = None
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "Trace":
+        self._token = _current_trace.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_trace.reset(self._token)
+        self.finish(error=repr(exc) if exc is not None else None)
+        return False
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._start
+
+    def add_span(self, stage: str, start: float, duration: float, **fields):
+        with self._lock:
+            self.spans.append({'stage': stage, 'start_ms': round((start - self._start) * 1000, 2),
+                               'duration_ms': round(duration * 1000, 2), **fields})
+
+    def stages(self) -> Dict[str, Dict[str, float]]:
+        # Total duration, tokens and cache hits per stage of this turn
+        totals: Dict[str, Dict[str, float]] = {}
+        with self._lock:
+            for s in sorted(self.spans, key=lambda s: s['start_ms']):
+                stage = totals.setdefault(s['stage'], {'count': 0, 'duration_ms': 0.0})
+                stage['count'] += 1
+                stage['duration_ms'] = round(stage['duration_ms'] + s['duration_ms'], 2)
+                for key in ('prompt_tokens', 'completion_tokens'):
+                    if key in s:
+                        stage[key] = stage.get(key, 0) + s[key]
+                if 'cache_hit' in s:
+                    stage['cache_hits'] = stage.get('cache_hits', 0) + int(s['cache_hit'])
+                if 'first_token_ms' in s:
+                    stage['first_token_ms'] = s['first_token_ms']
+        return totals
+
+    def finish(self, error: Optional[str] = None):
+        if self.duration is not None:
+            return
+        self.duration = self.elapsed()
+        self.error = error
+        metrics.observe('turn', self.duration, error=error is not None)
+        if self.writer is not None:
+            with self._lock:
+                spans = sorted(self.spans, key=lambda s: s['start_ms'])
+            self.writer.write({'trace_id': self.id, 'timestamp': self.started, **self.attributes,
+                               'duration_ms': round(self.duration * 1000, 2), 'active_ms': round(self.active * 1000, 2),
+                               'error': error, 'spans': spans})
+
+# Times the named runnables in STAGE_RUN_NAMES and counts the tokens of the LLM calls made inside them.
+# When a chain is streamed, every step of a sequence starts as soon as the stream is set up and then waits for its
+# input, so a stage is timed from its first LLM or retriever call (those only start once their input is complete).
+# Token counts come from the provider's usage data; streamed calls don't return it, so they are estimated
+# (and the span gets tokens_estimated). Callbacks run inline, so the handler sees the run events in order.
+# Outside a `with Trace` block (e.g. items of chain.batch, which run in worker threads) the handler makes its trace the
+# current one for the duration of each top level run, so span() calls inside the run still find it.
+class StageCallbackHandler(BaseCallbackHandler):
+    run_inline = True
+
+    def __init__(self, trace: Trace):
+        self.trace = trace
+        self.runs: Dict[UUID, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _start(self, run_id: UUID, parent_run_id: Optional[UUID], name: Optional[str], **fields):
+        with self._lock:
+            self.runs[run_id] = {'stage': STAGE_RUN_NAMES.get(name), 'parent': parent_run_id,
+                                 'start': time.perf_counter(), **fields}
+            if parent_run_id is None:
+                self.runs[run_id]['token'] = _current_trace.set(self.trace) if current_trace() is None else None
+
+    def _call_start(self, run_id: UUID, parent_run_id: Optional[UUID], **fields):
+        # LLM and retriever calls, which start the clock of the stage they run in
+        self._start(run_id, parent_run_id, None, **fields)
+        stage = self._stage_run(parent_run_id)
+        if stage is not None and not stage.get('called'):
+            stage['start'], stage['called'] = self.runs[run_id]['start'], True
+
+    def _end(self, run_id: UUID, error: Optional[BaseException] = None):
+        with self._lock:
+            run = self.runs.pop(run_id, None)
+        if run is not None and run['parent'] is None:
+            self._end_top_level(run)
+        if run is None or run['stage'] is None:
+            return
+        fields = {key: value for key, value in run.items()
+                  if key in ('prompt_tokens', 'completion_tokens', 'tokens_estimated', 'first_token_ms')}
+        if error is not None:
+            fields['error'] = repr(error)
+        record_span(run['stage'], run['start'], time.perf_counter() - run['start'], trace=self.trace, **fields)
+
+    def _end_top_level(self, run: Dict[str, Any]):
+        with self._lock:
+            self.trace.active += time.perf_counter() - run['start']
+        if run.get('token') is not None:
+            try:
+                _current_trace.reset(run['token'])
+            except ValueError:
+                # Ended in another context than it started in, which then goes away with its trace
+                pass
+
+    def _stage_run(self, run_id: Optional[UUID]) -> Optional[Dict[str, Any]]:
+        # The nearest enclosing run that is timed as a stage
+        with self._lock:
+            while run_id is not None:
+                run = self.runs.get(run_id)
+                if run is None:
+                    return None
+                if run['stage'] is not None:
+                    return run
+                run_id = run['parent']
+        return None
+
+    def on_chain_start(self, serialized: Dict[str, Any], inputs: Dict[str, Any], *, run_id: UUID,
+                       parent_run_id: Optional[UUID] = None, **kwargs):
+        self._start(run_id, parent_run_id, kwargs.get('name'))
+
+    def on_chain_end(self, outputs: Dict[str, Any], *, run_id: UUID, **kwargs):
+        self._end(run_id)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs):
+        self._end(run_id, error)
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[BaseMessage]], *, run_id: UUID,
+                            parent_run_id: Optional[UUID] = None, **kwargs):
+        self._call_start(run_id, parent_run_id,
+                         prompt_estimate=sum(count_tokens_approximately(prompt) for prompt in messages))
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID,
+                     parent_run_id: Optional[UUID] = None, **kwargs):
+        self._call_start(run_id, parent_run_id, prompt_estimate=count_tokens_approximately(prompts))
+
+    def on_retriever_start(self, serialized: Dict[str, Any], query: str, *, run_id: UUID,
+                           parent_run_id: Optional[UUID] = None, **kwargs):
+        self._call_start(run_id, parent_run_id)
+
+    def on_retriever_end(self, documents, *, run_id: UUID, **kwargs):
+        with self._lock:
+            self.runs.pop(run_id, None)
+
+    def on_retriever_error(self, error: BaseException, *, run_id: UUID, **kwargs):
+        with self._lock:
+            self.runs.pop(run_id, None)
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs):
+        stage = self._stage_run(run_id)
+        if stage is not None and stage['stage'] == 'answer' and 'first_token_ms' not in stage:
+            # Time to first token, from the start of the turn
+            elapsed = self.trace.elapsed()
+            stage['first_token_ms'] = round(elapsed * 1000, 2)
+            metrics.observe('first_token', elapsed)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs):
+        with self._lock:
+            run = self.runs.pop(run_id, None)
+        stage = self._stage_run(run['parent']) if run else None
+        if stage is None:
+            return
+        prompt_tokens, completion_tokens = llm_token_usage(response)
+        if prompt_tokens is None:
+            text = "".join(generation.text for generations in response.generations for generation in generations)
+            prompt_tokens, completion_tokens = run['prompt_estimate'], count_tokens_approximately([AIMessage(content=text)])
+            stage['tokens_estimated'] = True
+        with self._lock:
+            stage['prompt_tokens'] = stage.get('prompt_tokens', 0) + prompt_tokens
+            stage['completion_tokens'] = stage.get('completion_tokens', 0) + completion_tokens
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs):
+        with self._lock:
+            self.runs.pop(run_id, None)
+
+def llm_token_usage(response: LLMResult):
+    # (prompt tokens, completion tokens) reported by the provider, or (None, None)
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, 'message', None), 'usage_metadata', None)
+            if usage:
+                return usage.get('input_tokens', 0), usage.get('output_tokens', 0)
+    usage = (response.llm_output or {}).get('token_usage') or {}
+    if usage:
+        return usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+    return None, None
+
+# Serves `metrics` in the Prometheus text format at http://<host>:<port>/metrics from a daemon thread, for the apps
+# that don't have an HTTP server of their own
+def serve_metrics(port: int, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
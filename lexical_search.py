@@ -0,0 +1,84 @@
+import math
+import re
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Tuple
+
+from langchain_core.documents import Document
+
+from context_packing import STOP_WORDS
+
+# Field weights for the local BM25 index, a title match counts for more than a word in the plot
+FIELD_WEIGHTS = {'Title': 3, 'Cast': 2, 'Director': 1}
+
+def lexical_terms(text: str) -> List[str]:
+    return [word for word in re.findall(r"[a-z0-9']+", text.lower()) if word not in STOP_WORDS]
+
+# RediSearch full-text query over the title, cast and plot. Terms are OR'ed and ranked with BM25, so exact title and
+# name matches come out on top.
+def fulltext_query(text: str, fields: Tuple[str, ...] = ('Title', 'Cast', 'content')) -> str:
+    from langchain_community.utilities.redis import TokenEscaper
+
+    escaper = TokenEscaper()
+    terms = sorted(set(lexical_terms(text)))
+    if not terms:
+        return ""
+    return f"@{'|'.join(fields)}:({' | '.join(escaper.escape(term) for term in terms)})"
+
+# In-memory BM25 over movie_list.csv (title, cast, director and plot), the lexical side of hybrid retrieval when
+# RediSearch full-text search isn't available
+class LocalBM25Index:
+    def __init__(self, movies: Dict[str, Tuple[str, Dict[str, Any]]], k1: float = 1.5, b: float = 0.75):
+        self.movies = movies
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[str, int]] = defaultdict(dict)
+        self.lengths: Dict[str, int] = {}
+        for doc_id, (plot, metadata) in movies.items():
+            counts = Counter(lexical_terms(plot if isinstance(plot, str) else ''))
+            for field, weight in FIELD_WEIGHTS.items():
+                value = metadata.get(field)
+                for term in lexical_terms(value if isinstance(value, str) else ''):
+                    counts[term] += weight
+            for term, count in counts.items():
+                self.postings[term][doc_id] = count
+            self.lengths[doc_id] = sum(counts.values())
+        self.average_length = sum(self.lengths.values()) / max(len(self.lengths), 1)
+
+    def scores(self, query: str) -> List[Tuple[str, float]]:
+        scores = defaultdict(float)
+        n = len(self.lengths)
+        for term in set(lexical_terms(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[doc_id] / self.average_length)
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+    def search(self, query: str, k: int = 20) -> List[Document]:
+        docs = []
+        for doc_id, score in self.scores(query)[:k]:
+            plot, metadata = self.movies[doc_id]
+            docs.append(Document(page_content=plot if isinstance(plot, str) else '',
+                                 metadata={**metadata, 'id': doc_id, 'bm25_score': score}))
+        return docs
+
+# Reciprocal rank fusion: each document scores sum(1 / (rrf_k + rank)) over the rankings it appears in
+def reciprocal_rank_fusion(rankings: List[List[Document]], k: int, rrf_k: int = 60) -> List[Document]:
+    fused: Dict[str, float] = defaultdict(float)
+    docs: Dict[str, Document] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            doc_id = str(doc.metadata.get('id'))
+            fused[doc_id] += 1 / (rrf_k + rank)
+            if doc_id not in docs:
+                docs[doc_id] = doc
+            else:
+                # Keep the vector score if the other ranking found it first
+                docs[doc_id].metadata = {**doc.metadata, **docs[doc_id].metadata}
+    ranked = sorted(fused, key=fused.get, reverse=True)[:k]
+    for doc_id in ranked:
+        docs[doc_id].metadata['rrf_score'] = fused[doc_id]
+    return [docs[doc_id] for doc_id in ranked]
@@ -0,0 +1,541 @@
+import asyncio
+import hashlib
+import json
+import re
+import threading
+from concurrent.futures import Future
+from contextlib import aclosing, closing
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from pydantic import ConfigDict
+
+from context_packing import approximate_tokens
+from rate_limit import INTERACTIVE, RateLimiter
+
+# Governor for the Azure OpenAI calls of a process, wrapped around the chat model and the embeddings so every chain
+# built on them shares it:
+#   - one RateLimiter (RPM and TPM token bucket) per deployment, in priority order, so chat turns go ahead of
+#     history summaries and batch jobs. The buckets follow the rate limit headers of every response (see
+#     LLMGovernor.event_hooks), so requests wait locally instead of piling up 429s and retries.
+#   - identical chat requests in flight at the same time (the same rewrite prompt from two tabs) share one call
+#   - query embeddings asked for within `batch_window` seconds of each other are sent as one request, and identical
+#     texts in flight share one vector
+# Every caller still gets its own callbacks (tokens, traces) for the calls it joined.
+
+DEPLOYMENT_PATH = re.compile(r"/deployments/([^/]+)/")
+
+# Raised to the requests that joined a call whose caller went away (closed the stream or was cancelled)
+class AbandonedRequest(Exception):
+    pass
+
+# One call in flight, and what it produced so far: the chunks of a stream, or the single result of a call
+class _Flight:
+    def __init__(self):
+        self.items: List[Any] = []
+        # Requests reading the call besides the caller that made it, and whether that caller still reads it
+        self.followers = 0
+        self.leader = True
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._changed = threading.Condition()
+        self._waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+
+    def publish(self, item: Any = None, done: bool = False, error: Optional[BaseException] = None):
+        with self._changed:
+            if item is not None:
+                self.items.append(item)
+            self.done = self.done or done or error is not None
+            self.error = self.error or error
+            self._changed.notify_all()
+            waiters = list(self._waiters)
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def _next(self, seen: int) -> Tuple[List[Any], bool, Optional[BaseException]]:
+        return self.items[seen:], self.done, self.error
+
+    def add_follower(self):
+        with self._changed:
+            self.followers += 1
+
+    # Nobody reads the call any more, so the rest of it can be given up
+    @property
+    def abandoned(self) -> bool:
+        with self._changed:
+            return not self.leader and not self.followers
+
+    def follow(self) -> Iterator[Any]:
+        seen = 0
+        try:
+            while True:
+                with self._changed:
+                    while len(self.items) == seen and not self.done:
+                        self._changed.wait()
+                    items, done, error = self._next(seen)
+                seen += len(items)
+                yield from items
+                if done:
+                    if error is not None:
+                        raise error
+                    return
+        finally:
+            with self._changed:
+                self.followers -= 1
+
+    # `follower` is False for the caller that made the call (the async stream reads its own call this way)
+    async def afollow(self, follower: bool = True) -> AsyncIterator[Any]:
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        event = waiter[1]
+        with self._changed:
+            self._waiters.append(waiter)
+        seen = 0
+        try:
+            while True:
+                with self._changed:
+                    event.clear()
+                    items, done, error = self._next(seen)
+                if not items and not done:
+                    await event.wait()
+                    continue
+                seen += len(items)
+                for item in items:
+                    yield item
+                if done:
+                    if error is not None:
+                        raise error
+                    return
+        finally:
+            with self._changed:
+                self._waiters.remove(waiter)
+                if follower:
+                    self.followers -= 1
+
+# Calls in flight by request key. The first caller of a key makes the call, later ones follow it until it lands.
+class RequestCoalescer:
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def join(self, key: str) -> Tuple[_Flight, bool]:
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                flight.add_follower()
+                return flight, False
+            self.calls += 1
+            flight = self._flights[key] = _Flight()
+            return flight, True
+
+    def land(self, key: str, flight: _Flight, error: Optional[BaseException] = None):
+        # Later requests with the same key make a new call (finished answers are cached elsewhere)
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.publish(done=True, error=error)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'calls': self.calls, 'coalesced': self.coalesced, 'in_flight': len(self._flights)}
+
+def _request_key(kind: str, params: Dict[str, Any], messages: List[BaseMessage], stop: Optional[List[str]],
+                 kwargs: Dict[str, Any]) -> str:
+    request = [kind, params, [(message.type, message.content) for message in messages], stop, sorted(kwargs.items())]
+    return hashlib.sha256(json.dumps(request, default=str).encode('utf-8')).hexdigest()
+
+# Async streams that carry on for the requests that joined them after their caller went away. The event loop only
+# keeps weak references to tasks.
+_background_streams = set()
+
+def _usage(message: Optional[BaseMessage]) -> Optional[Dict[str, int]]:
+    return getattr(message, 'usage_metadata', None)
+
+# Token usage of a stream: reported on its last chunk when the model is asked for it (stream_usage), otherwise the
+# prompt estimate plus a token per content chunk
+class _StreamUsage:
+    def __init__(self, messages: List[BaseMessage]):
+        self.prompt_tokens = count_tokens_approximately(messages)
+        self.chunks = 0
+        self.reported: Optional[Dict[str, int]] = None
+
+    def add(self, chunk: ChatGenerationChunk):
+        self.reported = _usage(chunk.message) or self.reported
+        if chunk.text:
+            self.chunks += 1
+
+    def total(self) -> Dict[str, int]:
+        return self.reported or {'total_tokens': self.prompt_tokens + self.chunks}
+
+def _copy_chunk(chunk: ChatGenerationChunk) -> ChatGenerationChunk:
+    # Each follower's stream sets its own run id on the chunks it yields
+    return chunk.model_copy(update={'message': chunk.message.model_copy()})
+
+# Chat model wrapper, see LLMGovernor.chat_model(). with_priority() gives a copy with the same limiter and coalescer.
+class GovernedChatModel(BaseChatModel):
+    llm: BaseChatModel
+    limiter: Optional[RateLimiter] = None
+    coalescer: Optional[RequestCoalescer] = None
+    priority: int = INTERACTIVE
+    # Completion tokens counted against the TPM budget when the request sets no max_tokens
+    completion_tokens: int = 500
+    # Asks for the token usage at the end of streams (stream_options, OpenAI models). It is passed on stream calls
+    # only, the API rejects stream_options on calls that don't stream.
+    stream_usage: bool = False
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    @property
+    def _llm_type(self) -> str:
+        return self.llm._llm_type
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return self.llm._identifying_params
+
+    def with_priority(self, priority: int) -> "GovernedChatModel":
+        return self.model_copy(update={'priority': priority})
+
+    def _estimate(self, messages: List[BaseMessage], kwargs: Dict[str, Any]) -> int:
+        completion = kwargs.get('max_tokens') or getattr(self.llm, 'max_tokens', None) or self.completion_tokens
+        return count_tokens_approximately(messages) + completion
+
+    def _stream_kwargs(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        return {**kwargs, 'stream_options': {'include_usage': True}} if self.stream_usage else kwargs
+
+    def _settle(self, estimate: int, usage: Optional[Dict[str, int]]):
+        if self.limiter and usage:
+            self.limiter.refund(estimate - usage['total_tokens'])
+
+    def _join(self, kind: str, messages: List[BaseMessage], stop: Optional[List[str]],
+              kwargs: Dict[str, Any]) -> Tuple[Optional[str], Optional[_Flight], bool]:
+        if self.coalescer is None:
+            return None, None, True
+        key = _request_key(kind, self._identifying_params, messages, stop, kwargs)
+        flight, leader = self.coalescer.join(key)
+        return key, flight, leader
+
+    def _land(self, key: Optional[str], flight: Optional[_Flight], error: Optional[BaseException] = None):
+        if flight is not None:
+            # Followers of a call that was given up on make their own
+            self.coalescer.land(key, flight, error if isinstance(error, Exception) or error is None
+                                else AbandonedRequest())
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        while True:
+            key, flight, leader = self._join('generate', messages, stop, kwargs)
+            if leader:
+                break
+            # Read to the end, so this follower is let go of when the call lands
+            try:
+                return list(flight.follow())[0]
+            except AbandonedRequest:
+                continue
+        try:
+            estimate = self._estimate(messages, kwargs)
+            if self.limiter:
+                self.limiter.acquire(estimate, self.priority)
+            result = self.llm._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        except BaseException as e:
+            self._land(key, flight, e)
+            raise
+        if flight is not None:
+            flight.publish(result)
+        self._land(key, flight)
+        self._settle(estimate, _usage(result.generations[0].message) if result.generations else None)
+        return result
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        while True:
+            key, flight, leader = self._join('generate', messages, stop, kwargs)
+            if leader:
+                break
+            try:
+                return [result async for result in flight.afollow()][0]
+            except AbandonedRequest:
+                continue
+        try:
+            estimate = self._estimate(messages, kwargs)
+            if self.limiter:
+                await self.limiter.aacquire(estimate, self.priority)
+            result = await self.llm._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        except BaseException as e:
+            self._land(key, flight, e)
+            raise
+        if flight is not None:
+            flight.publish(result)
+        self._land(key, flight)
+        self._settle(estimate, _usage(result.generations[0].message) if result.generations else None)
+        return result
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        while True:
+            key, flight, leader = self._join('stream', messages, stop, kwargs)
+            if leader:
+                break
+            streamed = False
+            try:
+                # Closed here rather than when collected, so the call stops being read for this caller straight away
+                with closing(flight.follow()) as chunks:
+                    for chunk in chunks:
+                        chunk = _copy_chunk(chunk)
+                        if run_manager:
+                            run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                        streamed = True
+                        yield chunk
+                return
+            except AbandonedRequest:
+                if streamed:
+                    raise
+        estimate = self._estimate(messages, kwargs)
+        if self.limiter:
+            try:
+                self.limiter.acquire(estimate, self.priority)
+            except BaseException as e:
+                self._land(key, flight, e)
+                raise
+        # Tokens are reported here rather than by the model, so the stream can be finished without this caller
+        stream = self.llm._stream(messages, stop=stop, **self._stream_kwargs(kwargs))
+        usage = _StreamUsage(messages)
+        try:
+            for chunk in stream:
+                usage.add(chunk)
+                if flight is not None:
+                    flight.publish(chunk)
+                if run_manager:
+                    run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+        except GeneratorExit:
+            if flight is not None:
+                flight.leader = False
+            if flight is not None and not flight.abandoned:
+                # This caller stopped reading, the rest of the stream is read on a thread for the ones that joined it
+                threading.Thread(target=self._finish_stream, args=(stream, key, flight, estimate, usage),
+                                 daemon=True).start()
+            else:
+                stream.close()
+                self._land(key, flight, AbandonedRequest())
+            raise
+        except BaseException as e:
+            self._land(key, flight, e)
+            raise
+        self._land(key, flight)
+        self._settle(estimate, usage.total())
+
+    def _finish_stream(self, stream: Iterator[ChatGenerationChunk], key: str, flight: _Flight, estimate: int,
+                       usage: _StreamUsage):
+        try:
+            for chunk in stream:
+                usage.add(chunk)
+                flight.publish(chunk)
+                if flight.abandoned:
+                    # The ones that joined it have stopped reading too, the rest isn't paid for
+                    stream.close()
+                    self._land(key, flight, AbandonedRequest())
+                    return
+        except Exception as e:
+            self._land(key, flight, e)
+            return
+        self._land(key, flight)
+        self._settle(estimate, usage.total())
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        while True:
+            key, flight, leader = self._join('stream', messages, stop, kwargs)
+            if leader:
+                break
+            streamed = False
+            try:
+                async with aclosing(flight.afollow()) as chunks:
+                    async for chunk in chunks:
+                        chunk = _copy_chunk(chunk)
+                        if run_manager:
+                            await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                        streamed = True
+                        yield chunk
+                return
+            except AbandonedRequest:
+                if streamed:
+                    raise
+        estimate = self._estimate(messages, kwargs)
+        if flight is None:
+            if self.limiter:
+                await self.limiter.aacquire(estimate, self.priority)
+            usage = _StreamUsage(messages)
+            async for chunk in self.llm._astream(messages, stop=stop, **self._stream_kwargs(kwargs)):
+                usage.add(chunk)
+                if run_manager:
+                    await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+            self._settle(estimate, usage.total())
+            return
+        # The call runs in its own task and this caller follows it like the others, so the ones that joined it still
+        # get the whole stream when this caller closes the stream or is cancelled
+        task = asyncio.ensure_future(self._publish_stream(messages, stop, kwargs, key, flight, estimate))
+        _background_streams.add(task)
+        task.add_done_callback(_background_streams.discard)
+        try:
+            async with aclosing(flight.afollow(follower=False)) as chunks:
+                async for chunk in chunks:
+                    if run_manager:
+                        await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                    yield chunk
+        finally:
+            flight.leader = False
+            if flight.abandoned:
+                task.cancel()
+
+    async def _publish_stream(self, messages: List[BaseMessage], stop: Optional[List[str]], kwargs: Dict[str, Any],
+                              key: str, flight: _Flight, estimate: int):
+        usage = _StreamUsage(messages)
+        try:
+            if self.limiter:
+                await self.limiter.aacquire(estimate, self.priority)
+            stream = self.llm._astream(messages, stop=stop, **self._stream_kwargs(kwargs))
+            async for chunk in stream:
+                usage.add(chunk)
+                flight.publish(chunk)
+                if flight.abandoned:
+                    # The ones that joined it have stopped reading too, the rest isn't paid for
+                    await stream.aclose()
+                    self._land(key, flight, AbandonedRequest())
+                    return
+        except BaseException as e:
+            # Cancelled when nobody reads it any more
+            self._land(key, flight, e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        self._land(key, flight)
+        self._settle(estimate, usage.total())
+
+# Embeddings wrapper, see LLMGovernor.embeddings(). While another embedding request is out, embed_query() calls are
+# collected for up to `batch_window` seconds (or until `max_batch` texts) by the first caller, which embeds them all
+# with one request. A query with nothing else in flight is sent at once. The async
+# aembed_query() runs embed_query() in the executor, as in the Embeddings base class.
+class GovernedEmbeddings(Embeddings):
+    def __init__(self, embedding: Embeddings, limiter: Optional[RateLimiter] = None, priority: int = INTERACTIVE,
+                 batch_window: float = 0.01, max_batch: int = 16):
+        self.embedding = embedding
+        self.limiter = limiter
+        self.priority = priority
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.requests = 0
+        self.texts = 0
+        self.coalesced = 0
+        self._pending: Dict[str, Future] = {}
+        self._batch: List[str] = []
+        self._full = threading.Event()
+        self._sending = 0
+        self._lock = threading.Lock()
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        if self.limiter:
+            self.limiter.acquire(sum(approximate_tokens(text) for text in texts), self.priority)
+        with self._lock:
+            self.requests += 1
+            self.texts += len(texts)
+        return self.embedding.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        with self._lock:
+            future = self._pending.get(text)
+            if future is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                future = self._pending[text] = Future()
+                self._batch.append(text)
+                leader = len(self._batch) == 1
+                if len(self._batch) >= self.max_batch:
+                    self._full.set()
+                # Other queries are being embedded, so more are likely to arrive within the window
+                busy = self._sending > 0
+        if not leader:
+            return future.result()
+
+        if self.batch_window > 0 and busy:
+            self._full.wait(self.batch_window)
+        with self._lock:
+            batch, self._batch = self._batch, []
+            self._full.clear()
+            self._sending += 1
+        try:
+            vectors = self.embed_documents(batch)
+        except BaseException as e:
+            vectors, error = None, e
+        else:
+            error = None
+        with self._lock:
+            self._sending -= 1
+            futures = [self._pending.pop(text) for text in batch]
+        for n, batch_future in enumerate(futures):
+            if error is not None:
+                batch_future.set_exception(error)
+            else:
+                batch_future.set_result(vectors[n])
+        return future.result()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        # Already a batch: sent as it is, a request (of the embedding's chunk size) at a time through the limiter
+        size = getattr(self.embedding, 'chunk_size', None) or len(texts) or 1
+        return [vector for i in range(0, len(texts), size) for vector in self._embed(texts[i:i + size])]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'requests': self.requests, 'texts': self.texts, 'coalesced': self.coalesced}
+
+# One per process: the limiters of the deployments it calls and the coalescer of their chat requests.
+# `quotas` is {deployment name: (requests per minute, tokens per minute)}, from the deployments' quotas.
+class LLMGovernor:
+    def __init__(self, quotas: Dict[str, Tuple[int, int]], reserve: float = 0.0, coalesce: bool = True,
+                 batch_window: float = 0.01):
+        self.limiters = {deployment: RateLimiter(rpm, tpm, reserve=reserve) for deployment, (rpm, tpm) in quotas.items()}
+        self.coalescer = RequestCoalescer() if coalesce else None
+        self.batch_window = batch_window
+        self._embeddings: List[GovernedEmbeddings] = []
+
+    def chat_model(self, llm: BaseChatModel, deployment: str, priority: int = INTERACTIVE,
+                   stream_usage: bool = False) -> GovernedChatModel:
+        return GovernedChatModel(llm=llm, limiter=self.limiters.get(deployment), coalescer=self.coalescer,
+                                 priority=priority, stream_usage=stream_usage)
+
+    def embeddings(self, embedding: Embeddings, deployment: str, priority: int = INTERACTIVE) -> GovernedEmbeddings:
+        governed = GovernedEmbeddings(embedding, limiter=self.limiters.get(deployment), priority=priority,
+                                      batch_window=self.batch_window,
+                                      max_batch=getattr(embedding, 'chunk_size', None) or 16)
+        self._embeddings.append(governed)
+        return governed
+
+    def on_response(self, response):
+        # httpx response hook: the deployment is in the request path (/openai/deployments/<name>/...)
+        match = DEPLOYMENT_PATH.search(response.request.url.path)
+        limiter = self.limiters.get(match.group(1)) if match else None
+        if limiter:
+            limiter.update_from_headers(response.headers, response.status_code)
+
+    async def aon_response(self, response):
+        self.on_response(response)
+
+    # For httpx.Client(event_hooks=...), and httpx.AsyncClient(event_hooks=...) with async_=True
+    def event_hooks(self, async_: bool = False) -> Dict[str, List[Any]]:
+        return {'response': [self.aon_response if async_ else self.on_response]}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'chat': self.coalescer.stats() if self.coalescer else None,
+            'embeddings': [embedding.stats() for embedding in self._embeddings],
+        }
@@ -0,0 +1,405 @@
+import json
+import os
+import re
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from compression import compress, normalize, truncate
+
+# In-process vector store, a drop-in replacement for the Redis vector store for single node deployments, offline
+# development and as a baseline to benchmark Redis against.
+#
+# The index is a directory holding:
+#   vectors.npy      - L2 normalised embeddings (float32, float16 or int8, optionally truncated), memory-mapped on load
+#   scales.npy       - per-vector scales of int8 vectors
+#   vectors_full.npy - optional full float32 embeddings, used to rescore the top candidates of compressed vectors
+#   documents.jsonl  - one {"id", "content", "metadata"} line per row of vectors.npy
+#   ivf.npz          - optional IVF partitions (k-means centroids and the rows in each partition)
+# Search is an exact top-k with a matrix product, or, when IVF partitions have been built, a matrix product over the
+# rows of the `n_probe` partitions closest to the query. With `rescore`, the top `rescore` candidates are re-ranked on
+# the full float32 vectors. Relevance scores are cosine similarities, as with Redis.
+# The RedisText/RedisNum/RedisTag filter expressions used with the Redis store are evaluated against the metadata.
+# add_texts() and delete() change the store in memory, save() writes it, so a build calls save() once at the end.
+
+VECTORS_FILE = "vectors.npy"
+SCALES_FILE = "scales.npy"
+FULL_VECTORS_FILE = "vectors_full.npy"
+DOCUMENTS_FILE = "documents.jsonl"
+IVF_FILE = "ivf.npz"
+
+# Rows are scored in blocks so a float16 matrix is converted to float32 a block at a time
+BLOCK_SIZE = 65536
+
+def _json_value(value: Any) -> Any:
+    # numpy scalars from pandas dataframes
+    return value.item() if hasattr(value, 'item') else str(value)
+
+def _tokens(value: Any) -> List[str]:
+    # RediSearch TEXT fields are matched case-insensitively on words, ignoring punctuation
+    return re.findall(r"[a-z0-9]+", str(value).lower()) if value is not None else []
+
+def _unescape(value: str) -> str:
+    return re.sub(r"\\(.)", r"\1", value)
+
+def _number(value: str) -> Tuple[float, bool]:
+    # Returns the bound and whether it is exclusive, "(1987" is exclusive
+    return float(value.lstrip("(")), value.startswith("(")
+
+def _numeric(value: Any) -> Optional[float]:
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if number != number else number
+
+def _contains_phrase(tokens: List[str], phrase: List[str]) -> bool:
+    if not phrase:
+        return True
+    return any(tokens[i:i + len(phrase)] == phrase for i in range(len(tokens) - len(phrase) + 1))
+
+def _like(tokens: List[str], pattern: str) -> bool:
+    # "engineer|doctor" matches either term, "engineer doctor" both, "engine*" a prefix and "%%engine%%" a fuzzy match
+    def term(word: str) -> bool:
+        word = word.strip().lower()
+        if word.startswith("%"):
+            word = word.strip("%")
+            return any(word in token for token in tokens)
+        if word.endswith("*"):
+            return any(token.startswith(word[:-1]) for token in tokens)
+        return _contains_phrase(tokens, _tokens(word))
+    return any(all(term(word) for word in alternative.split()) for alternative in _unescape(pattern).split("|"))
+
+_TEXT_EQ = re.compile(r'^@(?P<field>[^:]+):\("(?P<value>.*)"\)$')
+_TEXT_NE = re.compile(r'^\(-@(?P<field>[^:]+):"(?P<value>.*)"\)$')
+_TEXT_LIKE = re.compile(r'^@(?P<field>[^:]+):\((?P<value>.*)\)$')
+_NUM = re.compile(r'^(?P<ne>\(-)?@(?P<field>[^:]+):\[(?P<low>\S+) (?P<high>\S+?)\]\)?$')
+_TAG = re.compile(r'^(?P<ne>\(-)?@(?P<field>[^:]+):\{(?P<value>.*)\}\)?$')
+
+def _compile_leaf(query: str) -> Callable[[Dict[str, Any]], bool]:
+    if query == "*":
+        return lambda metadata: True
+    match = _NUM.match(query)
+    if match:
+        low, low_exclusive = _number(match["low"])
+        high, high_exclusive = _number(match["high"])
+        field, negate = match["field"], bool(match["ne"])
+
+        def in_range(metadata):
+            value = _numeric(metadata.get(field))
+            matches = value is not None and (value > low if low_exclusive else value >= low) \
+                and (value < high if high_exclusive else value <= high)
+            return matches != negate
+        return in_range
+    match = _TAG.match(query)
+    if match:
+        field, negate = match["field"], bool(match["ne"])
+        values = {_unescape(value).strip().lower() for value in re.split(r"(?<!\\)\|", match["value"])}
+        return lambda metadata: bool(
+            {tag.strip().lower() for tag in str(metadata.get(field, "")).split(",")} & values) != negate
+    match = _TEXT_EQ.match(query)
+    if match:
+        field, phrase = match["field"], _tokens(match["value"])
+        return lambda metadata: _contains_phrase(_tokens(metadata.get(field)), phrase)
+    match = _TEXT_NE.match(query)
+    if match:
+        field, phrase = match["field"], _tokens(match["value"])
+        return lambda metadata: not _contains_phrase(_tokens(metadata.get(field)), phrase)
+    match = _TEXT_LIKE.match(query)
+    if match:
+        field, pattern = match["field"], match["value"]
+        return lambda metadata: _like(_tokens(metadata.get(field)), pattern)
+    raise ValueError(f"Unsupported filter for the local vector store: {query}")
+
+# Compiles a RedisFilterExpression into a predicate over a document's metadata
+def compile_filter(expression) -> Callable[[Dict[str, Any]], bool]:
+    from langchain_community.vectorstores.redis.filters import RedisFilterOperator
+
+    if expression._operator is None:
+        return _compile_leaf(expression._filter)
+    left, right = compile_filter(expression._left), compile_filter(expression._right)
+    if expression._operator == RedisFilterOperator.OR:
+        return lambda metadata: left(metadata) or right(metadata)
+    return lambda metadata: left(metadata) and right(metadata)
+
+class LocalVectorStore(VectorStore):
+    def __init__(self, embedding: Embeddings, path: str = "local_index", dtype: str = "float32", dims: Optional[int] = None,
+                 keep_full: bool = False, n_probe: int = 8, rescore: int = 0, max_cached_filters: int = 128):
+        self._embedding = embedding
+        self.path = path
+        self.n_probe = n_probe
+        self.rescore = rescore
+        self.max_cached_filters = max_cached_filters
+        self.clear(dtype=dtype, dims=dims, keep_full=keep_full)
+        if os.path.exists(os.path.join(path, VECTORS_FILE)):
+            self.load()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    # Empties the store (in memory, until the next save) and sets how new vectors are stored
+    def clear(self, dtype: str = "float32", dims: Optional[int] = None, keep_full: bool = False):
+        self.dtype = np.dtype(dtype)
+        self.dims = dims
+        self.keep_full = keep_full
+        self.ids: List[str] = []
+        self.contents: List[str] = []
+        self.metadatas: List[Dict[str, Any]] = []
+        self.rows: Dict[str, int] = {}
+        self.vectors = np.zeros((0, 0), dtype=self.dtype)
+        self.scales: Optional[np.ndarray] = None
+        self.full: Optional[np.ndarray] = None
+        self.ivf: Optional[Dict[str, np.ndarray]] = None
+        self._buffers: Dict[str, np.ndarray] = {}
+        # Row masks of recently used filters, a filter is evaluated against every document's metadata once
+        self._filter_masks: "OrderedDict[str, np.ndarray]" = OrderedDict()
+
+    # (dtype, stored dimensions, whether full vectors are kept for rescoring)
+    def compression(self) -> Tuple[str, Optional[int], bool]:
+        return self.dtype.name, self.vectors.shape[1] if self.ids else self.dims, self.full is not None if self.ids else self.keep_full
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def load(self):
+        self.vectors = np.load(self._file(VECTORS_FILE), mmap_mode="r")
+        self.dtype = self.vectors.dtype
+        self.dims = self.vectors.shape[1]
+        self.scales = np.load(self._file(SCALES_FILE)) if os.path.exists(self._file(SCALES_FILE)) else None
+        self.full = np.load(self._file(FULL_VECTORS_FILE), mmap_mode="r") if os.path.exists(self._file(FULL_VECTORS_FILE)) else None
+        self.keep_full = self.full is not None
+        self.ids, self.contents, self.metadatas = [], [], []
+        with open(self._file(DOCUMENTS_FILE), encoding="utf-8") as f:
+            for line in f:
+                row = json.loads(line)
+                self.ids.append(row["id"])
+                self.contents.append(row["content"])
+                self.metadatas.append(row["metadata"])
+        self.rows = {id: row for row, id in enumerate(self.ids)}
+        self.ivf = dict(np.load(self._file(IVF_FILE))) if os.path.exists(self._file(IVF_FILE)) else None
+        self._filter_masks.clear()
+
+    def _save_array(self, name: str, array: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        # Written to a temporary file and renamed, so a running app never sees a half written index
+        if array is None:
+            if os.path.exists(self._file(name)):
+                os.remove(self._file(name))
+            return None
+        np.save(self._file(name + ".tmp.npy"), np.ascontiguousarray(array))
+        os.replace(self._file(name + ".tmp.npy"), self._file(name))
+        return np.load(self._file(name), mmap_mode="r")
+
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        documents_tmp = self._file(DOCUMENTS_FILE + ".tmp")
+        with open(documents_tmp, "w", encoding="utf-8") as f:
+            for id, content, metadata in zip(self.ids, self.contents, self.metadatas):
+                f.write(json.dumps({"id": id, "content": content, "metadata": metadata}, default=_json_value) + "\n")
+        self.vectors = self._save_array(VECTORS_FILE, self.vectors)
+        self._save_array(SCALES_FILE, self.scales)
+        self.scales = np.asarray(self.scales) if self.scales is not None else None
+        self.full = self._save_array(FULL_VECTORS_FILE, self.full)
+        self._buffers.clear()
+        os.replace(documents_tmp, self._file(DOCUMENTS_FILE))
+        if self.ivf is not None:
+            np.savez(self._file(IVF_FILE), **self.ivf)
+        elif os.path.exists(self._file(IVF_FILE)):
+            os.remove(self._file(IVF_FILE))
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+                  embeddings: Optional[List[List[float]]] = None, keys: Optional[List[str]] = None,
+                  **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        keys = [str(key) for key in keys] if keys else [str(len(self.ids) + i) for i in range(len(texts))]
+        if embeddings is None:
+            embeddings = self._embedding.embed_documents(texts)
+        full = normalize(np.asarray(embeddings, dtype=np.float32))
+        stored, scales = compress(full, self.dtype.name, self.dims)
+
+        if not self.ids:
+            self.vectors = np.zeros((0, stored.shape[1]), dtype=self.dtype)
+            self.scales = np.zeros(0, dtype=np.float32) if scales is not None else None
+            self.full = np.zeros((0, full.shape[1]), dtype=np.float32) if self.keep_full else None
+        appended, replaced, rows = [], [], []
+        for i, (key, text, metadata) in enumerate(zip(keys, texts, metadatas)):
+            # Keys are movie ids, so adding an existing movie replaces it in place
+            row = self.rows.get(key)
+            if row is None:
+                self.rows[key] = len(self.ids)
+                self.ids.append(key)
+                self.contents.append(text)
+                self.metadatas.append(dict(metadata))
+                appended.append(i)
+                continue
+            self.contents[row] = text
+            self.metadatas[row] = dict(metadata)
+            replaced.append(i)
+            rows.append(row)
+        self.vectors = self._append('vectors', stored[appended])
+        self.scales = self._append('scales', scales[appended]) if self.scales is not None else None
+        self.full = self._append('full', full[appended]) if self.full is not None else None
+        if replaced:
+            self.vectors[rows] = stored[replaced]
+            if self.scales is not None:
+                self.scales[rows] = scales[replaced]
+            if self.full is not None:
+                self.full[rows] = full[replaced]
+        # Partitions no longer cover every row, rebuild them with build_ivf()
+        self.ivf = None
+        self._filter_masks.clear()
+        return keys
+
+    def _append(self, name: str, rows: np.ndarray) -> np.ndarray:
+        # The arrays are views of buffers with spare rows, so repeated adds copy the index only when a buffer doubles.
+        # Loaded (read-only, memory-mapped) arrays are copied into a buffer on the first add.
+        current = getattr(self, name)
+        buffer = self._buffers.get(name)
+        size = len(current) + len(rows)
+        if buffer is None or current.base is not buffer or len(buffer) < size:
+            buffer = np.empty((max(2 * size, 1024),) + current.shape[1:], dtype=current.dtype)
+            buffer[:len(current)] = current
+            self._buffers[name] = buffer
+        buffer[len(current):size] = rows
+        return buffer[:size]
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        # Accepts movie ids or Redis style "doc:movieindex:<id>" keys
+        remove = {str(id).split(":")[-1] for id in ids or []}
+        keep = [row for row, id in enumerate(self.ids) if id not in remove]
+        self.vectors = np.array(self.vectors[keep])
+        self.scales = np.array(self.scales[keep]) if self.scales is not None else None
+        self.full = np.array(self.full[keep]) if self.full is not None else None
+        self.ids = [self.ids[row] for row in keep]
+        self.contents = [self.contents[row] for row in keep]
+        self.metadatas = [self.metadatas[row] for row in keep]
+        self.rows = {id: row for row, id in enumerate(self.ids)}
+        self.ivf = None
+        self._filter_masks.clear()
+        return True
+
+    def _block(self, rows) -> np.ndarray:
+        # Stored vectors as float32, int8 codes are scaled back
+        block = np.asarray(self.vectors[rows], dtype=np.float32)
+        if self.scales is not None:
+            block *= self.scales[rows][:, None]
+        return block
+
+    # Spherical k-means over the normalised vectors, trained on a sample of the rows
+    def build_ivf(self, n_lists: Optional[int] = None, iterations: int = 10, sample_size: int = 50000, seed: int = 0):
+        n = len(self.ids)
+        n_lists = n_lists or max(1, int(np.sqrt(n)))
+        rng = np.random.default_rng(seed)
+        sample = self._block(np.sort(rng.choice(n, size=min(n, sample_size), replace=False)))
+        centroids = sample[rng.choice(len(sample), size=min(n_lists, len(sample)), replace=False)]
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            for list_id in range(len(centroids)):
+                members = sample[assignments == list_id]
+                if len(members):
+                    centroids[list_id] = members.mean(axis=0)
+            centroids = normalize(centroids)
+
+        assignments = np.concatenate([
+            np.argmax(self._block(slice(start, start + BLOCK_SIZE)) @ centroids.T, axis=1)
+            for start in range(0, n, BLOCK_SIZE)])
+        order = np.argsort(assignments, kind="stable")
+        offsets = np.searchsorted(assignments[order], np.arange(len(centroids) + 1))
+        self.ivf = {"centroids": centroids, "order": order, "offsets": offsets}
+        np.savez(self._file(IVF_FILE), **self.ivf)
+
+    def _filter_mask(self, filter) -> np.ndarray:
+        key = str(filter)
+        mask = self._filter_masks.get(key)
+        if mask is None:
+            predicate = compile_filter(filter)
+            mask = np.fromiter((predicate(metadata) for metadata in self.metadatas), dtype=bool, count=len(self.metadatas))
+            self._filter_masks[key] = mask
+            if len(self._filter_masks) > self.max_cached_filters:
+                self._filter_masks.popitem(last=False)
+        else:
+            self._filter_masks.move_to_end(key)
+        return mask
+
+    def _candidates(self, query: np.ndarray) -> Optional[np.ndarray]:
+        if self.ivf is None:
+            return None
+        centroid_scores = self.ivf["centroids"] @ query
+        lists = np.argsort(-centroid_scores)[:self.n_probe]
+        offsets, order = self.ivf["offsets"], self.ivf["order"]
+        return np.sort(np.concatenate([order[offsets[list_id]:offsets[list_id + 1]] for list_id in lists]))
+
+    def _score(self, query: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        if rows is not None:
+            return self._block(rows) @ query
+        return np.concatenate([
+            self._block(slice(start, start + BLOCK_SIZE)) @ query
+            for start in range(0, len(self.ids), BLOCK_SIZE)]) if self.ids else np.zeros(0, dtype=np.float32)
+
+    @staticmethod
+    def _top(scores: np.ndarray, k: int) -> np.ndarray:
+        top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+        return top[np.argsort(-scores[top])]
+
+    def search_by_vector(self, embedding: List[float], k: int = 4, filter=None) -> List[Tuple[int, float]]:
+        full_query = normalize(np.asarray(embedding, dtype=np.float32))
+        query = truncate(full_query, self.vectors.shape[1]) if self.ids else full_query
+        mask = self._filter_mask(filter) if filter is not None else None
+        rows = self._candidates(query)
+        if rows is not None and mask is not None:
+            rows = rows[mask[rows]]
+        # Too few rows in the probed partitions pass the filter, fall back to an exact search
+        if rows is not None and len(rows) < k:
+            rows = None
+        if rows is None and mask is not None:
+            rows = np.flatnonzero(mask)
+        scores = self._score(query, rows)
+        if len(scores) == 0:
+            return []
+        rescore = self.rescore if self.full is not None else 0
+        top = self._top(scores, max(k, rescore))
+        top_rows = rows[top] if rows is not None else top
+        if rescore:
+            scores = np.asarray(self.full[np.sort(top_rows)], dtype=np.float32) @ full_query
+            top_rows = np.sort(top_rows)
+            top = self._top(scores, k)
+            return [(int(top_rows[i]), float(scores[i])) for i in top]
+        return [(int(row), float(scores[i])) for row, i in zip(top_rows, top)][:k]
+
+    def _document(self, row: int) -> Document:
+        return Document(page_content=self.contents[row], metadata={**self.metadatas[row], "id": self.ids[row]})
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter=None, **kwargs: Any) -> List[Tuple[Document, float]]:
+        # Scores are cosine distances, as returned by the Redis vector store
+        return [(self._document(row), 1 - score)
+                for row, score in self.search_by_vector(self._embedding.embed_query(query), k=k, filter=filter)]
+
+    def similarity_search(self, query: str, k: int = 4, filter=None, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, filter=filter)]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, filter=None, **kwargs: Any) -> List[Document]:
+        return [self._document(row) for row, _ in self.search_by_vector(embedding, k=k, filter=filter)]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        return lambda distance: 1 - distance
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   path: str = "local_index", dtype: str = "float32", keys: Optional[List[str]] = None,
+                   **kwargs: Any) -> "LocalVectorStore":
+        store = cls(embedding, path=path, dtype=dtype, **kwargs)
+        store.add_texts(texts, metadatas, keys=keys)
+        store.save()
+        return store
+
+    @classmethod
+    def from_existing_index(cls, embedding: Embeddings, path: str = "local_index", n_probe: int = 8,
+                            rescore: int = 0) -> "LocalVectorStore":
+        if not os.path.exists(os.path.join(path, VECTORS_FILE)):
+            raise FileNotFoundError(f"The local vector index '{path}' was not found. Run create-local-index.py first to create it.")
+        return cls(embedding, path=path, n_probe=n_probe, rescore=rescore)
@@ -0,0 +1,307 @@
+import re
+from collections import Counter, defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from langchain_core.documents import Document
+from langchain_community.vectorstores.redis.filters import RedisFilterExpression, RedisNum, RedisText
+
+from context_packing import STOP_WORDS
+from preprocessing import MIN_YEAR, ORIGINS
+
+# Structured query path for exact metadata lookups ("movies released in 1987", "which movies did both Tom Cruise and
+# Jamie Foxx star in", "what years has Tom Cruise been in movies"). Constraints on year, cast, director, genre and origin
+# are parsed out of the (rewritten) question and looked up directly, without an embedding call.
+
+MAX_YEAR = 2100
+
+# Words that only describe the lookup itself. Anything left in the question once these, the stop words and the parsed
+# constraints are removed is treated as a plot or theme description, which needs vector search.
+QUERY_WORDS = {
+    'year', 'years', 'decade', 'released', 'release', 'releases', 'come', 'came', 'out', 'made', 'make', 'new', 'old',
+    'starring', 'stars', 'acted', 'acting', 'act', 'appear', 'appeared', 'appears', 'appearing', 'played', 'play',
+    'plays', 'feature', 'features', 'featured', 'featuring', 'actor', 'actors', 'actress', 'actresses', 'cast',
+    'director', 'directors', 'directed', 'direct', 'directing', 'by', 'genre', 'genres', 'both', 'all', 'list', 'every',
+    'many', 'how', 'between', 'before', 'after', 'since', 'until', 'till', 'during', 'from', 'together', 'same',
+    'he', 'she', 'they', 'has', 'had', 'have', 'name', 'names', 'give', 'please', 'can', 'you', 'i', 'want', 'were',
+    'there', 'also', 'each', 'other', 'only', 'not', 'than', 'into', 'all', 'his', 'her', 'ones', 'title', 'titles',
+    'early', 'late', 'mid', 'latest', 'recent', 'recently', 'eighties', 'nineties', 'seventies', 'noughties',
+}
+
+# Clauses starting with these words describe the plot ("comedies about a family road trip"), so genres and origins
+# are only parsed before them
+PLOT_MARKERS = {'about', 'where', 'involving', 'whose'}
+
+DECADE_WORDS = {'seventies': 1970, 'eighties': 1980, 'nineties': 1990, 'noughties': 2000}
+
+# Genres recognised when movie_list.csv isn't available to build the vocabulary from
+DEFAULT_GENRES = [
+    'action', 'adventure', 'animation', 'biography', 'comedy', 'crime', 'documentary', 'drama', 'family', 'fantasy',
+    'horror', 'musical', 'mystery', 'romance', 'romantic comedy', 'science fiction', 'sci-fi', 'sports', 'thriller',
+    'war', 'western',
+]
+
+# Genres must appear at least this many times in movie_list.csv to be recognised, which filters out one-off labels
+MIN_GENRE_COUNT = 20
+
+def _words(text: str) -> List[str]:
+    return re.findall(r"[a-z0-9']+", text.lower())
+
+def _key(text: str) -> str:
+    return " ".join(_words(text))
+
+def _singular(word: str) -> str:
+    if word.endswith('ies') and len(word) > 4:
+        return word[:-3] + 'y'
+    if word.endswith('s') and not word.endswith('ss') and len(word) > 3:
+        return word[:-1]
+    return word
+
+def _text(value: Any) -> str:
+    # Missing values come back from pandas as NaN floats
+    return value if isinstance(value, str) else ''
+
+def split_names(value: Any) -> List[str]:
+    return [name.strip() for name in re.split(r',|;|/|\band\b|\n', _text(value)) if name.strip()]
+
+def split_genres(value: Any) -> List[str]:
+    return [genre.strip().lower() for genre in re.split(r',|;|/|\n', _text(value)) if genre.strip()]
+
+class MovieConstraints:
+    def __init__(self):
+        self.year_ranges: List[Tuple[int, int]] = []
+        self.cast: List[str] = []
+        self.directors: List[str] = []
+        self.genres: List[str] = []
+        self.origins: List[str] = []
+        # Words left over once the constraints are removed, i.e. what the question says about plot or theme
+        self.plot_terms: List[str] = []
+
+    def __bool__(self) -> bool:
+        return bool(self.year_ranges or self.cast or self.directors or self.genres or self.origins)
+
+    @property
+    def is_lookup(self) -> bool:
+        return bool(self) and not self.plot_terms
+
+    def __repr__(self) -> str:
+        parts = [f"{name}={value}" for name, value in (
+            ('years', self.year_ranges), ('cast', self.cast), ('directors', self.directors), ('genres', self.genres),
+            ('origins', self.origins), ('plot', self.plot_terms)) if value]
+        return f"MovieConstraints({', '.join(parts)})"
+
+# Parses metadata constraints out of a question. Cast and director names are matched against the names that appear in
+# movie_list.csv (longest match first), so a name is only recognised if some movie in the index has it.
+class ConstraintParser:
+    def __init__(self, cast: Iterable[str] = (), directors: Iterable[str] = (), genres: Iterable[str] = DEFAULT_GENRES,
+                 origins: Iterable[str] = ORIGINS):
+        self.cast = {_key(name): name for name in cast}
+        self.directors = {_key(name): name for name in directors}
+        self.genres = {_key(genre): genre for genre in genres}
+        self.origins = {_key(origin): origin for origin in origins}
+        self.max_words = max([len(key.split()) for key in [*self.cast, *self.directors, *self.genres]] + [1])
+
+    @classmethod
+    def from_movies(cls, movies: Dict[str, Tuple[str, Dict[str, Any]]]) -> "ConstraintParser":
+        cast, directors, genres = set(), set(), Counter()
+        for _, metadata in movies.values():
+            cast.update(split_names(metadata.get('Cast')))
+            directors.update(split_names(metadata.get('Director')))
+            genres.update(split_genres(metadata.get('Genre')))
+        genres = [genre for genre, count in genres.items() if count >= MIN_GENRE_COUNT and genre != 'unknown']
+        return cls(cast=cast, directors=directors, genres=genres or DEFAULT_GENRES)
+
+    def parse_years(self, question: str) -> Tuple[List[Tuple[int, int]], Set[str]]:
+        text = question.lower()
+        ranges, used = [], set()
+        year = r"(1[89]\d\d|20\d\d)"
+
+        for match in re.finditer(rf"\b(?:between|from)\s+{year}\s+(?:and|to|-)\s+{year}\b|\b{year}\s*(?:-|to)\s*{year}\b", text):
+            start, end = [int(value) for value in match.groups() if value]
+            ranges.append((min(start, end), max(start, end)))
+            used.update(match.group(0).split())
+        text = re.sub(rf"\b(?:between|from)\s+{year}\s+(?:and|to|-)\s+{year}\b|\b{year}\s*(?:-|to)\s*{year}\b", " ", text)
+
+        for match in re.finditer(rf"\b(before|until|till|after|since)\s+{year}\b", text):
+            value = int(match.group(2))
+            if match.group(1) in ('before', 'until', 'till'):
+                ranges.append((MIN_YEAR, value - 1 if match.group(1) == 'before' else value))
+            else:
+                ranges.append((value + 1 if match.group(1) == 'after' else value, MAX_YEAR))
+            used.update(match.group(0).split())
+        text = re.sub(rf"\b(before|until|till|after|since)\s+{year}\b", " ", text)
+
+        for match in re.finditer(r"\b(1[89]\d|20\d)0'?s\b|\b'?(\d)0'?s\b", text):
+            decade = int(match.group(1)) * 10 if match.group(1) else (1900 if int(match.group(2)) >= 2 else 2000) + int(match.group(2)) * 10
+            ranges.append((decade, decade + 9))
+            used.add(match.group(0))
+        for word, decade in DECADE_WORDS.items():
+            if re.search(rf"\b{word}\b", text):
+                ranges.append((decade, decade + 9))
+        text = re.sub(r"\b(1[89]\d|20\d)0'?s\b|\b'?(\d)0'?s\b", " ", text)
+
+        for match in re.finditer(rf"\b{year}\b", text):
+            ranges.append((int(match.group(1)), int(match.group(1))))
+            used.add(match.group(1))
+        return ranges, used
+
+    def parse(self, question: str) -> MovieConstraints:
+        constraints = MovieConstraints()
+        constraints.year_ranges, year_words = self.parse_years(question)
+
+        tokens = [(match.group(0).lower(), match.group(0)[0].isupper(), match.start())
+                  for match in re.finditer(r"[A-Za-z0-9']+", question)]
+        words = [word for word, _, _ in tokens]
+        plot_start = next((i for i, word in enumerate(words) if word in PLOT_MARKERS), len(words))
+        directing = any(word.startswith('direct') for word in words)
+
+        used = set()
+        i = 0
+        while i < len(words):
+            for n in range(min(self.max_words, len(words) - i), 0, -1):
+                key = " ".join(words[i:i + n])
+                # A single word only counts as a name when it is capitalised and doesn't start the question
+                is_name = n > 1 or (tokens[i][1] and i > 0 and key not in STOP_WORDS and key not in QUERY_WORDS)
+                if is_name and key in self.directors and (directing or key not in self.cast):
+                    constraints.directors.append(self.directors[key])
+                elif is_name and key in self.cast:
+                    constraints.cast.append(self.cast[key])
+                elif i < plot_start and " ".join(words[i:i + n - 1] + [_singular(words[i + n - 1])]) in self.genres:
+                    constraints.genres.append(self.genres[" ".join(words[i:i + n - 1] + [_singular(words[i + n - 1])])])
+                elif i < plot_start and n == 1 and key in self.origins:
+                    constraints.origins.append(self.origins[key])
+                else:
+                    continue
+                used.update(range(i, i + n))
+                i += n
+                break
+            else:
+                i += 1
+
+        constraints.plot_terms = [
+            word for i, word in enumerate(words)
+            if i not in used and word not in year_words and word not in STOP_WORDS and word not in QUERY_WORDS
+            and word not in PLOT_MARKERS and not word.isdigit() and not re.fullmatch(r"'?\d0'?s", word)
+        ]
+        return constraints
+
+# Filter expression for the `movieindex` schema (year NUMERIC, Cast/Director/Genre/origin TEXT). Used both for
+# structured lookups and to restrict vector search when the question also describes a plot.
+def redis_filter(constraints: MovieConstraints) -> Optional[RedisFilterExpression]:
+    expression = None
+
+    def both(a, b):
+        return b if a is None else a & b
+
+    if constraints.year_ranges:
+        years = None
+        for start, end in constraints.year_ranges:
+            year_range = (RedisNum("year") >= start) & (RedisNum("year") <= end)
+            years = year_range if years is None else years | year_range
+        expression = both(expression, years)
+    for field, values in (("Cast", constraints.cast), ("Director", constraints.directors),
+                          ("Genre", constraints.genres), ("origin", constraints.origins)):
+        for value in values:
+            expression = both(expression, RedisText(field) == value)
+    return expression
+
+# Field schema of the `movieindex` metadata, as LangChain generates it from the first document's metadata (numbers
+# NUMERIC, strings TEXT) except that `year` is SORTABLE, for RedisMetadataIndex.search to order lookups by
+def movie_index_schema(metadata: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+    schema = {'text': [], 'numeric': [], 'tag': []}
+    for name, value in metadata.items():
+        try:
+            int(value)
+            schema['numeric'].append({'name': name, 'sortable': True} if name == 'year' else {'name': name})
+        except (ValueError, TypeError):
+            if isinstance(value, str):
+                schema['text'].append({'name': name})
+    return schema
+
+def _lookup_document(doc_id: str, plot: str, metadata: Dict[str, Any]) -> Document:
+    # Exact matches get a perfect score and are marked so the context packer keeps their plots short
+    return Document(page_content=_text(plot), metadata={**metadata, 'id': doc_id, 'score': 1.0, 'match': 'lookup'})
+
+def _sort_key(doc: Document):
+    return (doc.metadata.get('year') or 0, str(doc.metadata.get('Title', '')))
+
+def _first(docs: List[Document], total: int, limit: int) -> List[Document]:
+    # Both indexes return the first `limit` matches in _sort_key order. Each document records how many movies matched,
+    # so the context packer can say the list was cut off.
+    docs = sorted(docs, key=_sort_key)[:limit]
+    for doc in docs:
+        doc.metadata['matches'] = total
+    return docs
+
+# Structured lookups against the RediSearch `movieindex`
+class RedisMetadataIndex:
+    METADATA_FIELDS = ['Title', 'year', 'Director', 'Cast', 'Genre', 'origin']
+
+    def __init__(self, client, index_name: str = "movieindex"):
+        self.client = client
+        self.index_name = index_name
+
+    def _search(self, query: str, limit: int):
+        from redis.commands.search.query import Query
+
+        query = (Query(query).return_fields(*self.METADATA_FIELDS, 'content').sort_by('year').paging(0, limit)
+                 .dialect(2))
+        result = self.client.ft(self.index_name).search(query)
+        docs = []
+        for row in result.docs:
+            metadata = {field: getattr(row, field) for field in self.METADATA_FIELDS if hasattr(row, field)}
+            if 'year' in metadata:
+                metadata['year'] = int(float(metadata['year']))
+            # Keys are "doc:movieindex:<movie id>"
+            docs.append(_lookup_document(row.id.split(':')[-1], getattr(row, 'content', ''), metadata))
+        return docs, result.total
+
+    def search(self, constraints: MovieConstraints, limit: int = 50) -> List[Document]:
+        query = str(redis_filter(constraints))
+        docs, total = self._search(query, limit)
+        if total > len(docs) and docs:
+            # RediSearch only orders by year, so the movies of the last year on the page are fetched in full and
+            # ordered by title as well, giving the same first `limit` movies as the local index
+            year = docs[-1].metadata['year']
+            ties, _ = self._search(f"({query}) @year:[{year} {year}]", total)
+            docs = [doc for doc in docs if doc.metadata['year'] < year] + ties
+        return _first(docs, total, limit)
+
+# In-memory inverted index built from movie_list.csv, used when RediSearch is unavailable (or METADATA_QUERY=local)
+class LocalMetadataIndex:
+    def __init__(self, movies: Dict[str, Tuple[str, Dict[str, Any]]]):
+        self.movies = movies
+        self.postings: Dict[str, Dict[str, Set[str]]] = {field: defaultdict(set) for field in ('Cast', 'Director', 'Genre', 'origin')}
+        self.years: Dict[int, Set[str]] = defaultdict(set)
+        for doc_id, (_, metadata) in movies.items():
+            for name in split_names(metadata.get('Cast')):
+                self.postings['Cast'][_key(name)].add(doc_id)
+            for name in split_names(metadata.get('Director')):
+                self.postings['Director'][_key(name)].add(doc_id)
+            for genre in split_genres(metadata.get('Genre')):
+                self.postings['Genre'][_key(genre)].add(doc_id)
+                # "romantic comedy" is also a comedy, as it is for a RediSearch TEXT match
+                for word in _words(genre):
+                    self.postings['Genre'][word].add(doc_id)
+            self.postings['origin'][_key(_text(metadata.get('origin')))].add(doc_id)
+            if metadata.get('year') == metadata.get('year'):
+                self.years[int(metadata['year'])].add(doc_id)
+
+    def match(self, constraints: MovieConstraints) -> Set[str]:
+        matches = None
+
+        def narrow(ids: Set[str]):
+            nonlocal matches
+            matches = set(ids) if matches is None else matches & ids
+
+        if constraints.year_ranges:
+            narrow({doc_id for year, ids in self.years.items()
+                    if any(start <= year <= end for start, end in constraints.year_ranges) for doc_id in ids})
+        for field, values in (("Cast", constraints.cast), ("Director", constraints.directors),
+                              ("Genre", constraints.genres), ("origin", constraints.origins)):
+            for value in values:
+                narrow(self.postings[field].get(_key(value), set()))
+        return matches or set()
+
+    def search(self, constraints: MovieConstraints, limit: int = 50) -> List[Document]:
+        docs = [_lookup_document(doc_id, *self.movies[doc_id]) for doc_id in self.match(constraints)]
+        return _first(docs, len(docs), limit)
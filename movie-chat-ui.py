@@ -1,26 +1,14 @@
 import os
-import time
-from typing import List
+import uuid
+from typing import Any, List, NamedTuple
 from dotenv import load_dotenv
 
-from langchain_openai import AzureOpenAIEmbeddings
-from langchain_community.vectorstores import Redis as RedisVectorStore
-from langchain_openai import AzureChatOpenAI
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
-from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, trim_messages
-from langchain_core.messages.utils import count_tokens_approximately
-from langchain_core.runnables import Runnable
-from langchain.chains import create_history_aware_retriever
-from langchain_core.prompts import MessagesPlaceholder
-from langchain.chains import create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
-
-import debugging as debugging
+from startup import Background, StartupTimer, warm_connections, warm_tokenizer
 
 import streamlit as st
 
+# LangChain and the app modules are imported in setup_app(), on a background thread (see STARTUP_MODE)
+
 @st.cache_resource
 def load_env():
     load_dotenv()
@@ -34,9 +22,13 @@ def get_system_prompt():
         "{context}"
     )
 
-def display_answer(answer):
+def display_answer(answer) -> str:
+    # answer is either the full answer or an iterator of answer tokens, which are rendered as they arrive
     with st.chat_message("assistant"):
-        st.write(answer)
+        if isinstance(answer, str):
+            st.write(answer)
+            return answer
+        return st.write_stream(answer)
 
 def display_question(message):
     with st.chat_message("user"):
@@ -51,91 +43,271 @@ def contextualize_q_system_prompt():
         "just reformulate it if needed and otherwise return it as is."
     )
 
-@st.cache_resource
-def setup_rag_chain(api_key, resource_endpoint, deployment_name, redis_endpoint, redis_password):
-    contextualize_q_prompt = ChatPromptTemplate.from_messages(
-    [
-        ("system", contextualize_q_system_prompt()),
-        MessagesPlaceholder("chat_history"),
-        ("human", "{input}"),
-    ]
-    )
+def setup_query_embedding(api_key, resource_endpoint, deployment_name, redis_endpoint, redis_password, http_client,
+                          governor):
+    from langchain_openai import AzureOpenAIEmbeddings
+    from query_embedding_cache import QueryEmbeddingCache
 
     # we will use Azure OpenAI as our embeddings provider
-    embedding = AzureOpenAIEmbeddings(
+    embedding = governor.embeddings(AzureOpenAIEmbeddings(
         azure_endpoint=resource_endpoint,
         azure_deployment=deployment_name,
         openai_api_key=api_key,
         openai_api_version='2024-03-01-preview',
-        chunk_size=16)
-
-    # name of the Redis search index to create
-    index_name = "movieindex"
+        chunk_size=16,
+        http_client=http_client), deployment_name)
 
-    # create a connection string for the Redis Vector Store. Uses Redis-py format: https://redis-py.readthedocs.io/en/stable/connections.html#redis.Redis.from_url
     # This example assumes TLS is enabled. If not, use "redis://" instead of "rediss://
-    redis_url = "rediss://:" + redis_password + "@"+ redis_endpoint
+    # (with the local vector store, query embeddings are only cached in-process)
+    redis_url = "rediss://:" + redis_password + "@"+ redis_endpoint if os.getenv('VECTOR_STORE', 'redis') == 'redis' else None
 
-    vectorstore = RedisVectorStore.from_existing_index(
+    # cache query embeddings in-process and in Redis so repeated questions skip the embedding call across all replicas
+    return QueryEmbeddingCache(
         embedding=embedding,
+        deployment=deployment_name,
         redis_url=redis_url,
-        index_name=index_name,
-        schema="redis_schema.yaml"
-    )
+        max_size=int(os.getenv('QUERY_CACHE_SIZE', '1024')),
+        ttl=int(os.getenv('QUERY_CACHE_TTL', '86400')))
+
+def setup_llm(api_key, resource_endpoint, http_client, governor):
+    from langchain_openai import AzureChatOpenAI
 
     # Initialize the LLM
-    llm = AzureChatOpenAI(
+    return governor.chat_model(AzureChatOpenAI(
         azure_endpoint=resource_endpoint,
         azure_deployment='gpt-4o-mini',
         api_key=api_key,
-        openai_api_version="2024-09-01-preview"
-    )
+        openai_api_version="2024-09-01-preview",
+        http_client=http_client
+    ), 'gpt-4o-mini', stream_usage=True)
+
+# One rate limit per deployment, shared by all browser sessions of this process and kept in step with the rate limit
+# headers of the responses. Identical requests in flight share one call, concurrent query embeddings are sent together
+# (see llm_governor.py).
+def setup_governor(deployment_name):
+    from llm_governor import LLMGovernor
+
+    return LLMGovernor(
+        {deployment_name: (int(os.getenv('EMBEDDING_RPM', '300')), int(os.getenv('EMBEDDING_TPM', '350000'))),
+         'gpt-4o-mini': (int(os.getenv('LLM_RPM', '1500')), int(os.getenv('LLM_TPM', '250000')))},
+        reserve=float(os.getenv('RATE_LIMIT_RESERVE', '0.2')),
+        coalesce=os.getenv('LLM_COALESCE', '1') == '1',
+        batch_window=float(os.getenv('EMBEDDING_BATCH_WINDOW_MS', '10')) / 1000)
+
+def setup_rag_chain(timer, query_embedding, llm, redis_endpoint, redis_password):
+    with timer.phase('import langchain'):
+        from langchain_community.vectorstores import Redis as RedisVectorStore
+        from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+    with timer.phase('import app modules'):
+        from answer_cache import SemanticAnswerCache
+        from chains import build_rag_chain
+        from chunking import load_chunk_index
+        from compression import TruncatedEmbeddings
+        from context_packing import ContextPacker
+        from local_vectorstore import LocalVectorStore
+        from retrievers import create_retriever
 
-    retriever = vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": 10})
-
-    history_aware_retriever = create_history_aware_retriever(
-        llm, retriever, contextualize_q_prompt
-    )
-
-    qa_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", get_system_prompt()),
-            MessagesPlaceholder("chat_history"),
-            ("human", "{input}"),
-        ]
+    contextualize_q_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", contextualize_q_system_prompt()),
+        MessagesPlaceholder("chat_history"),
+        ("human", "{input}"),
+    ]
     )
-    question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
-
-    return create_retrieval_chain(history_aware_retriever, question_answer_chain)
-
-def reset_chat_history():
-    st.session_state['chat_history'] = []
-
-def get_chat_history():
-    if 'chat_history' not in st.session_state:
-        reset_chat_history()
-    return st.session_state.get('chat_history')
-
-def append_to_chat_history(message):
-    if 'chat_history' not in st.session_state:
-        reset_chat_history()
-
-    st.session_state['chat_history'].append(message)
-
-def display_chat_history():
-    if 'chat_history' not in st.session_state:
-        reset_chat_history()
 
-    for message in st.session_state.chat_history:
-        with st.chat_message(message.type):
-            st.write(message.content)
-
-def welcome_message():
-    if len(get_chat_history()) == 0:
-        append_to_chat_history(AIMessage(content=(
+    use_redis = os.getenv('VECTOR_STORE', 'redis') == 'redis'
+    with timer.phase('vector index'):
+        if use_redis:
+            # name of the Redis search index to create
+            index_name = "movieindex"
+
+            # create a connection string for the Redis Vector Store. Uses Redis-py format: https://redis-py.readthedocs.io/en/stable/connections.html#redis.Redis.from_url
+            # This example assumes TLS is enabled. If not, use "redis://" instead of "rediss://
+            redis_url = "rediss://:" + redis_password + "@"+ redis_endpoint
+
+            # VECTOR_DIMS must match the index, the answer cache keeps the full width query embedding
+            vector_dims = int(os.getenv('VECTOR_DIMS', '0'))
+            vectorstore = RedisVectorStore.from_existing_index(
+                embedding=TruncatedEmbeddings(query_embedding, vector_dims) if vector_dims else query_embedding,
+                redis_url=redis_url,
+                index_name=index_name,
+                schema="redis_schema.yaml"
+            )
+        else:
+            # in-process vector store created by create-local-index.py, no Redis needed
+            vectorstore = LocalVectorStore.from_existing_index(
+                embedding=query_embedding,
+                path=os.getenv('LOCAL_INDEX_PATH', 'local_index'),
+                n_probe=int(os.getenv('LOCAL_INDEX_PROBES', '8')),
+                rescore=int(os.getenv('LOCAL_INDEX_RESCORE', '0')))
+
+        # with PLOT_CHUNKS=1, search the plot chunk index instead of whole plots (see chunking.py)
+        chunk_vectorstore = load_chunk_index(
+            vectorstore,
+            redis_url=redis_url if use_redis else None,
+            path=os.getenv('LOCAL_CHUNK_INDEX_PATH', 'local_chunk_index'),
+            n_probe=int(os.getenv('LOCAL_INDEX_PROBES', '8')),
+            rescore=int(os.getenv('LOCAL_INDEX_RESCORE', '0'))) if os.getenv('PLOT_CHUNKS', '0') == '1' else None
+
+    with timer.phase('retriever'):
+        # exact year/cast/director/genre/origin lookups, falling back to hybrid full-text + similarity search for plot and
+        # theme questions (similarity search keeps the relevance score of each movie for the context packing stage)
+        # "movies like <title>" questions are answered from the precomputed neighbour graph
+        retriever = create_retriever(
+            vectorstore,
+            k=int(os.getenv('RETRIEVER_K', '6')),
+            hybrid=os.getenv('HYBRID_SEARCH', '1') == '1',
+            hybrid_candidates=int(os.getenv('HYBRID_CANDIDATES', '20')),
+            metadata_query=os.getenv('METADATA_QUERY', 'redis'),
+            movie_list=os.getenv('MOVIE_LIST', 'movie_list.csv'),
+            max_results=int(os.getenv('METADATA_MAX_RESULTS', '50')),
+            neighbours_file=os.getenv('NEIGHBOURS_FILE', 'movie_neighbours.npz'),
+            chunk_vectorstore=chunk_vectorstore,
+            chunks_per_movie=int(os.getenv('PLOT_CHUNKS_PER_MOVIE', '3')),
+            debug=bool(os.getenv('DEBUG')))
+
+    with timer.phase('chain'):
+        # dedupe, rerank and pack the retrieved movies into a token budget before they are sent to the LLM
+        context_packer = ContextPacker(
+            token_budget=int(os.getenv('CONTEXT_TOKEN_BUDGET', '3000')),
+            max_plot_tokens=int(os.getenv('CONTEXT_MAX_PLOT_TOKENS', '400')),
+            min_score=float(os.getenv('CONTEXT_MIN_SCORE', '0.25')),
+            max_score_gap=float(os.getenv('CONTEXT_MAX_SCORE_GAP', '0.2')),
+            debug=bool(os.getenv('DEBUG')))
+
+        qa_prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", get_system_prompt()),
+                MessagesPlaceholder("chat_history"),
+                ("human", "{input}"),
+            ]
+        )
+
+        # cache answers to (rewritten) questions that were recently answered from the same movies
+        answer_cache = SemanticAnswerCache(
+            client=vectorstore.client,
+            embedding=query_embedding,
+            threshold=float(os.getenv('ANSWER_CACHE_THRESHOLD', '0.95')),
+            ttl=int(os.getenv('ANSWER_CACHE_TTL', '3600')),
+            max_entries=int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', '10000'))) if use_redis and os.getenv('ANSWER_CACHE', '1') == '1' else None
+
+        # the history aware retriever rewrites follow up questions into standalone questions before retrieval
+        # (skipped when there is no chat history or the question doesn't refer back to earlier turns)
+        rag_chain = build_rag_chain(
+            llm, retriever, contextualize_q_prompt, qa_prompt,
+            answer_cache=answer_cache,
+            rewrite_fast_path=os.getenv('REWRITE_FAST_PATH', '1') == '1',
+            speculative_retrieval=os.getenv('REWRITE_SPECULATIVE', '0') == '1',
+            rewrite_history_tokens=int(os.getenv('REWRITE_HISTORY_TOKENS', '1000')),
+            answer_history_tokens=int(os.getenv('ANSWER_HISTORY_TOKENS', '3000')),
+            context_packer=context_packer)
+    return rag_chain, vectorstore
+
+# Conversations live in a session store rather than in st.session_state: in Redis by default, so any replica behind a
+# load balancer can serve the next turn (no sticky sessions) and open tabs don't hold their history in memory. The
+# session id is kept in the page URL, a reconnect picks the conversation up again.
+def setup_session_store(redis_endpoint, redis_password):
+    import redis
+    from session_store import InMemorySessionStore, RedisSessionStore
+
+    ttl = int(os.getenv('SESSION_TTL', '86400'))
+    default_store = 'redis' if os.getenv('VECTOR_STORE', 'redis') == 'redis' else 'memory'
+    if os.getenv('SESSION_STORE', default_store) == 'redis':
+        return RedisSessionStore(redis.Redis.from_url("rediss://:" + redis_password + "@"+ redis_endpoint), ttl=ttl)
+    return InMemorySessionStore(ttl=ttl)
+
+# per-stage timings of every turn, written to TRACE_FILE as JSON lines and served for Prometheus on METRICS_PORT
+# (shared by all browser sessions of this process)
+def setup_instrumentation():
+    from instrumentation import TraceWriter, serve_metrics
+
+    if int(os.getenv('METRICS_PORT', '0')):
+        serve_metrics(int(os.getenv('METRICS_PORT')))
+    return TraceWriter(os.getenv('TRACE_FILE')) if os.getenv('TRACE_FILE') else None
+
+class ChatApp(NamedTuple):
+    rag_chain: Any
+    # for the chat history summaries, behind the chat turns in the governor's queue
+    summary_llm: Any
+    query_embedding: Any
+    session_store: Any
+    trace_writer: Any
+
+def setup_app(timer, api_key, resource_endpoint, deployment_name, redis_endpoint, redis_password) -> ChatApp:
+    with timer.phase('import langchain'):
+        import httpx
+        import langchain_openai
+        from rate_limit import BACKGROUND
+
+    with timer.phase('clients'):
+        governor = setup_governor(deployment_name)
+        # one keep-alive connection pool to Azure OpenAI for the embeddings and the LLM, warmed up below
+        http_client = httpx.Client(timeout=float(os.getenv('HTTP_TIMEOUT', '60')), event_hooks=governor.event_hooks())
+        query_embedding = setup_query_embedding(api_key, resource_endpoint, deployment_name, redis_endpoint,
+                                                redis_password, http_client, governor)
+        llm = setup_llm(api_key, resource_endpoint, http_client, governor)
+
+    rag_chain, vectorstore = setup_rag_chain(timer, query_embedding, llm, redis_endpoint, redis_password)
+
+    with timer.phase('sessions'):
+        session_store = setup_session_store(redis_endpoint, redis_password)
+        trace_writer = setup_instrumentation()
+
+    # open the Redis and Azure OpenAI connections and load the tokenizer now rather than in the first question
+    if os.getenv('STARTUP_WARMUP', '1') == '1':
+        warm_connections(
+            timer,
+            redis_clients=[getattr(vectorstore, 'client', None), query_embedding.client,
+                           getattr(session_store, 'client', None)],
+            http_client=http_client,
+            urls=[resource_endpoint] if resource_endpoint else [])
+        warm_tokenizer(timer, query_embedding)
+    return ChatApp(rag_chain, llm.with_priority(BACKGROUND), query_embedding, session_store, trace_writer)
+
+# Sets the app up once per process, on a background thread started by the first page load, so the page renders while
+# LangChain is imported and the clients and the chain are built. With STARTUP_MODE=eager the page waits for it.
+@st.cache_resource
+def start_app(api_key, resource_endpoint, deployment_name, redis_endpoint, redis_password) -> Background:
+    timer = StartupTimer()
+    startup = Background(
+        lambda: setup_app(timer, api_key, resource_endpoint, deployment_name, redis_endpoint, redis_password), timer)
+    if os.getenv('STARTUP_MODE', 'background') == 'eager':
+        startup.result()
+    return startup
+
+def wait_for_app(startup: Background) -> ChatApp:
+    if not startup.done():
+        with st.spinner("Starting up..."):
+            return startup.result()
+    return startup.result()
+
+def get_session_id() -> str:
+    if 'session' not in st.query_params:
+        st.query_params['session'] = uuid.uuid4().hex
+    return st.query_params['session']
+
+# the token-budgeted question/answer history sent to the chain (see chat_history.py), also the transcript on the page
+def get_prompt_history(llm, session_store):
+    from chat_history import ChatHistoryManager
+
+    return ChatHistoryManager(
+        max_tokens=int(os.getenv('ANSWER_HISTORY_TOKENS', '3000')),
+        llm=llm if os.getenv('HISTORY_SUMMARY', '1') == '1' else None,
+        store=session_store,
+        session_id=get_session_id())
+
+def display_chat_history(session_store=None):
+    with st.chat_message("ai"):
+        st.write(
             "Welcome to the Movie Chatbot!"
             "Ask me anything about movies, and I'll do my best to help you out."
-            " Type 'q' to start a new conversation.")))
+            " Type 'q' to start a new conversation.")
+    if session_store is None:
+        return
+    for message in session_store.transcript(get_session_id(), limit=int(os.getenv('SESSION_DISPLAY_MESSAGES', '200'))):
+        with st.chat_message(message.type):
+            st.write(message.content)
 
 if __name__ == "__main__":
     load_env()
@@ -146,8 +318,9 @@ if __name__ == "__main__":
     REDIS_ENDPOINT = os.getenv('REDIS_ENDPOINT')
     REDIS_PASSWORD = os.getenv('REDIS_PASSWORD')
     DEBUG = os.getenv('DEBUG')
+    STREAMING = os.getenv('STREAMING', '1') == '1'
 
-    rag_chain = setup_rag_chain(
+    startup = start_app(
         api_key=API_KEY,
         resource_endpoint=RESOURCE_ENDPOINT,
         deployment_name=DEPLOYMENT_NAME,
@@ -156,41 +329,57 @@ if __name__ == "__main__":
     )
 
     st.title('Movie Chat')
-    welcome_message()
-    display_chat_history()
 
     question = st.chat_input("Ask your questions about movies or type 'q' to start a new conversation.")
-
-    if question:
+    startup.timer.mark('prompt')
+
+    # a new conversation has no transcript to show, so its page doesn't wait for the setup
+    if not (question or 'session' in st.query_params or startup.done()):
+        display_chat_history()
+    else:
+        app = wait_for_app(startup)
+        prompt_history = get_prompt_history(app.summary_llm, app.session_store)
         if question == 'q':
-            reset_chat_history()
-            welcome_message()
-            display_chat_history()
-        else:
-            append_to_chat_history(HumanMessage(content=question))
-            display_question(question)
-            try:
-                with st.spinner("Thinking...", show_time=True):
-                    if DEBUG:
-                        start_time = time.time()
-                        response = rag_chain.invoke({"input": question, "chat_history": get_chat_history()}, config={'callbacks': [debugging.DebugCallbackHandler()]})
-                        end_time = time.time()
-                        elapsed_time = end_time - start_time
-                    else:
-                        response = rag_chain.invoke({"input": question, "chat_history": get_chat_history()})
-
-                append_to_chat_history(AIMessage(content=response["answer"]))
-                display_answer(response["answer"])
-
-                if DEBUG:
-                    with st.chat_message("assistant"):
-                        st.write(f"Processing time: {elapsed_time:.2f} seconds")
-                    debugging.debug_chat_history(
-                        messages=[
-                            SystemMessage(content=get_system_prompt()), 
-                            *get_chat_history()
-                        ],
-                        truncate_length=200
-                    )
-            except Exception as e:
-                print(f"Error during chain execution: {e}")
\ No newline at end of file
+            prompt_history.reset()
+        display_chat_history(app.session_store)
+
+    if question and question != 'q':
+        # already imported by setup_app()
+        import debugging as debugging
+        from chains import stream_answer
+        from instrumentation import Trace
+        from langchain_core.messages import SystemMessage
+
+        if DEBUG and 'first question' not in startup.timer.marks:
+            print(startup.timer.report())
+        startup.timer.mark('first question')
+
+        display_question(question)
+        try:
+            inputs = {"input": question, "chat_history": prompt_history.messages()}
+            with Trace(app.trace_writer, app='streamlit', session_id=get_session_id()) as trace:
+                config = {'callbacks': trace.callbacks}
+                if STREAMING:
+                    answer = display_answer(stream_answer(app.rag_chain, inputs, config=config))
+                else:
+                    with st.spinner("Thinking...", show_time=True):
+                        answer = app.rag_chain.invoke(inputs, config=config)["answer"]
+                    display_answer(answer)
+
+            prompt_history.add_turn(question, answer)
+
+            if DEBUG:
+                with st.chat_message("assistant"):
+                    st.write(f"Processing time: {trace.duration:.2f} seconds")
+                    st.json(trace.stages(), expanded=False)
+                debugging.debug_trace(trace)
+                print(f"Query embedding cache: {app.query_embedding.stats()}")
+                debugging.debug_chat_history(
+                    messages=[
+                        SystemMessage(content=get_system_prompt()),
+                        *prompt_history.messages()
+                    ],
+                    truncate_length=200
+                )
+        except Exception as e:
+            print(f"Error during chain execution: {e}")
\ No newline at end of file
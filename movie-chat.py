@@ -1,26 +1,14 @@
 import os
-import time
-from typing import List
+from typing import Any, List, NamedTuple, Optional
 from dotenv import load_dotenv
 from rich.console import Console
 from rich.prompt import Prompt
 from rich.text import Text
 
-from langchain_openai import AzureOpenAIEmbeddings
-from langchain_community.vectorstores import Redis as RedisVectorStore
-from langchain_openai import AzureChatOpenAI
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
-from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, trim_messages
-from langchain_core.messages.utils import count_tokens_approximately
-from langchain_core.runnables import Runnable
-from langchain.chains import create_history_aware_retriever
-from langchain_core.prompts import MessagesPlaceholder
-from langchain.chains import create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
-
-import debugging as debugging
+from startup import Background, StartupTimer, warm_connections, warm_tokenizer
+
+# LangChain and the app modules are imported in setup(), see STARTUP_MODE
+timer = StartupTimer()
 
 load_dotenv()
 
@@ -30,6 +18,55 @@ DEPLOYMENT_NAME = os.getenv('DEPLOYMENT_NAME')
 REDIS_ENDPOINT = os.getenv('REDIS_ENDPOINT')
 REDIS_PASSWORD = os.getenv('REDIS_PASSWORD')
 DEBUG = os.getenv('DEBUG')
+QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', '1024'))
+QUERY_CACHE_TTL = int(os.getenv('QUERY_CACHE_TTL', '86400'))
+ANSWER_CACHE = os.getenv('ANSWER_CACHE', '1') == '1'
+ANSWER_CACHE_THRESHOLD = float(os.getenv('ANSWER_CACHE_THRESHOLD', '0.95'))
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', '3600'))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', '10000'))
+REWRITE_FAST_PATH = os.getenv('REWRITE_FAST_PATH', '1') == '1'
+REWRITE_SPECULATIVE = os.getenv('REWRITE_SPECULATIVE', '0') == '1'
+STREAMING = os.getenv('STREAMING', '1') == '1'
+REWRITE_HISTORY_TOKENS = int(os.getenv('REWRITE_HISTORY_TOKENS', '1000'))
+ANSWER_HISTORY_TOKENS = int(os.getenv('ANSWER_HISTORY_TOKENS', '3000'))
+HISTORY_SUMMARY = os.getenv('HISTORY_SUMMARY', '1') == '1'
+RETRIEVER_K = int(os.getenv('RETRIEVER_K', '6'))
+HYBRID_SEARCH = os.getenv('HYBRID_SEARCH', '1') == '1'
+HYBRID_CANDIDATES = int(os.getenv('HYBRID_CANDIDATES', '20'))
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '3000'))
+CONTEXT_MAX_PLOT_TOKENS = int(os.getenv('CONTEXT_MAX_PLOT_TOKENS', '400'))
+CONTEXT_MIN_SCORE = float(os.getenv('CONTEXT_MIN_SCORE', '0.25'))
+CONTEXT_MAX_SCORE_GAP = float(os.getenv('CONTEXT_MAX_SCORE_GAP', '0.2'))
+METADATA_QUERY = os.getenv('METADATA_QUERY', 'redis')
+METADATA_MAX_RESULTS = int(os.getenv('METADATA_MAX_RESULTS', '50'))
+MOVIE_LIST = os.getenv('MOVIE_LIST', 'movie_list.csv')
+VECTOR_STORE = os.getenv('VECTOR_STORE', 'redis')
+LOCAL_INDEX_PATH = os.getenv('LOCAL_INDEX_PATH', 'local_index')
+LOCAL_INDEX_PROBES = int(os.getenv('LOCAL_INDEX_PROBES', '8'))
+LOCAL_INDEX_RESCORE = int(os.getenv('LOCAL_INDEX_RESCORE', '0'))
+NEIGHBOURS_FILE = os.getenv('NEIGHBOURS_FILE', 'movie_neighbours.npz')
+# Search the plot chunk index built with PLOT_CHUNKS=1 instead of whole plots
+PLOT_CHUNKS = os.getenv('PLOT_CHUNKS', '0') == '1'
+PLOT_CHUNKS_PER_MOVIE = int(os.getenv('PLOT_CHUNKS_PER_MOVIE', '3'))
+LOCAL_CHUNK_INDEX_PATH = os.getenv('LOCAL_CHUNK_INDEX_PATH', 'local_chunk_index')
+TRACE_FILE = os.getenv('TRACE_FILE')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+# Must match the VECTOR_DIMS the Redis index was created with (0 for full width vectors)
+VECTOR_DIMS = int(os.getenv('VECTOR_DIMS', '0'))
+# background: show the prompt at once and set up the chain while the first question is typed, eager: set up first
+STARTUP_MODE = os.getenv('STARTUP_MODE', 'background')
+# open the Redis and Azure OpenAI connections during setup
+STARTUP_WARMUP = os.getenv('STARTUP_WARMUP', '1') == '1'
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '60'))
+# Quotas of the chat and embedding deployments (requests and tokens per minute), the share of them kept for chat turns
+# when history summaries compete with them, and the time concurrent query embeddings are collected for one request
+LLM_RPM = int(os.getenv('LLM_RPM', '1500'))
+LLM_TPM = int(os.getenv('LLM_TPM', '250000'))
+EMBEDDING_RPM = int(os.getenv('EMBEDDING_RPM', '300'))
+EMBEDDING_TPM = int(os.getenv('EMBEDDING_TPM', '350000'))
+RATE_LIMIT_RESERVE = float(os.getenv('RATE_LIMIT_RESERVE', '0.2'))
+LLM_COALESCE = os.getenv('LLM_COALESCE', '1') == '1'
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv('EMBEDDING_BATCH_WINDOW_MS', '10'))
 
 console = Console()
 
@@ -42,9 +79,18 @@ def get_system_prompt():
         "{context}"
     )
 
-def display_answer(answer):
+def display_answer(answer) -> str:
+    # answer is either the full answer or an iterator of answer tokens, which are printed as they arrive
     console.print(f'\nAnswer:\n', style="yellow")
-    console.print(answer, style="white")
+    if isinstance(answer, str):
+        console.print(answer, style="white")
+        return answer
+    tokens = []
+    for token in answer:
+        console.print(token, style="white", end="", markup=False, highlight=False)
+        tokens.append(token)
+    console.print()
+    return ''.join(tokens)
 
 def welcome_message():
         console.print(f"""
@@ -69,67 +115,193 @@ contextualize_q_system_prompt = (
     "just reformulate it if needed and otherwise return it as is."
 )
 
-contextualize_q_prompt = ChatPromptTemplate.from_messages(
-    [
-        ("system", contextualize_q_system_prompt),
-        MessagesPlaceholder("chat_history"),
-        ("human", "{input}"),
-    ]
-)
+class ChatApp(NamedTuple):
+    rag_chain: Any
+    # for the chat history summaries, behind the chat turns in the governor's queue
+    summary_llm: Any
+    query_embedding: Any
+    answer_cache: Optional[Any]
+    trace_writer: Optional[Any]
 
-# we will use Azure OpenAI as our embeddings provider
-embedding = AzureOpenAIEmbeddings(
-    azure_endpoint=RESOURCE_ENDPOINT,
-    azure_deployment=DEPLOYMENT_NAME,
-    openai_api_key=API_KEY,
-    openai_api_version='2024-03-01-preview',
-    chunk_size=16)
-
-# name of the Redis search index to create
-index_name = "movieindex"
-
-# create a connection string for the Redis Vector Store. Uses Redis-py format: https://redis-py.readthedocs.io/en/stable/connections.html#redis.Redis.from_url
-# This example assumes TLS is enabled. If not, use "redis://" instead of "rediss://
-redis_url = "rediss://:" + REDIS_PASSWORD + "@"+ REDIS_ENDPOINT
-
-vectorstore = RedisVectorStore.from_existing_index(
-    embedding=embedding,
-    redis_url=redis_url,
-    index_name=index_name,
-    schema="redis_schema.yaml"
-)
+def setup() -> ChatApp:
+    with timer.phase('import langchain'):
+        import httpx
+        from langchain_openai import AzureChatOpenAI, AzureOpenAIEmbeddings
+        from langchain_community.vectorstores import Redis as RedisVectorStore
+        from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 
-# Initialize the LLM
-llm = AzureChatOpenAI(
-    azure_endpoint=RESOURCE_ENDPOINT,
-    azure_deployment='gpt-4o-mini',
-    api_key=API_KEY,
-    openai_api_version="2024-09-01-preview"
-)
+    with timer.phase('import app modules'):
+        from answer_cache import SemanticAnswerCache
+        from chains import build_rag_chain
+        from chunking import load_chunk_index
+        from compression import TruncatedEmbeddings
+        from context_packing import ContextPacker
+        from instrumentation import TraceWriter, serve_metrics
+        from llm_governor import LLMGovernor
+        from local_vectorstore import LocalVectorStore
+        from rate_limit import BACKGROUND
+        from retrievers import create_retriever
+        from query_embedding_cache import QueryEmbeddingCache
 
-retriever = vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": 10})
+    with timer.phase('clients'):
+        # one rate limit per deployment for every call of the chains, following the rate limit headers of the
+        # responses; identical requests in flight share one call (see llm_governor.py)
+        governor = LLMGovernor(
+            {DEPLOYMENT_NAME: (EMBEDDING_RPM, EMBEDDING_TPM), 'gpt-4o-mini': (LLM_RPM, LLM_TPM)},
+            reserve=RATE_LIMIT_RESERVE,
+            coalesce=LLM_COALESCE,
+            batch_window=EMBEDDING_BATCH_WINDOW_MS / 1000)
 
-history_aware_retriever = create_history_aware_retriever(
-    llm, retriever, contextualize_q_prompt
-)
+        # one keep-alive connection pool to Azure OpenAI for the embeddings and the LLM, warmed up below
+        http_client = httpx.Client(timeout=HTTP_TIMEOUT, event_hooks=governor.event_hooks())
 
-qa_prompt = ChatPromptTemplate.from_messages(
-    [
-        ("system", get_system_prompt()),
-        MessagesPlaceholder("chat_history"),
-        ("human", "{input}"),
-    ]
-)
-question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
+        # we will use Azure OpenAI as our embeddings provider
+        embedding = governor.embeddings(AzureOpenAIEmbeddings(
+            azure_endpoint=RESOURCE_ENDPOINT,
+            azure_deployment=DEPLOYMENT_NAME,
+            openai_api_key=API_KEY,
+            openai_api_version='2024-03-01-preview',
+            chunk_size=16,
+            http_client=http_client), DEPLOYMENT_NAME)
+
+        # create a connection string for the Redis Vector Store. Uses Redis-py format: https://redis-py.readthedocs.io/en/stable/connections.html#redis.Redis.from_url
+        # This example assumes TLS is enabled. If not, use "redis://" instead of "rediss://
+        # (not needed with the local vector store)
+        redis_url = "rediss://:" + REDIS_PASSWORD + "@"+ REDIS_ENDPOINT if VECTOR_STORE == 'redis' else None
+
+        # cache query embeddings in-process and in Redis so repeated questions skip the embedding call
+        query_embedding = QueryEmbeddingCache(
+            embedding=embedding,
+            deployment=DEPLOYMENT_NAME,
+            redis_url=redis_url,
+            max_size=QUERY_CACHE_SIZE,
+            ttl=QUERY_CACHE_TTL)
+
+        # Initialize the LLM
+        llm = governor.chat_model(AzureChatOpenAI(
+            azure_endpoint=RESOURCE_ENDPOINT,
+            azure_deployment='gpt-4o-mini',
+            api_key=API_KEY,
+            openai_api_version="2024-09-01-preview",
+            http_client=http_client
+        ), 'gpt-4o-mini', stream_usage=True)
+
+    with timer.phase('vector index'):
+        if VECTOR_STORE == 'redis':
+            vectorstore = RedisVectorStore.from_existing_index(
+                embedding=TruncatedEmbeddings(query_embedding, VECTOR_DIMS) if VECTOR_DIMS else query_embedding,
+                redis_url=redis_url,
+                index_name="movieindex",
+                schema="redis_schema.yaml"
+            )
+        else:
+            # in-process vector store created by create-local-index.py
+            vectorstore = LocalVectorStore.from_existing_index(
+                embedding=query_embedding,
+                path=LOCAL_INDEX_PATH,
+                n_probe=LOCAL_INDEX_PROBES,
+                rescore=LOCAL_INDEX_RESCORE)
+
+        # matching plot chunks instead of whole plots, collapsed to one document per movie (see chunking.py)
+        chunk_vectorstore = load_chunk_index(
+            vectorstore,
+            redis_url=redis_url,
+            path=LOCAL_CHUNK_INDEX_PATH,
+            n_probe=LOCAL_INDEX_PROBES,
+            rescore=LOCAL_INDEX_RESCORE) if PLOT_CHUNKS else None
+
+    with timer.phase('retriever'):
+        # exact year/cast/director/genre/origin lookups, falling back to hybrid full-text + similarity search for plot and
+        # theme questions (similarity search keeps the relevance score of each movie for the context packing stage)
+        # "movies like <title>" questions are answered from the precomputed neighbour graph
+        retriever = create_retriever(
+            vectorstore,
+            k=RETRIEVER_K,
+            hybrid=HYBRID_SEARCH,
+            hybrid_candidates=HYBRID_CANDIDATES,
+            metadata_query=METADATA_QUERY,
+            movie_list=MOVIE_LIST,
+            max_results=METADATA_MAX_RESULTS,
+            neighbours_file=NEIGHBOURS_FILE,
+            chunk_vectorstore=chunk_vectorstore,
+            chunks_per_movie=PLOT_CHUNKS_PER_MOVIE,
+            debug=bool(DEBUG))
 
-rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
+    with timer.phase('chain'):
+        contextualize_q_prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", contextualize_q_system_prompt),
+                MessagesPlaceholder("chat_history"),
+                ("human", "{input}"),
+            ]
+        )
 
-if DEBUG:
-    debug_handler = debugging.DebugCallbackHandler()
+        # dedupe, rerank and pack the retrieved movies into a token budget before they are sent to the LLM
+        context_packer = ContextPacker(
+            token_budget=CONTEXT_TOKEN_BUDGET,
+            max_plot_tokens=CONTEXT_MAX_PLOT_TOKENS,
+            min_score=CONTEXT_MIN_SCORE,
+            max_score_gap=CONTEXT_MAX_SCORE_GAP,
+            debug=bool(DEBUG))
+
+        qa_prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", get_system_prompt()),
+                MessagesPlaceholder("chat_history"),
+                ("human", "{input}"),
+            ]
+        )
+
+        # cache answers to (rewritten) questions that were recently answered from the same movies
+        answer_cache = SemanticAnswerCache(
+            client=vectorstore.client,
+            embedding=query_embedding,
+            threshold=ANSWER_CACHE_THRESHOLD,
+            ttl=ANSWER_CACHE_TTL,
+            max_entries=ANSWER_CACHE_MAX_ENTRIES) if ANSWER_CACHE and VECTOR_STORE == 'redis' else None
+
+        # the history aware retriever rewrites follow up questions into standalone questions before retrieval
+        # (skipped when there is no chat history or the question doesn't refer back to earlier turns)
+        rag_chain = build_rag_chain(
+            llm, retriever, contextualize_q_prompt, qa_prompt,
+            answer_cache=answer_cache,
+            rewrite_fast_path=REWRITE_FAST_PATH,
+            speculative_retrieval=REWRITE_SPECULATIVE,
+            rewrite_history_tokens=REWRITE_HISTORY_TOKENS,
+            answer_history_tokens=ANSWER_HISTORY_TOKENS,
+            context_packer=context_packer)
+
+    # per-stage timings of every turn, written to TRACE_FILE as JSON lines and served for Prometheus on METRICS_PORT
+    trace_writer = TraceWriter(TRACE_FILE) if TRACE_FILE else None
+    if METRICS_PORT:
+        serve_metrics(METRICS_PORT)
+
+    # open the Redis and Azure OpenAI connections and load the tokenizer now rather than in the first question
+    if STARTUP_WARMUP:
+        warm_connections(
+            timer,
+            redis_clients=[getattr(vectorstore, 'client', None), query_embedding.client],
+            http_client=http_client,
+            urls=[RESOURCE_ENDPOINT] if RESOURCE_ENDPOINT else [])
+        warm_tokenizer(timer, embedding)
+
+    return ChatApp(rag_chain, llm.with_priority(BACKGROUND), query_embedding, answer_cache, trace_writer)
+
+# with STARTUP_MODE=background the prompt is shown straight away and setup() runs while the first question is typed
+startup = Background(setup, timer)
+if STARTUP_MODE == 'eager':
+    startup.result()
+
+def wait_for_setup() -> ChatApp:
+    if not startup.done():
+        with console.status("Starting up...", spinner_style="yellow"):
+            return startup.result()
+    return startup.result()
 
 welcome_message()
+timer.mark('prompt')
 
-chat_history = []
+chat_history = None
 
 while True:
     question = Prompt.ask(user_input_prompt())
@@ -138,36 +310,50 @@ while True:
         break
     elif question == '':
         welcome_message()
-        chat_history = []
+        if chat_history:
+            chat_history.reset()
         console.print(f'Starting a new conversation...\n', style="yellow")
     else:
         try:
+            app = wait_for_setup()
+        except Exception as e:
+            print(f"Error during startup: {e}")
+            break
+        if chat_history is None:
+            # already imported by setup()
+            import debugging as debugging
+            from chains import stream_answer
+            from chat_history import ChatHistoryManager
+            from instrumentation import Trace
+            from langchain_core.messages import SystemMessage
+
+            # only questions and answers are kept, older turns are summarised in the background to keep prompts a flat size
+            chat_history = ChatHistoryManager(max_tokens=ANSWER_HISTORY_TOKENS, llm=app.summary_llm if HISTORY_SUMMARY else None)
             if DEBUG:
-                start_time = time.time()
-                response = rag_chain.invoke({"input": question, "chat_history": chat_history}, config={'callbacks': [debug_handler]})
-                end_time = time.time()
-                elapsed_time = end_time - start_time
-            else:
-                response = rag_chain.invoke({"input": question, "chat_history": chat_history})
-
-            answer = response["answer"]
-            chat_history.extend(
-                [
-                HumanMessage(content=question),
-                AIMessage(content=answer)
-                ]
-            )
+                print(timer.report())
+        try:
+            inputs = {"input": question, "chat_history": chat_history.messages()}
+            with Trace(app.trace_writer, app='console') as trace:
+                config = {'callbacks': trace.callbacks}
+                if STREAMING:
+                    answer = display_answer(stream_answer(app.rag_chain, inputs, config=config))
+                else:
+                    answer = app.rag_chain.invoke(inputs, config=config)["answer"]
+                    display_answer(answer)
 
-            display_answer(answer)
+            chat_history.add_turn(question, answer)
 
             if DEBUG:
-                print(f"\n(Processing time: {elapsed_time:.2f} seconds)")
+                debugging.debug_trace(trace)
+                print(f"(Query embedding cache: {app.query_embedding.stats()})")
+                if app.answer_cache:
+                    print(f"(Answer cache: {app.answer_cache.stats()})")
                 debugging.debug_chat_history(
                     messages=[
                         SystemMessage(content=get_system_prompt()),
-                        *chat_history
+                        *chat_history.messages()
                     ],
                     truncate_length=200
                 )
         except Exception as e:
-            print(f"Error during chain execution: {e}")
\ No newline at end of file
+            print(f"Error during chain execution: {e}")
@@ -0,0 +1,164 @@
+import os
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from compression import normalize
+from context_packing import STOP_WORDS
+
+# Precomputed movie-to-movie similarity graph for "movies like X" questions. The index scripts compute the top N
+# nearest neighbours of every movie from the stored embeddings and save them as an adjacency list keyed by movie id.
+# At chat time a "like <title>" question is answered by a title lookup plus a neighbour fetch, with no embedding call
+# and no KNN query.
+
+NEIGHBOURS_FILE = 'movie_neighbours.npz'
+
+# "find me movies like Top Gun", "something similar to 'The Matrix' please", "films like Psycho (1960)".
+# "like" only counts after a noun, so the verb ("do you like Top Gun?") is a question about the movie itself.
+LIKE_PATTERN = re.compile(r"\b(?:(?:movies?|films?|something|anything|ones|titles|stuff)\s+like|similar to|similar with|"
+                          r"in the style of|along the lines of)\s+(.+)$", re.IGNORECASE)
+YEAR_PATTERN = re.compile(r"\s*\(?\b(1[89]\d\d|20\d\d)\)?$")
+
+# Words allowed before the phrase. Anything else ("Tom Cruise movies like Top Gun", "comedies like ...") is a constraint
+# the graph can't apply, so those questions go to the normal retrieval path.
+LEAD_WORDS = STOP_WORDS | {
+    'recommend', 'suggest', 'suggestions', 'recommendations', 'other', 'more', 'similar', 'something', 'anything',
+    'good', 'great', 'best', 'few', 'i', 'want', 'watch', 'see', 'can', 'could', 'you', 'please', 'give', 'list', 'are',
+    'there', 'titles', 'else', 'name', 'get', 'need', 'would', 'enjoy', 'if', 'liked', 'loved', 'enjoyed',
+}
+TRAILING_WORDS = {'please', 'thanks', 'movie', 'film', 'the movie', 'the film'}
+
+def normalize_title(title: str) -> str:
+    words = re.findall(r"[a-z0-9]+", str(title).lower().replace('&', ' and '))
+    if words and words[0] in ('the', 'a', 'an'):
+        words = words[1:]
+    return " ".join(words)
+
+# Top `n` neighbours of every row, by cosine similarity. Rows are scored in batches of `batch_size` against the whole
+# matrix, so memory stays at batch_size x number of movies. `normalized` vectors are used as they are, without a copy.
+def nearest_neighbours(vectors: np.ndarray, n: int = 20, batch_size: int = 512,
+                       normalized: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    vectors = np.asarray(vectors, dtype=np.float32) if normalized else normalize(np.asarray(vectors, dtype=np.float32))
+    n = min(n, len(vectors) - 1)
+    neighbours = np.zeros((len(vectors), max(n, 0)), dtype=np.int32)
+    scores = np.zeros((len(vectors), max(n, 0)), dtype=np.float16)
+    if n <= 0:
+        return neighbours, scores
+    for start in range(0, len(vectors), batch_size):
+        sims = vectors[start:start + batch_size] @ vectors.T
+        rows = np.arange(len(sims))
+        sims[rows, start + rows] = -np.inf
+        top = np.argpartition(-sims, n - 1, axis=1)[:, :n]
+        top_sims = np.take_along_axis(sims, top, axis=1)
+        order = np.argsort(-top_sims, axis=1)
+        neighbours[start:start + len(sims)] = np.take_along_axis(top, order, axis=1)
+        scores[start:start + len(sims)] = np.take_along_axis(top_sims, order, axis=1)
+    return neighbours, scores
+
+class MovieNeighbourGraph:
+    def __init__(self, ids: List[str], neighbours: np.ndarray, scores: np.ndarray):
+        self.ids = list(ids)
+        self.neighbours = neighbours
+        self.scores = scores
+        self.rows = {id: row for row, id in enumerate(self.ids)}
+
+    @classmethod
+    def build(cls, ids: List[str], vectors: np.ndarray, n: int = 20, batch_size: int = 512,
+              normalized: bool = False) -> "MovieNeighbourGraph":
+        neighbours, scores = nearest_neighbours(vectors, n=n, batch_size=batch_size, normalized=normalized)
+        return cls(ids, neighbours, scores)
+
+    @classmethod
+    def load(cls, path: str = NEIGHBOURS_FILE) -> "MovieNeighbourGraph":
+        with np.load(path) as data:
+            return cls([str(id) for id in data['ids']], data['neighbours'], data['scores'])
+
+    def save(self, path: str = NEIGHBOURS_FILE):
+        # Written to a temporary file and renamed, so a running app never reads a half written graph
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, ids=np.asarray(self.ids), neighbours=self.neighbours, scores=self.scores)
+        os.replace(tmp_path, path)
+
+    def similar(self, movie_id: str, k: int = 10) -> List[Tuple[str, float]]:
+        row = self.rows.get(str(movie_id))
+        if row is None:
+            return []
+        return [(self.ids[i], float(score)) for i, score in zip(self.neighbours[row][:k], self.scores[row][:k])]
+
+# Embeds (normally from the embedding cache) every movie in the list and saves its neighbour graph, called at the end
+# of the index scripts so the graph always matches the index. The vectors are fetched `chunk_size` movies at a time into
+# one preallocated float32 matrix, normalized as they arrive. CachedEmbeddings are read straight from the cache bytes,
+# so the whole catalogue is never held as lists of Python floats.
+def build_neighbour_file(movies: Dict[str, Tuple[str, Dict[str, Any]]], embedding: Embeddings, path: str = NEIGHBOURS_FILE,
+                         n: int = 20, chunk_size: int = 1000) -> MovieNeighbourGraph:
+    ids = [id for id, (plot, _) in movies.items() if isinstance(plot, str) and plot]
+    vectors = None
+    for start in range(0, len(ids), chunk_size):
+        plots = [movies[id][0] for id in ids[start:start + chunk_size]]
+        if hasattr(embedding, 'embed_array'):
+            chunk = embedding.embed_array(plots)
+        else:
+            chunk = np.asarray(embedding.embed_documents(plots), dtype=np.float32)
+        if vectors is None:
+            vectors = np.empty((len(ids), chunk.shape[1]), dtype=np.float32)
+        vectors[start:start + len(chunk)] = normalize(chunk)
+    if vectors is None:
+        vectors = np.zeros((0, 0), dtype=np.float32)
+    graph = MovieNeighbourGraph.build(ids, vectors, n=n, normalized=True)
+    graph.save(path)
+    return graph
+
+# Resolves "like <title>" questions against movie_list.csv and returns the title's neighbours as documents.
+# Titles shared by several movies (remakes) resolve to the earliest, unless the question gives the year.
+class SimilarMovies:
+    def __init__(self, graph: MovieNeighbourGraph, movies: Dict[str, Tuple[str, Dict[str, Any]]]):
+        self.graph = graph
+        self.movies = movies
+        self.titles: Dict[str, List[str]] = {}
+        for doc_id, (_, metadata) in sorted(movies.items(), key=lambda item: item[1][1].get('year') or 0):
+            self.titles.setdefault(normalize_title(metadata.get('Title', '')), []).append(doc_id)
+
+    def resolve(self, question: str) -> Optional[str]:
+        match = LIKE_PATTERN.search(question.strip())
+        if not match:
+            return None
+        lead = re.findall(r"[a-z0-9']+", question[:match.start()].lower())
+        if any(word not in LEAD_WORDS and not word.isdigit() for word in lead):
+            return None
+
+        text = match.group(1).strip().strip('?!.').strip().strip('"\'')
+        year = None
+        year_match = YEAR_PATTERN.search(text)
+        if year_match:
+            year, text = int(year_match.group(1)), text[:year_match.start()]
+        title = normalize_title(text)
+        for word in sorted(TRAILING_WORDS, key=len, reverse=True):
+            if title.endswith(' ' + word):
+                title = title[:-len(word) - 1]
+        # "something like that", "movies like it" refer back to the conversation, not to a title
+        if not title or all(word in STOP_WORDS for word in title.split()):
+            return None
+
+        candidates = self.titles.get(title, [])
+        if year is not None:
+            candidates = [id for id in candidates if self.movies[id][1].get('year') == year] or candidates
+        candidates = [id for id in candidates if id in self.graph.rows]
+        return candidates[0] if candidates else None
+
+    def search(self, question: str, k: int = 6) -> Optional[List[Document]]:
+        movie_id = self.resolve(question)
+        if movie_id is None:
+            return None
+        source_title = self.movies[movie_id][1].get('Title')
+        docs = []
+        for doc_id, score in self.graph.similar(movie_id, k=k):
+            if doc_id not in self.movies:
+                continue
+            plot, metadata = self.movies[doc_id]
+            docs.append(Document(page_content=plot if isinstance(plot, str) else '',
+                                 metadata={**metadata, 'score': score, 'match': 'neighbour', 'similar_to': source_title,
+                                           'id': doc_id}))
+        return docs
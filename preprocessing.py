@@ -0,0 +1,159 @@
+# Streaming preprocessing of the Kaggle movie plots CSV.
+# The dataset is read in chunks, so memory stays bounded however large the catalogue is. Plots are normalized with
+# vectorized pandas string operations, and token counts use tiktoken's batched encoder spread across a process pool.
+# Each filtered chunk is appended to movie_list.csv and yielded to the caller (e.g. to be embedded and indexed).
+#
+# Run it standalone to only (re)create movie_list.csv and report throughput:
+#   python preprocessing.py
+
+import csv
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+import tiktoken
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+ENCODING_NAME = "cl100k_base"
+MAX_TOKENS = 8192
+MIN_YEAR = 1970
+ORIGINS = ['American', 'British', 'Canadian']
+
+# movie_list.csv uses snake_case column names, the index uses the original dataset names for its metadata fields
+METADATA_COLUMNS = {
+    'id': 'id',
+    'title': 'Title',
+    'director': 'Director',
+    'cast': 'Cast',
+    'genre': 'Genre',
+    'wiki_page': 'Wiki Page',
+    'year': 'year',
+    'origin': 'origin',
+    'n_tokens': 'n_tokens',
+}
+
+_tokenizer = None
+
+def _init_tokenizer(encoding_name: str = ENCODING_NAME):
+    global _tokenizer
+    _tokenizer = tiktoken.get_encoding(encoding_name)
+
+def _count_tokens(texts: List[str]) -> List[int]:
+    if _tokenizer is None:
+        _init_tokenizer()
+    return [len(tokens) for tokens in _tokenizer.encode_batch(texts)]
+
+def create_token_counter(max_workers: Optional[int] = None) -> Executor:
+    # Worker processes are forked so they don't re-import the calling script, and they inherit the tokenizer
+    # loaded here instead of each loading it again. Where fork is unavailable fall back to threads,
+    # tiktoken releases the GIL while encoding.
+    if _tokenizer is None:
+        _init_tokenizer()
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('fork'))
+    return ThreadPoolExecutor(max_workers=max_workers)
+
+def count_tokens(texts: List[str], executor: Executor, slice_size: int = 1000) -> List[int]:
+    slices = [texts[i:i + slice_size] for i in range(0, len(texts), slice_size)]
+    return [count for counts in executor.map(_count_tokens, slices) for count in counts]
+
+# Vectorized equivalent of the original per-row normalize_text()
+def normalize_plots(plots: pd.Series) -> pd.Series:
+    plots = plots.str.replace(r'\s+', ' ', regex=True).str.strip()
+    plots = plots.str.replace(r'. ,', '', regex=True)
+    # remove all instances of multiple spaces
+    plots = plots.str.replace('..', '.', regex=False)
+    plots = plots.str.replace('. .', '.', regex=False)
+    plots = plots.str.replace('\n', '', regex=False)
+    return plots.str.strip()
+
+def peak_rss_mb() -> float:
+    if resource is None:
+        return 0.0
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is reported in bytes on macOS and kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+class PreprocessStats:
+    def __init__(self):
+        self.start_time = time.time()
+        self.rows_read = 0
+        self.rows_kept = 0
+        self.tokens = 0
+        # time spent in preprocess_movies itself, not in the caller's work on the chunks it yields
+        self.preprocess_seconds = 0.0
+
+    def report(self):
+        elapsed = time.time() - self.start_time
+        rows_per_second = self.rows_read / self.preprocess_seconds if self.preprocess_seconds > 0 else 0
+        print(f"Rows read: {self.rows_read}, movies kept: {self.rows_kept}, tokens required: {self.tokens}")
+        print(f"Preprocessing: {self.preprocess_seconds:.1f}s, {rows_per_second:,.0f} rows/sec")
+        print(f"End to end: {elapsed:.1f}s, {self.rows_read / elapsed if elapsed > 0 else 0:,.0f} rows/sec, "
+              f"peak RSS {peak_rss_mb():.0f} MB")
+
+def preprocess_movies(file_name: str, output_csv: str = 'movie_list.csv', chunk_size: int = 10000,
+                      max_workers: Optional[int] = None, stats: Optional[PreprocessStats] = None) -> Iterator[pd.DataFrame]:
+    stats = stats or PreprocessStats()
+    resumed = time.time()
+    if os.path.exists(output_csv):
+        os.remove(output_csv)
+
+    with create_token_counter(max_workers) as executor:
+        for df in pd.read_csv(file_name, chunksize=chunk_size):
+            # ids are the row numbers in the source dataset, so they stay stable between runs
+            df.insert(0, 'id', range(stats.rows_read, stats.rows_read + len(df)))
+            stats.rows_read += len(df)
+
+            df['year'] = df['Release Year'].astype(int)
+            df['origin'] = df['Origin/Ethnicity'].astype(str)
+            del df['Release Year']
+            del df['Origin/Ethnicity']
+            # Apply the cheap filters first so only the remaining plots are normalized and tokenized
+            df = df[(df.year > MIN_YEAR) & df.origin.isin(ORIGINS)].copy()
+            if df.empty:
+                continue
+
+            df['Plot'] = normalize_plots(df['Plot'])
+            df['n_tokens'] = count_tokens(df['Plot'].tolist(), executor)
+            df = df[df.n_tokens < MAX_TOKENS]
+            if df.empty:
+                continue
+
+            stats.rows_kept += len(df)
+            stats.tokens += int(df['n_tokens'].sum())
+
+            # Write the movie list with snake_case column names, appending one chunk at a time
+            movie_list = df.copy()
+            movie_list.columns = movie_list.columns.str.lower().str.replace(' ', '_')
+            movie_list.to_csv(output_csv, mode='a', index=False, header=not os.path.exists(output_csv), sep=',',
+                              quoting=csv.QUOTE_NONNUMERIC, escapechar='\\', quotechar='"')
+
+            stats.preprocess_seconds += time.time() - resumed
+            yield df
+            resumed = time.time()
+    stats.preprocess_seconds += time.time() - resumed
+
+# Reads movie_list.csv back as {id: (plot, metadata)}, with the metadata named as in the index
+def load_movie_list(file_name: str = 'movie_list.csv') -> Dict[str, Tuple[str, Dict[str, Any]]]:
+    df = pd.read_csv(file_name, escapechar='\\')
+    movies = {}
+    for row in df.to_dict(orient='records'):
+        metadata = {name: row[column] for column, name in METADATA_COLUMNS.items() if column in row}
+        movies[str(row['id'])] = (row['plot'], metadata)
+    return movies
+
+if __name__ == "__main__":
+    FILE_NAME = 'wiki_movie_plots_deduped.csv'
+    stats = PreprocessStats()
+    for _ in preprocess_movies(FILE_NAME, stats=stats):
+        pass
+    stats.report()
+    print("CSV file created: movie_list.csv")
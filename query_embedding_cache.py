@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import re
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import redis
+from langchain_core.embeddings import Embeddings
+
+from instrumentation import span
+
+def normalize_query(text: str) -> str:
+    return re.sub(r'\s+', ' ', text).strip().lower()
+
+# Two-tier cache for query embeddings, wrapped around the embeddings used by the retriever:
+#   1. an in-process LRU, so a repeated question in the same process skips the network entirely
+#   2. a shared Redis tier with a TTL, so a question embedded by one app replica is reused by all of them
+# Keys are the normalized query text and the embedding deployment name. Documents are passed straight through.
+class QueryEmbeddingCache(Embeddings):
+    def __init__(self, embedding: Embeddings, deployment: str, redis_url: Optional[str] = None,
+                 max_size: int = 1024, ttl: int = 86400, key_prefix: str = "query_embedding",
+                 client: Optional[redis.Redis] = None):
+        self.embedding = embedding
+        self.deployment = deployment
+        self.max_size = max_size
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+        # An existing client can be passed in to share its connection pool
+        self.client = client or (redis.Redis.from_url(redis_url) if redis_url else None)
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, text: str) -> str:
+        digest = hashlib.sha256(normalize_query(text).encode('utf-8')).hexdigest()
+        return f"{self.key_prefix}:{self.deployment}:{digest}"
+
+    # `count` is False for lookups that aren't a query being answered (prefetch), so they stay out of the hit rates
+    def _get_local(self, key: str, count: bool = True) -> Optional[List[float]]:
+        with self._lock:
+            vector = self._local.get(key)
+            if vector is not None:
+                self._local.move_to_end(key)
+                self.local_hits += count
+            return vector
+
+    def _put_local(self, key: str, vector: List[float]):
+        with self._lock:
+            self._local[key] = vector
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+
+    def _get_shared(self, key: str, count: bool = True) -> Optional[List[float]]:
+        if self.client is None:
+            return None
+        # The shared tier is an optimisation, a Redis error falls through to the embedding call
+        try:
+            blob = self.client.get(key)
+        except redis.RedisError:
+            return None
+        if blob is None:
+            return None
+        vector = array('f', blob).tolist()
+        with self._lock:
+            self.redis_hits += count
+        self._put_local(key, vector)
+        return vector
+
+    def _put_shared(self, key: str, vector: List[float]):
+        if self.client is None:
+            return
+        try:
+            self.client.set(key, array('f', vector).tobytes(), ex=self.ttl)
+        except redis.RedisError:
+            pass
+
+    def _lookup(self, key: str, count: bool = True) -> Tuple[Optional[List[float]], Optional[str]]:
+        # (vector, the tier it was found in) or (None, None)
+        vector = self._get_local(key, count)
+        if vector is not None:
+            return vector, 'local'
+        return self._lookup_shared(key, count)
+
+    def _lookup_shared(self, key: str, count: bool = True) -> Tuple[Optional[List[float]], Optional[str]]:
+        vector = self._get_shared(key, count)
+        if vector is not None:
+            return vector, 'redis'
+        with self._lock:
+            self.misses += count
+        return None, None
+
+    def _store(self, key: str, vector: List[float]):
+        self._put_local(key, vector)
+        self._put_shared(key, vector)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self._key(text)
+        with span('query_embedding') as fields:
+            vector, tier = self._lookup(key)
+            fields.update(cache_hit=vector is not None, cache=tier or 'miss')
+            if vector is None:
+                vector = self.embedding.embed_query(text)
+                self._store(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        # The shared tier is read and written on the executor, redis-py calls would block the event loop
+        loop = asyncio.get_running_loop()
+        key = self._key(text)
+        with span('query_embedding') as fields:
+            vector, tier = self._get_local(key), 'local'
+            if vector is None:
+                vector, tier = await loop.run_in_executor(None, self._lookup_shared, key)
+            fields.update(cache_hit=vector is not None, cache=tier or 'miss')
+            if vector is None:
+                vector = await self.embedding.aembed_query(text)
+                self._put_local(key, vector)
+                if self.client is not None:
+                    await loop.run_in_executor(None, self._put_shared, key, vector)
+        return vector
+
+    # Embeds the uncached `texts` with one embed_documents call (split into requests of the embedding's chunk size)
+    # and caches them, so the embed_query calls that follow are cache hits. Used to embed a batch of questions at once.
+    def prefetch(self, texts: List[str]) -> int:
+        keys = {}
+        for text in texts:
+            key = self._key(text)
+            if key not in keys and self._lookup(key, count=False)[0] is None:
+                keys[key] = text
+        if keys:
+            with span('query_embedding', batch=len(keys), cache_hit=False):
+                vectors = self.embedding.embed_documents(list(keys.values()))
+            for key, vector in zip(keys, vectors):
+                self._store(key, vector)
+        return len(keys)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embedding.embed_documents(texts)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.embedding.aembed_documents(texts)
+
+    # Empties the in-process tier, the shared tier expires on its TTL
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'local_hits': self.local_hits,
+                'redis_hits': self.redis_hits,
+                'misses': self.misses,
+                'local_size': len(self._local),
+            }
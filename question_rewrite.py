@@ -0,0 +1,104 @@
+import re
+from typing import Dict
+
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import Runnable, RunnableLambda, RunnablePassthrough
+from langchain_core.language_models import BaseChatModel
+
+# Words that usually point back at an earlier turn ("what years has HE been in movies?", "show THOSE as a table").
+# The check is deliberately generous: a false positive only costs the rewrite LLM call we used to make on every turn.
+REFERENCE_WORDS = {
+    'he', 'him', 'his', 'himself', 'she', 'her', 'hers', 'herself', 'they', 'them', 'their', 'theirs', 'themselves',
+    'it', 'its', 'itself', 'this', 'that', 'these', 'those', 'one', 'ones', 'former', 'latter',
+    'same', 'above', 'previous', 'previously', 'earlier', 'before', 'last', 'again', 'instead', 'else',
+    'also', 'too', 'more', 'other', 'others', 'another', 'first', 'second', 'third', 'rest', 'both', 'either', 'neither',
+    'list', 'table', 'format', 'display', 'summarise', 'summarize', 'shorter', 'longer',
+}
+CONTINUATION_WORDS = {'and', 'or', 'but', 'so', 'then', 'what', 'how', 'why'}
+# "THE movie", "THE sequel", "THE main villain": a definite noun phrase about a movie that isn't named in the question
+DEFINITE_NOUNS = {
+    'movie', 'movies', 'film', 'films', 'picture', 'sequel', 'sequels', 'prequel', 'prequels', 'remake', 'original',
+    'franchise', 'series', 'trilogy', 'book', 'novel', 'plot', 'story', 'storyline', 'ending', 'end', 'beginning',
+    'twist', 'scene', 'scenes', 'cast', 'director', 'directors', 'actor', 'actors', 'actress', 'actresses', 'star',
+    'stars', 'lead', 'leads', 'hero', 'heroine', 'villain', 'villains', 'character', 'characters', 'protagonist',
+    'runtime', 'length', 'budget', 'rating', 'ratings', 'reviews', 'genre', 'release', 'year', 'screenplay', 'script',
+    'writer', 'writers', 'producer', 'studio', 'soundtrack', 'music', 'score', 'trailer', 'setting', 'title',
+}
+SUPERLATIVES = {'best', 'worst', 'most', 'least', 'top', 'better', 'worse'}
+
+def _words(text: str):
+    return re.findall(r"[a-z0-9']+", text.lower())
+
+def _definite_reference(words) -> bool:
+    # the noun may follow an adjective ("the main villain", "the original movie")
+    return any(word == 'the' and DEFINITE_NOUNS.intersection(words[n + 1:n + 3]) for n, word in enumerate(words))
+
+def _bare_superlative(words) -> bool:
+    # "which is the best?", "which is the most popular?": a superlative with nothing it applies to
+    if 'the' not in words:
+        return False
+    tail = words[len(words) - words[::-1].index('the'):]
+    if tail[:1] in (['most'], ['least']):
+        return len(tail) == 2
+    return len(tail) == 1 and (tail[0] in SUPERLATIVES or tail[0].endswith('est'))
+
+def needs_rewrite(question: str) -> bool:
+    words = _words(question)
+    if any(word in REFERENCE_WORDS for word in words):
+        return True
+    if _definite_reference(words) or _bare_superlative(words):
+        return True
+    # very short follow ups ("and 1987?", "why?", "what about comedies?") only make sense with the previous turn
+    if len(words) <= 3 and (not words or words[0] in CONTINUATION_WORDS):
+        return True
+    return words[:2] in (['what', 'about'], ['how', 'about'])
+
+def same_question(a: str, b: str) -> bool:
+    return _words(a) == _words(b)
+
+# Whether the chain sends the turn `x` ({"input", "chat_history"}) through the rewrite LLM call
+def wants_rewrite(x: Dict, fast_path: bool = True) -> bool:
+    # Both empty string and empty list evaluate to False
+    if not x.get("chat_history", False):
+        return False
+    return not fast_path or needs_rewrite(x["input"])
+
+def create_rewrite_chain(llm: BaseChatModel, contextualize_q_prompt: Runnable) -> Runnable:
+    return (contextualize_q_prompt | llm | StrOutputParser()).with_config(run_name="rewrite_question")
+
+# Rewrite stage of the RAG chain, producing `standalone_question` and the retrieved `context`.
+# The contextualize LLM call is skipped when there is no chat history, or when the question has no references
+# to earlier turns. For turns that do need a rewrite, `speculative` starts retrieval on the raw question at the same
+# time as the rewrite and keeps those results if the rewrite came back unchanged, otherwise it retrieves again.
+def create_rewrite_and_retrieve_chain(llm: BaseChatModel, retriever: BaseRetriever, contextualize_q_prompt: Runnable,
+                                      fast_path: bool = True, speculative: bool = False) -> Runnable:
+    rewrite = create_rewrite_chain(llm, contextualize_q_prompt)
+    retrieve = ((lambda x: x["standalone_question"]) | retriever).with_config(run_name="retrieve_documents")
+    no_rewrite = RunnablePassthrough.assign(standalone_question=lambda x: x["input"]).assign(context=retrieve)
+    retrieve_only = RunnablePassthrough.assign(context=retrieve)
+    rewrite_then_retrieve = RunnablePassthrough.assign(standalone_question=rewrite).assign(context=retrieve)
+
+    def keep_valid_retrieval(x):
+        if same_question(x["standalone_question"], x["input"]):
+            return x["speculative_context"]
+        return retrieve
+
+    speculative_rewrite = (
+        RunnablePassthrough.assign(
+            standalone_question=rewrite,
+            speculative_context=((lambda x: x["input"]) | retriever).with_config(run_name="speculative_retrieve_documents"),
+        )
+        | RunnablePassthrough.assign(context=keep_valid_retrieval)
+        | (lambda x: {key: value for key, value in x.items() if key != "speculative_context"})
+    )
+
+    def route(x):
+        # Callers that have rewritten the question already (batch-chat.py) pass it in as `standalone_question`
+        if x.get("standalone_question"):
+            return retrieve_only
+        if not wants_rewrite(x, fast_path):
+            return no_rewrite
+        return speculative_rewrite if speculative else rewrite_then_retrieve
+
+    return RunnableLambda(route).with_config(run_name="chat_retriever_chain")
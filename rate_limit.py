@@ -0,0 +1,140 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from typing import Mapping, Optional
+
+# Request priorities, lower goes first: chat turns, background work of the chat apps (history summaries), batch jobs
+INTERACTIVE = 0
+BACKGROUND = 1
+BATCH = 2
+
+# Token bucket shared across worker threads that limits both requests per minute (RPM)
+# and tokens per minute (TPM), matching how Azure OpenAI deployment quotas are expressed.
+# Waiting requests are served in priority order, and requests below INTERACTIVE priority leave `reserve` (a share of
+# each bucket) to interactive ones. update_from_headers() keeps the buckets in step with the service's own count,
+# which also covers the other processes and replicas using the same deployment.
+class RateLimiter:
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int, reserve: float = 0.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.reserve = reserve
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiting = []
+        self._tickets = itertools.count()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    def _enqueue(self, priority: int) -> tuple:
+        ticket = (priority, next(self._tickets))
+        heapq.heappush(self._waiting, ticket)
+        if self._waiting[0] == ticket:
+            # A new first in line, the previous one goes back to waiting its turn
+            self._changed.notify_all()
+        return ticket
+
+    def _dequeue(self, ticket: tuple):
+        if ticket in self._waiting:
+            self._waiting.remove(ticket)
+            heapq.heapify(self._waiting)
+            self._changed.notify_all()
+
+    def _try_acquire(self, ticket: tuple, tokens: int) -> Optional[float]:
+        # 0 when acquired, otherwise seconds to wait (None: until the requests ahead are served)
+        self._refill()
+        now = time.monotonic()
+        if self._paused_until > now:
+            return self._paused_until - now
+        if self._waiting[0] != ticket:
+            return None
+        # What has to be left in the buckets for this request to go
+        floor = self.reserve if ticket[0] > INTERACTIVE else 0.0
+        needed_requests = min(1 + floor * self.requests_per_minute, self.requests_per_minute)
+        needed_tokens = min(tokens + floor * self.tokens_per_minute, self.tokens_per_minute)
+        if self._requests >= needed_requests and self._tokens >= needed_tokens:
+            self._requests -= 1
+            self._tokens -= tokens
+            self._dequeue(ticket)
+            return 0
+        return max(
+            (needed_requests - self._requests) * 60 / self.requests_per_minute,
+            (needed_tokens - self._tokens) * 60 / self.tokens_per_minute,
+            0.01)
+
+    def acquire(self, tokens: int = 0, priority: int = INTERACTIVE):
+        # A single request larger than the whole TPM budget would never fit, so cap it
+        tokens = min(tokens, self.tokens_per_minute)
+        with self._changed:
+            ticket = self._enqueue(priority)
+            try:
+                while True:
+                    wait = self._try_acquire(ticket, tokens)
+                    if wait == 0:
+                        return
+                    self._changed.wait(wait)
+            finally:
+                self._dequeue(ticket)
+
+    async def aacquire(self, tokens: int = 0, priority: int = INTERACTIVE):
+        # As acquire(), without blocking the event loop. The lock is only held for the bookkeeping.
+        tokens = min(tokens, self.tokens_per_minute)
+        with self._lock:
+            ticket = self._enqueue(priority)
+        try:
+            while True:
+                with self._lock:
+                    wait = self._try_acquire(ticket, tokens)
+                if wait == 0:
+                    return
+                await asyncio.sleep(min(wait or 0.01, 1.0))
+        finally:
+            with self._lock:
+                self._dequeue(ticket)
+
+    def refund(self, tokens: int):
+        # Gives back the part of an estimate the request didn't use
+        if tokens <= 0:
+            return
+        with self._changed:
+            self._refill()
+            self._tokens = min(self.tokens_per_minute, self._tokens + tokens)
+            self._changed.notify_all()
+
+    def update(self, remaining_requests: Optional[float] = None, remaining_tokens: Optional[float] = None,
+               retry_after: Optional[float] = None):
+        with self._changed:
+            self._refill()
+            if remaining_requests is not None:
+                self._requests = min(self._requests, remaining_requests)
+            if remaining_tokens is not None:
+                self._tokens = min(self._tokens, remaining_tokens)
+            if retry_after:
+                # Throttled: nothing is sent until the service says it can take requests again
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            self._changed.notify_all()
+
+    # Azure OpenAI returns the quota left in x-ratelimit-remaining-requests/-tokens, and how long to back off after a
+    # 429 in retry-after-ms or retry-after
+    def update_from_headers(self, headers: Mapping[str, str], status_code: int = 200):
+        def number(name: str) -> Optional[float]:
+            try:
+                return float(headers[name])
+            except (KeyError, TypeError, ValueError):
+                return None
+
+        retry_after = None
+        if status_code == 429:
+            retry_after = number('retry-after-ms')
+            retry_after = retry_after / 1000 if retry_after is not None else number('retry-after') or 1.0
+        self.update(number('x-ratelimit-remaining-requests'), number('x-ratelimit-remaining-tokens'), retry_after)
@@ -0,0 +1,291 @@
+import math
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import yaml
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+from langchain_community.vectorstores import Redis as RedisVectorStore
+
+from chunking import CHUNK_SCHEMA_FILE, collapse_chunks
+from instrumentation import span
+from lexical_search import LocalBM25Index, fulltext_query, reciprocal_rank_fusion
+from metadata_query import ConstraintParser, LocalMetadataIndex, MovieConstraints, RedisMetadataIndex, redis_filter
+from movie_neighbours import MovieNeighbourGraph, SimilarMovies
+from preprocessing import load_movie_list
+
+# Vector similarity retriever that keeps each movie's relevance score (0..1, higher is more similar)
+# in doc.metadata['score'], so the context packing stage can apply a score cutoff and rerank.
+class ScoredVectorRetriever(BaseRetriever):
+    vectorstore: VectorStore
+    k: int = 10
+    filter: Optional[Any] = None
+
+    def search(self, query: str, filter: Optional[Any] = None) -> List[Document]:
+        kwargs = {"filter": filter} if filter is not None else {}
+        docs = []
+        with span('vector_search', mode='vector', filtered=filter is not None) as fields:
+            for doc, score in self.vectorstore.similarity_search_with_relevance_scores(query, k=self.k, **kwargs):
+                doc.metadata["score"] = score
+                docs.append(with_movie_id(doc))
+            fields['results'] = len(docs)
+        return docs
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.search(query, filter=self.filter)
+
+def with_movie_id(doc: Document) -> Document:
+    # Redis returns the document key ("doc:movieindex:<movie id>") as the id
+    doc.metadata["id"] = str(doc.metadata.get("id")).split(":")[-1]
+    return doc
+
+# Fields of a Redis vector index, read from the schema file written by create-redis-index.py (redis_schema.yaml, or
+# CHUNK_SCHEMA_FILE for the plot chunk index). HybridRetriever builds its queries from these with redis-py alone,
+# rather than through the internals of the LangChain Redis store.
+class RedisIndexSchema:
+    def __init__(self, schema: Dict[str, List[Dict[str, Any]]]):
+        vector = (schema.get('vector') or [{}])[0]
+        self.vector_field = vector.get('name', 'content_vector')
+        self.dtype = np.float64 if str(vector.get('datatype', 'FLOAT32')).upper() == 'FLOAT64' else np.float32
+        self.distance_metric = str(vector.get('distance_metric', 'COSINE')).upper()
+        # LangChain stores the page content in the `content` text field
+        self.content_field = 'content'
+        self.metadata_fields = [field['name'] for group in ('text', 'tag', 'numeric') for field in schema.get(group) or []
+                                if field['name'] != self.content_field]
+
+    @classmethod
+    def load(cls, path: str) -> "RedisIndexSchema":
+        with open(path) as f:
+            return cls(yaml.safe_load(f) or {})
+
+    def relevance(self, distance: float) -> float:
+        # 0..1 relevance scores, as the LangChain Redis store computes them for each distance metric
+        if self.distance_metric == 'L2':
+            return 1.0 - distance / math.sqrt(2)
+        if self.distance_metric == 'IP':
+            return 1.0 - distance if distance > 0 else -distance
+        return 1.0 - distance
+
+# Hybrid retriever: a full-text (BM25) query over Title/Cast/Plot runs alongside the KNN query, and the two rankings
+# are merged with reciprocal rank fusion, so exact title and name matches ("Tell me about Top Gun") are found with a
+# small k. On Redis both queries go out in one pipelined round trip. Otherwise, or if the full-text query fails, the
+# lexical side comes from `lexical_index` (a local BM25 index over movie_list.csv). The Redis queries need `index_schema`,
+# without it (or if the Redis queries fail) the store's own similarity search is used.
+# Movies found by vector search keep their relevance score in metadata['score']. Movies only found by the full-text
+# query get the score of the weakest vector match, so the context packing cutoff treats them as borderline matches.
+class HybridRetriever(BaseRetriever):
+    vectorstore: VectorStore
+    k: int = 6
+    candidates: int = 20
+    rrf_k: int = 60
+    lexical_index: Optional[LocalBM25Index] = None
+    index_schema: Optional[RedisIndexSchema] = None
+    filter: Optional[Any] = None
+
+    def redis_search(self, query: str, filter: Optional[Any] = None) -> Tuple[List[Document], List[Document]]:
+        from redis.commands.search.query import Query
+        from redis.commands.search.result import Result
+
+        if self.index_schema is None:
+            raise ValueError("no index schema")
+        store, schema = self.vectorstore, self.index_schema
+        vector = np.asarray(store.embeddings.embed_query(query), dtype=schema.dtype).tobytes()
+        queries = [
+            Query(f"({filter if filter is not None else '*'})=>[KNN {self.candidates} @{schema.vector_field} $vector AS distance]")
+            .sort_by("distance")
+            .return_fields(schema.content_field, "distance", *schema.metadata_fields)
+            .paging(0, self.candidates)
+            .dialect(2)]
+        text = fulltext_query(query)
+        if text:
+            queries.append(
+                Query(f"({filter}) {text}" if filter is not None else text)
+                .scorer("BM25")
+                .return_fields(schema.content_field, *schema.metadata_fields)
+                .paging(0, self.candidates)
+                .dialect(2))
+
+        pipe = store.client.ft(store.index_name).pipeline(transaction=False)
+        pipe.search(queries[0], {"vector": vector})
+        if text:
+            pipe.search(queries[1])
+        results = [response if isinstance(response, Result) else Result(response, True) for response in pipe.execute()]
+
+        rankings = []
+        for result in results:
+            docs = []
+            for row in result.docs:
+                metadata = {field: getattr(row, field) for field in schema.metadata_fields if hasattr(row, field)}
+                doc = Document(page_content=getattr(row, schema.content_field, ''), metadata={**metadata, "id": row.id})
+                if hasattr(row, "distance"):
+                    doc.metadata["score"] = schema.relevance(float(row.distance))
+                docs.append(with_movie_id(doc))
+            rankings.append(docs)
+        return rankings[0], rankings[1] if len(rankings) > 1 else []
+
+    def local_search(self, query: str, filter: Optional[Any] = None) -> Tuple[List[Document], List[Document]]:
+        kwargs = {"filter": filter} if filter is not None else {}
+        vector_docs = [with_movie_id(doc) for doc in self._scored(query, **kwargs)]
+        # The local index can't apply a metadata filter, so filtered searches only use vector search
+        text_docs = self.lexical_index.search(query, k=self.candidates) if filter is None and self.lexical_index else []
+        return vector_docs, text_docs
+
+    def search(self, query: str, filter: Optional[Any] = None) -> List[Document]:
+        with span('vector_search', mode='hybrid', filtered=filter is not None) as fields:
+            if isinstance(self.vectorstore, RedisVectorStore):
+                try:
+                    vector_docs, text_docs = self.redis_search(query, filter=filter)
+                except Exception as e:
+                    print(f"Hybrid search failed, using vector search{' and the local BM25 index' if self.lexical_index else ''}: {e}")
+                    vector_docs, text_docs = self.local_search(query, filter=filter)
+            else:
+                vector_docs, text_docs = self.local_search(query, filter=filter)
+            fields['results'] = len(vector_docs) + len(text_docs)
+
+        docs = reciprocal_rank_fusion([vector_docs, text_docs], k=self.k, rrf_k=self.rrf_k)
+        scores = [doc.metadata["score"] for doc in vector_docs if "score" in doc.metadata]
+        for doc in docs:
+            if "score" not in doc.metadata and scores:
+                doc.metadata["score"] = min(scores)
+        return docs
+
+    def _scored(self, query: str, **kwargs) -> List[Document]:
+        docs = []
+        for doc, score in self.vectorstore.similarity_search_with_relevance_scores(query, k=self.candidates, **kwargs):
+            doc.metadata["score"] = score
+            docs.append(doc)
+        return docs
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.search(query, filter=self.filter)
+
+# Search over the plot chunk index (see chunking.py). `retriever` (vector or hybrid search over the chunks) fetches
+# `k * chunks_per_movie` chunks, which are collapsed into the top `k` movies, each with only its matching chunks.
+# Has the same search(query, filter) as the other search retrievers, so filtered searches also run on the chunks.
+class ChunkedRetriever(BaseRetriever):
+    retriever: BaseRetriever
+    k: int = 6
+    debug: bool = False
+
+    def search(self, query: str, filter: Optional[Any] = None) -> List[Document]:
+        chunks = self.retriever.search(query, filter=filter)
+        docs = collapse_chunks(chunks, k=self.k)
+        if self.debug:
+            print(f"Retrieval: {len(chunks)} plot chunks -> {len(docs)} movies")
+        return docs
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.search(query)
+
+# Routes each question between an exact metadata lookup and vector search:
+#   - no year/cast/director/genre/origin constraints: plain (or hybrid) search with `retriever`
+#   - constraints only ("movies released in 1987"): exact lookup on the index fields, no embedding call
+#   - constraints plus a plot or theme ("Tom Cruise movies about fighter pilots"): vector search filtered by the constraints
+# Lookups use `index` and fall back to `fallback_index` (e.g. the local index built from movie_list.csv) if it fails.
+class MetadataQueryRetriever(BaseRetriever):
+    retriever: BaseRetriever
+    parser: ConstraintParser
+    index: Any
+    fallback_index: Optional[Any] = None
+    max_results: int = 50
+    debug: bool = False
+
+    def lookup(self, constraints: MovieConstraints) -> List[Document]:
+        with span('metadata_lookup') as fields:
+            try:
+                docs = self.index.search(constraints, limit=self.max_results)
+            except Exception as e:
+                if self.fallback_index is None:
+                    raise
+                print(f"Metadata lookup failed, using the local index: {e}")
+                fields['fallback'] = True
+                docs = self.fallback_index.search(constraints, limit=self.max_results)
+            fields['results'] = len(docs)
+        return docs
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        constraints = self.parser.parse(query)
+        if not constraints:
+            route, docs = "vector search", self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        elif constraints.is_lookup:
+            route, docs = "metadata lookup", self.lookup(constraints)
+        else:
+            route, docs = "filtered vector search", self.retriever.search(query, filter=redis_filter(constraints))
+        if self.debug:
+            print(f"Retrieval: {route} {constraints} -> {len(docs)} movies")
+        return docs
+
+# "Movies like <title>" questions are answered from the precomputed neighbour graph (see movie_neighbours.py), without
+# an embedding call or KNN query. Anything else, including titles that aren't in the graph, goes to `retriever`.
+class SimilarMoviesRetriever(BaseRetriever):
+    retriever: BaseRetriever
+    similar_movies: SimilarMovies
+    k: int = 6
+    debug: bool = False
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        with span('neighbour_lookup') as fields:
+            docs = self.similar_movies.search(query, k=self.k)
+            fields['matched'] = docs is not None
+        if docs is None:
+            return self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        if self.debug:
+            title = docs[0].metadata['similar_to'] if docs else None
+            print(f"Retrieval: neighbour graph (like {title}) -> {len(docs)} movies")
+        return docs
+
+# Builds the chat retriever. `hybrid` adds full-text search to vector search (see HybridRetriever).
+# `metadata_query` is "redis" (lookups on the RediSearch index, falling back to the local index), "local" (lookups on
+# an inverted index built from movie_list.csv, always used with the local vector store) or "0" (vector search only).
+# Cast and director names, and the local BM25 and lookup indexes, need movie_list.csv. "Movies like X" questions use
+# the `neighbours_file` graph written by the index scripts, if it exists. With a `chunk_vectorstore` (the plot chunk
+# index), vector and hybrid search run on plot chunks, `chunks_per_movie` chunks per movie returned (see ChunkedRetriever).
+# `schema_file` is the schema of the Redis movie index the apps load the vector store with.
+def create_retriever(vectorstore: VectorStore, k: int = 6, hybrid: bool = True, hybrid_candidates: int = 20,
+                     metadata_query: str = "redis", movie_list: str = "movie_list.csv", max_results: int = 50,
+                     neighbours_file: str = "movie_neighbours.npz", chunk_vectorstore: Optional[VectorStore] = None,
+                     chunks_per_movie: int = 3, schema_file: str = "redis_schema.yaml",
+                     debug: bool = False) -> BaseRetriever:
+    movies = load_movie_list(movie_list) if os.path.exists(movie_list) else None
+    retriever = _create_search_retriever(vectorstore, movies, k=k, hybrid=hybrid, hybrid_candidates=hybrid_candidates,
+                                         metadata_query=metadata_query, movie_list=movie_list, max_results=max_results,
+                                         chunk_vectorstore=chunk_vectorstore, chunks_per_movie=chunks_per_movie,
+                                         schema_file=schema_file, debug=debug)
+    if movies and neighbours_file and os.path.exists(neighbours_file):
+        similar_movies = SimilarMovies(MovieNeighbourGraph.load(neighbours_file), movies)
+        retriever = SimilarMoviesRetriever(retriever=retriever, similar_movies=similar_movies, k=k, debug=debug)
+    return retriever
+
+def _create_search_retriever(vectorstore: VectorStore, movies, k: int, hybrid: bool, hybrid_candidates: int,
+                             metadata_query: str, movie_list: str, max_results: int,
+                             chunk_vectorstore: Optional[VectorStore] = None, chunks_per_movie: int = 3,
+                             schema_file: str = "redis_schema.yaml", debug: bool = False) -> BaseRetriever:
+    search_store, search_k = (chunk_vectorstore, k * chunks_per_movie) if chunk_vectorstore is not None else (vectorstore, k)
+    if hybrid:
+        schema_file = CHUNK_SCHEMA_FILE if chunk_vectorstore is not None else schema_file
+        schema = RedisIndexSchema.load(schema_file) if isinstance(search_store, RedisVectorStore) and os.path.exists(schema_file) else None
+        retriever = HybridRetriever(vectorstore=search_store, k=search_k, candidates=max(hybrid_candidates, search_k),
+                                    lexical_index=LocalBM25Index(movies) if movies else None, index_schema=schema)
+    else:
+        retriever = ScoredVectorRetriever(vectorstore=search_store, k=search_k)
+    if chunk_vectorstore is not None:
+        retriever = ChunkedRetriever(retriever=retriever, k=k, debug=debug)
+    if metadata_query == "0":
+        return retriever
+    if metadata_query == "redis" and not isinstance(vectorstore, RedisVectorStore):
+        metadata_query = "local"
+    if metadata_query == "local" and not movies:
+        print(f"Movie list '{movie_list}' not found, metadata lookups are disabled")
+        return retriever
+
+    parser = ConstraintParser.from_movies(movies) if movies else ConstraintParser()
+    local_index = LocalMetadataIndex(movies) if movies else None
+    if metadata_query == "local":
+        index, fallback_index = local_index, None
+    else:
+        index, fallback_index = RedisMetadataIndex(vectorstore.client, vectorstore.index_name), local_index
+    return MetadataQueryRetriever(retriever=retriever, parser=parser, index=index, fallback_index=fallback_index,
+                                  max_results=max_results, debug=debug)
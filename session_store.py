@@ -0,0 +1,190 @@
+import json
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+import redis
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.messages.utils import count_tokens_approximately
+
+# Chat session stores used by ChatHistoryManager. A session is an append-only log of question/answer messages plus a
+# rolling summary that covers the first `summarized` messages of the log. Each turn appends only its two new messages,
+# and loading a session reads the summary plus the newest messages, back to the budget the prompt needs.
+#   - InMemorySessionStore: in process, for the console app and single replica deployments
+#   - RedisSessionStore: shared by every replica (no sticky sessions), messages stored as compact JSON in a Redis list
+# Sessions expire `ttl` seconds after their last write.
+
+MESSAGE_TYPES = {'h': HumanMessage, 'a': AIMessage}
+TYPE_CODES = {'human': 'h', 'ai': 'a'}
+
+class SessionWindow(NamedTuple):
+    summary: Optional[str]
+    summarized: int            # number of messages at the start of the log covered by the summary
+    first: int                 # position of messages[0] in the log
+    messages: List[BaseMessage]
+    total: int                 # number of messages in the log
+    generation: int            # incremented on reset, so a summary of the previous conversation is never saved
+
+def encode_message(message: BaseMessage) -> str:
+    # [type, approximate tokens, content], the token count lets load() stop reading once the budget is covered
+    return json.dumps([TYPE_CODES[message.type], count_tokens_approximately([message]), message.content],
+                      separators=(',', ':'), ensure_ascii=False)
+
+def decode_message(entry) -> BaseMessage:
+    code, _, content = json.loads(entry)
+    return MESSAGE_TYPES[code](content=content)
+
+def entry_tokens(entry) -> int:
+    return json.loads(entry)[1]
+
+def _decode_state(state: dict) -> dict:
+    # Works with clients created with or without decode_responses
+    return {(key.decode('utf-8') if isinstance(key, bytes) else key): (value.decode('utf-8') if isinstance(value, bytes) else value)
+            for key, value in state.items()}
+
+class InMemorySessionStore:
+    def __init__(self, ttl: int = 86400):
+        self.ttl = ttl
+        self._sessions: Dict[str, dict] = {}
+        self._last_sweep = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _session(self, session_id: str) -> dict:
+        now = time.monotonic()
+        # Expired sessions are swept at most once a minute
+        if now - self._last_sweep > 60:
+            self._last_sweep = now
+            for expired in [id for id, session in self._sessions.items() if now - session['updated'] > self.ttl]:
+                del self._sessions[expired]
+        return self._sessions.setdefault(session_id, {'messages': [], 'summary': None, 'summarized': 0,
+                                                      'generation': 0, 'updated': now})
+
+    def append(self, session_id: str, messages: List[BaseMessage]):
+        with self._lock:
+            session = self._session(session_id)
+            session['messages'].extend(encode_message(message) for message in messages)
+            session['updated'] = time.monotonic()
+
+    def load(self, session_id: str, max_tokens: int) -> SessionWindow:
+        with self._lock:
+            session = self._session(session_id)
+            entries = session['messages']
+            first, tokens = len(entries), 0
+            while first > session['summarized'] and tokens < max_tokens:
+                first -= 1
+                tokens += entry_tokens(entries[first])
+            return SessionWindow(session['summary'], session['summarized'], first,
+                                 [decode_message(entry) for entry in entries[first:]], len(entries), session['generation'])
+
+    def range(self, session_id: str, start: int, stop: int) -> List[BaseMessage]:
+        with self._lock:
+            return [decode_message(entry) for entry in self._session(session_id)['messages'][start:stop]]
+
+    def set_summary(self, session_id: str, summary: Optional[str], summarized: int, generation: int) -> bool:
+        with self._lock:
+            session = self._session(session_id)
+            if session['generation'] != generation or summarized <= session['summarized']:
+                return False
+            session['summary'] = summary if summary is not None else session['summary']
+            session['summarized'] = summarized
+            session['updated'] = time.monotonic()
+            return True
+
+    def reset(self, session_id: str):
+        with self._lock:
+            session = self._session(session_id)
+            session.update(messages=[], summary=None, summarized=0, generation=session['generation'] + 1,
+                           updated=time.monotonic())
+
+    def transcript(self, session_id: str, limit: Optional[int] = None) -> List[BaseMessage]:
+        with self._lock:
+            entries = self._session(session_id)['messages']
+            return [decode_message(entry) for entry in (entries[-limit:] if limit else entries)]
+
+# Keys per session: `{prefix}:{id}:messages` (list of encoded messages) and `{prefix}:{id}:state` (hash with the
+# summary, summarized count and generation). Messages are only ever RPUSHed, the summary only moves forward.
+class RedisSessionStore:
+    def __init__(self, client: redis.Redis, ttl: int = 86400, key_prefix: str = "chat_session", page_size: int = 16):
+        self.client = client
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+        self.page_size = page_size
+
+    def _keys(self, session_id: str):
+        return f"{self.key_prefix}:{session_id}:messages", f"{self.key_prefix}:{session_id}:state"
+
+    def append(self, session_id: str, messages: List[BaseMessage]):
+        messages_key, state_key = self._keys(session_id)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.rpush(messages_key, *[encode_message(message) for message in messages])
+        pipe.expire(messages_key, self.ttl)
+        pipe.expire(state_key, self.ttl)
+        pipe.execute()
+
+    def load(self, session_id: str, max_tokens: int) -> SessionWindow:
+        messages_key, state_key = self._keys(session_id)
+        # The state, the length and the newest page in one round trip, older pages only if the budget isn't covered
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hgetall(state_key)
+        pipe.llen(messages_key)
+        pipe.lrange(messages_key, -self.page_size, -1)
+        state, total, entries = pipe.execute()
+        state = _decode_state(state)
+        summary = state.get('summary') or None
+        summarized = int(state.get('summarized', 0))
+        generation = int(state.get('generation', 0))
+
+        first = total - len(entries)
+        tokens = sum(entry_tokens(entry) for entry in entries)
+        while first > summarized and tokens < max_tokens:
+            start = max(summarized, first - self.page_size)
+            page = self.client.lrange(messages_key, start, first - 1)
+            if not page:
+                break
+            entries = page + entries
+            first = start
+            tokens += sum(entry_tokens(entry) for entry in page)
+        # Only messages the summary doesn't cover, and only as many as the budget needs
+        skip = max(summarized - first, 0)
+        tokens -= sum(entry_tokens(entry) for entry in entries[:skip])
+        while skip < len(entries) - 1 and tokens - entry_tokens(entries[skip]) >= max_tokens:
+            tokens -= entry_tokens(entries[skip])
+            skip += 1
+        entries, first = entries[skip:], first + skip
+        return SessionWindow(summary, summarized, first, [decode_message(entry) for entry in entries], total, generation)
+
+    def range(self, session_id: str, start: int, stop: int) -> List[BaseMessage]:
+        if stop <= start:
+            return []
+        messages_key, _ = self._keys(session_id)
+        return [decode_message(entry) for entry in self.client.lrange(messages_key, start, stop - 1)]
+
+    def set_summary(self, session_id: str, summary: Optional[str], summarized: int, generation: int) -> bool:
+        _, state_key = self._keys(session_id)
+
+        def update(pipe) -> bool:
+            state = _decode_state(pipe.hgetall(state_key))
+            if int(state.get('generation', 0)) != generation or summarized <= int(state.get('summarized', 0)):
+                return False
+            pipe.multi()
+            pipe.hset(state_key, 'summarized', summarized)
+            if summary is not None:
+                pipe.hset(state_key, 'summary', summary)
+            pipe.expire(state_key, self.ttl)
+            return True
+
+        # WATCH the state, so replicas compacting the same session at the same time can't move it backwards
+        return self.client.transaction(update, state_key, value_from_callable=True)
+
+    def reset(self, session_id: str):
+        messages_key, state_key = self._keys(session_id)
+        pipe = self.client.pipeline()
+        pipe.delete(messages_key)
+        pipe.hdel(state_key, 'summary', 'summarized')
+        pipe.hincrby(state_key, 'generation', 1)
+        pipe.expire(state_key, self.ttl)
+        pipe.execute()
+
+    def transcript(self, session_id: str, limit: Optional[int] = None) -> List[BaseMessage]:
+        messages_key, _ = self._keys(session_id)
+        return [decode_message(entry) for entry in self.client.lrange(messages_key, -limit if limit else 0, -1)]
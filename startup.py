@@ -0,0 +1,103 @@
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+
+# Cold start of the chat apps (STARTUP_MODE, see "Fast startup" in the README). Importing LangChain and building the
+# clients, the vector index and the chain takes seconds, most of it before the first question is even typed.
+#   - Background runs that setup on a thread while the prompt (or the Streamlit page) is shown. The first question
+#     only waits for whatever is left of it.
+#   - warm_connections opens the Redis and Azure OpenAI (TLS) connections as part of the setup, so they are already
+#     in the connection pools when the first question is asked
+#   - warm_tokenizer loads the tiktoken encoding the embeddings count query tokens with, on the first question it
+#     would otherwise be loaded (or downloaded) before the embedding request
+#   - StartupTimer records the time of each setup phase, for the breakdown printed with DEBUG
+# Only the standard library is imported here, the apps import everything else inside their setup.
+
+class StartupTimer:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        # Seconds from the start to milestones such as 'prompt' (the app takes questions) and 'ready' (setup done)
+        self.marks: Dict[str, float] = {}
+        self.errors: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def mark(self, name: str):
+        with self._lock:
+            self.marks.setdefault(name, time.perf_counter() - self.start)
+
+    def report(self) -> str:
+        with self._lock:
+            lines = ["Startup: " + ", ".join(f"{name} after {seconds:.2f}s" for name, seconds in self.marks.items())]
+            lines += [f"  {name:<24} {seconds:>6.2f}s" for name, seconds in self.phases.items()]
+            lines += [f"  {name:<24} failed: {error}" for name, error in self.errors.items()]
+        return "\n".join(lines)
+
+# Runs `setup` on a daemon thread (so quitting doesn't wait for it). result() waits for it and re-raises its error.
+class Background:
+    def __init__(self, setup: Callable[[], Any], timer: Optional[StartupTimer] = None, name: str = "startup"):
+        self.timer = timer
+        self._future: Future = Future()
+        threading.Thread(target=self._run, args=(setup,), name=name, daemon=True).start()
+
+    def _run(self, setup: Callable[[], Any]):
+        try:
+            self._future.set_result(setup())
+        except BaseException as e:
+            self._future.set_exception(e)
+        if self.timer:
+            self.timer.mark('ready')
+
+    def done(self) -> bool:
+        return self._future.done()
+
+    def result(self) -> Any:
+        return self._future.result()
+
+# Opens a connection in the pool of each Redis client and of the HTTP client shared by the Azure OpenAI embeddings
+# and chat model. `urls` only need to be on the right host: any HTTP response, even a 404, leaves a keep-alive
+# connection with its TLS session in the pool. Failures are recorded in the timer rather than raised, the first
+# question reports them as before.
+def warm_connections(timer: StartupTimer, redis_clients: Iterable[Any] = (), http_client: Optional[Any] = None,
+                     urls: Iterable[str] = ()):
+    with timer.phase('warm-up: redis'):
+        for client in {id(client): client for client in redis_clients if client is not None}.values():
+            try:
+                client.ping()
+            except Exception as e:
+                timer.errors['warm-up: redis'] = str(e)
+    if http_client is None:
+        return
+    with timer.phase('warm-up: azure openai'):
+        for url in urls:
+            try:
+                http_client.head(url)
+            except Exception as e:
+                timer.errors['warm-up: azure openai'] = str(e)
+
+def warm_tokenizer(timer: StartupTimer, embedding: Any):
+    # The Azure OpenAI embeddings are the innermost of the wrappers (caches, governor)
+    while hasattr(embedding, 'embedding'):
+        embedding = embedding.embedding
+    model = getattr(embedding, 'tiktoken_model_name', None) or getattr(embedding, 'model', None)
+    with timer.phase('warm-up: tokenizer'):
+        try:
+            import tiktoken
+            try:
+                tiktoken.encoding_for_model(model)
+            except KeyError:
+                # as in AzureOpenAIEmbeddings, models unknown to tiktoken use cl100k_base
+                tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            timer.errors['warm-up: tokenizer'] = str(e)
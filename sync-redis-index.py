@@ -0,0 +1,165 @@
+# Incrementally syncs the Redis `movieindex` with the current movie_list.csv.
+# Rows are matched on the `id` column and compared using a per-row content fingerprint, so only new or changed
+# movies are embedded and upserted, and movies no longer in the list are deleted. The index is never dropped,
+# so it keeps serving queries while the sync runs.
+#
+# Run create-redis-index.py once to build the index (and movie_list.csv), then use this script for refreshes.
+
+import os
+import time
+from dotenv import load_dotenv
+from langchain_openai import AzureOpenAIEmbeddings
+from langchain_community.vectorstores import Redis as RedisVectorStore
+
+from answer_cache import SemanticAnswerCache
+from chunking import CHUNK_INDEX_NAME, CHUNK_SCHEMA_FILE, chunk_fingerprints, chunk_movies, create_plot_splitter
+from compression import TruncatedEmbeddings
+from ingestion import CachedEmbeddings, EmbeddingCache, document_fingerprint, load_fingerprints, save_fingerprints, delete_fingerprints
+from movie_neighbours import build_neighbour_file
+from preprocessing import load_movie_list
+from rate_limit import RateLimiter
+
+load_dotenv()
+
+API_KEY = os.getenv('API_KEY')
+RESOURCE_ENDPOINT = os.getenv('RESOURCE_ENDPOINT')
+DEPLOYMENT_NAME = os.getenv('DEPLOYMENT_NAME')
+REDIS_ENDPOINT = os.getenv('REDIS_ENDPOINT')
+REDIS_PASSWORD = os.getenv('REDIS_PASSWORD')
+
+EMBEDDING_CACHE_PATH = os.getenv('EMBEDDING_CACHE_PATH', 'embedding_cache.db')
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', '256'))
+EMBEDDING_CONCURRENCY = int(os.getenv('EMBEDDING_CONCURRENCY', '4'))
+EMBEDDING_RPM = int(os.getenv('EMBEDDING_RPM', '300'))
+EMBEDDING_TPM = int(os.getenv('EMBEDDING_TPM', '350000'))
+
+FILE_NAME = os.getenv('MOVIE_LIST', 'movie_list.csv')
+
+# Must match the VECTOR_DIMS the index was created with
+VECTOR_DIMS = int(os.getenv('VECTOR_DIMS', '0'))
+
+# "Movies like X" neighbour graph, rebuilt when the index changes (0 skips it)
+NEIGHBOURS_FILE = os.getenv('NEIGHBOURS_FILE', 'movie_neighbours.npz')
+NEIGHBOURS_N = int(os.getenv('NEIGHBOURS_N', '20'))
+
+# Also sync the plot chunk index (see chunking.py), creating it if it doesn't exist yet
+PLOT_CHUNKS = os.getenv('PLOT_CHUNKS', '0') == '1'
+PLOT_CHUNK_TOKENS = int(os.getenv('PLOT_CHUNK_TOKENS', '256'))
+PLOT_CHUNK_OVERLAP = int(os.getenv('PLOT_CHUNK_OVERLAP', '32'))
+
+if not os.path.exists(FILE_NAME):
+    raise FileNotFoundError(f"The movie list '{FILE_NAME}' was not found. Run create-redis-index.py first to create it.")
+
+start_time = time.time()
+print(f"Loading movie list {FILE_NAME}...")
+movies = load_movie_list(FILE_NAME)
+
+embedding = AzureOpenAIEmbeddings(
+    azure_endpoint=RESOURCE_ENDPOINT,
+    azure_deployment=DEPLOYMENT_NAME,
+    openai_api_key=API_KEY,
+    openai_api_version='2024-03-01-preview',
+    chunk_size=EMBEDDING_BATCH_SIZE)
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH)
+cached_embedding = CachedEmbeddings(
+    embedding=embedding,
+    cache=embedding_cache,
+    model=DEPLOYMENT_NAME,
+    batch_size=EMBEDDING_BATCH_SIZE,
+    max_workers=EMBEDDING_CONCURRENCY,
+    rate_limiter=RateLimiter(requests_per_minute=EMBEDDING_RPM, tokens_per_minute=EMBEDDING_TPM))
+index_embedding = TruncatedEmbeddings(cached_embedding, VECTOR_DIMS) if VECTOR_DIMS else cached_embedding
+
+index_name = "movieindex"
+
+# This example assumes TLS is enabled. If not, use "redis://" instead of "rediss://
+redis_url = "rediss://:" + REDIS_PASSWORD + "@"+ REDIS_ENDPOINT
+
+vectorstore = RedisVectorStore.from_existing_index(
+    embedding=index_embedding,
+    redis_url=redis_url,
+    index_name=index_name,
+    schema="redis_schema.yaml"
+)
+
+## Diff the movie list against the index
+## -------------------------------------
+# An index built before fingerprints were recorded has no entries here, so every movie is treated as changed once.
+# Their embeddings still come from the embedding cache if it is available.
+indexed = load_fingerprints(vectorstore.client, index_name)
+fingerprints = {id: document_fingerprint(plot, metadata) for id, (plot, metadata) in movies.items()}
+
+upserts = [id for id, fingerprint in fingerprints.items() if indexed.get(id) != fingerprint]
+removed = [id for id in indexed if id not in movies]
+print(f"Movies in list: {len(movies)}, indexed: {len(indexed)}, new or changed: {len(upserts)}, removed: {len(removed)}")
+
+## Apply the changes
+## -----------------
+if upserts:
+    print("Upserting new and changed movies...")
+    texts = [movies[id][0] for id in upserts]
+    metadatas = [movies[id][1] for id in upserts]
+    vectors = index_embedding.embed_documents(texts)
+    # Documents are keyed by movie id, so HSET replaces a changed movie in place
+    vectorstore.add_texts(texts, metadatas, embeddings=vectors, keys=upserts)
+    save_fingerprints(vectorstore.client, index_name, {id: fingerprints[id] for id in upserts})
+
+if removed:
+    print("Deleting removed movies...")
+    vectorstore.delete(ids=[f"{vectorstore.key_prefix}:{id}" for id in removed])
+    delete_fingerprints(vectorstore.client, index_name, removed)
+
+## Sync the plot chunks
+## ---------------------
+# Chunks are diffed the same way, on their own fingerprints, so only the chunks of changed plots are re-embedded.
+# A changed plot can split into fewer chunks than before, its extra chunks are deleted.
+if PLOT_CHUNKS:
+    chunks = chunk_movies(movies, create_plot_splitter(PLOT_CHUNK_TOKENS, PLOT_CHUNK_OVERLAP))
+    chunk_prints = chunk_fingerprints(chunks)
+    indexed_chunks = load_fingerprints(vectorstore.client, CHUNK_INDEX_NAME)
+    chunk_upserts = [key for key, fingerprint in chunk_prints.items() if indexed_chunks.get(key) != fingerprint]
+    chunk_removed = [key for key in indexed_chunks if key not in chunks]
+    print(f"Plot chunks: {len(chunks)}, indexed: {len(indexed_chunks)}, new or changed: {len(chunk_upserts)}, removed: {len(chunk_removed)}")
+
+    chunk_store = None
+    if os.path.exists(CHUNK_SCHEMA_FILE):
+        chunk_store = RedisVectorStore.from_existing_index(
+            embedding=index_embedding,
+            redis_url=redis_url,
+            index_name=CHUNK_INDEX_NAME,
+            schema=CHUNK_SCHEMA_FILE
+        )
+    if chunk_upserts:
+        texts = [chunks[key][0] for key in chunk_upserts]
+        metadatas = [chunks[key][1] for key in chunk_upserts]
+        if chunk_store is None:
+            print("Creating the plot chunk index...")
+            chunk_store = RedisVectorStore.from_texts(
+                texts=texts,
+                embedding=index_embedding,
+                metadatas=metadatas,
+                index_name=CHUNK_INDEX_NAME,
+                redis_url=redis_url,
+                keys=chunk_upserts
+            )
+            chunk_store.write_schema(CHUNK_SCHEMA_FILE)
+        else:
+            chunk_store.add_texts(texts, metadatas, embeddings=index_embedding.embed_documents(texts), keys=chunk_upserts)
+        save_fingerprints(vectorstore.client, CHUNK_INDEX_NAME, {key: chunk_prints[key] for key in chunk_upserts})
+    if chunk_removed and chunk_store is not None:
+        chunk_store.delete(ids=[f"{chunk_store.key_prefix}:{key}" for key in chunk_removed])
+        delete_fingerprints(vectorstore.client, CHUNK_INDEX_NAME, chunk_removed)
+
+# Cached chat answers may refer to movies that have changed or been removed
+if upserts or removed:
+    SemanticAnswerCache(vectorstore.client).invalidate()
+
+if NEIGHBOURS_N and (upserts or removed or not os.path.exists(NEIGHBOURS_FILE)):
+    print(f"Building the movie neighbour graph ({NEIGHBOURS_N} neighbours per movie)...")
+    graph_start = time.time()
+    build_neighbour_file(movies, cached_embedding, path=NEIGHBOURS_FILE, n=NEIGHBOURS_N)
+    print(f"Saved {NEIGHBOURS_FILE} in {time.time() - graph_start:.1f} seconds")
+
+embedding_cache.close()
+print(f"Sync complete in {time.time() - start_time:.1f} seconds")
@@ -0,0 +1,13 @@
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# The apps are hyphenated scripts, imported by path
+def load_script(name: str):
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(ROOT, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,134 @@
+import asyncio
+import csv
+import json
+
+import langchain_openai
+import pandas as pd
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from conftest import load_script
+from fakes import FakeChatModel, FakeEmbeddings, synthetic_movies
+from local_vectorstore import LocalVectorStore
+from movie_neighbours import build_neighbour_file
+from preprocessing import load_movie_list
+
+# chat-server.py with a small local index, and the fakes in place of Azure OpenAI
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    work_dir = tmp_path_factory.mktemp("server")
+    movie_list = str(work_dir / "movie_list.csv")
+    pd.DataFrame(synthetic_movies(50)).to_csv(movie_list, index=False, quoting=csv.QUOTE_NONNUMERIC,
+                                              escapechar='\\', quotechar='"')
+    movies = load_movie_list(movie_list)
+    ids = [id for id, (plot, _) in movies.items() if isinstance(plot, str) and plot]
+    vectorstore = LocalVectorStore(FakeEmbeddings(), path=str(work_dir / "local_index"))
+    vectorstore.add_texts([movies[id][0] for id in ids], [movies[id][1] for id in ids], keys=ids)
+    vectorstore.save()
+    build_neighbour_file(movies, FakeEmbeddings(), str(work_dir / "movie_neighbours.npz"))
+
+    with pytest.MonkeyPatch.context() as patch:
+        for name, value in {
+            'API_KEY': 'test', 'RESOURCE_ENDPOINT': 'https://test', 'DEPLOYMENT_NAME': 'test-embedding',
+            'VECTOR_STORE': 'local', 'LOCAL_INDEX_PATH': vectorstore.path, 'MOVIE_LIST': movie_list,
+            'METADATA_QUERY': 'local', 'NEIGHBOURS_FILE': str(work_dir / "movie_neighbours.npz"),
+            'HISTORY_SUMMARY': '0', 'SESSION_MAX_PENDING': '2', 'TRACE_FILE': '',
+        }.items():
+            patch.setenv(name, value)
+        patch.setattr(langchain_openai, 'AzureChatOpenAI',
+                      lambda **kwargs: FakeChatModel(latency=0.05, token_latency=0, answer_tokens=12))
+        patch.setattr(langchain_openai, 'AzureOpenAIEmbeddings', lambda **kwargs: FakeEmbeddings())
+        yield load_script("chat-server")
+
+# One event loop and test client for the module, the app and its asyncio primitives are bound to the loop
+@pytest.fixture(scope="module")
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+@pytest.fixture(scope="module")
+def client(server, loop):
+    async def start():
+        client = TestClient(TestServer(server.app))
+        await client.start_server()
+        return client
+
+    client = loop.run_until_complete(start())
+    yield client
+    loop.run_until_complete(client.close())
+
+def run(loop, client, scenario):
+    return loop.run_until_complete(scenario(client))
+
+def parse_events(text: str):
+    events = []
+    for block in text.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+def test_streamed_answer(server, loop, client):
+    async def scenario(client):
+        response = await client.post("/chat", json={"question": "Find me movies like Top Gun"})
+        return response.status, response.headers["Content-Type"], await response.text()
+
+    status, content_type, text = run(loop, client, scenario)
+    assert status == 200 and content_type.startswith("text/event-stream")
+    events = parse_events(text)
+    assert events[0][0] == "session" and events[-1][0] == "done"
+    tokens = [data for event, data in events if event == "token"]
+    assert tokens and "".join(tokens) == events[-1][1]["answer"]
+
+def test_json_answer_and_history_across_turns(server, loop, client):
+    async def scenario(client):
+        first = await (await client.post("/chat", json={"question": "Tell me about a heist", "stream": False})).json()
+        second = await client.post("/chat", json={"question": "Who directed it?", "session_id": first["session_id"],
+                                                   "stream": False})
+        return first, second.status, await second.json()
+
+    first, status, second = run(loop, client, scenario)
+    assert status == 200 and second["session_id"] == first["session_id"] and second["answer"]
+    messages = server.sessions.get(first["session_id"]).history.messages()
+    assert [message.content for message in messages] == [
+        "Tell me about a heist", first["answer"], "Who directed it?", second["answer"]]
+
+@pytest.mark.parametrize("body", [
+    "not json",
+    "[1, 2]",
+    "{}",
+    '{"question": "  "}',
+    '{"question": "hi", "session_id": ["a"]}',
+    '{"question": "hi", "session_id": {"a": 1}}',
+    '{"question": "hi", "session_id": 42}',
+    '{"question": "hi", "session_id": ""}',
+    '{"question": "hi", "session_id": "has spaces"}',
+    '{"question": "hi", "session_id": "' + "a" * 65 + '"}',
+])
+def test_bad_bodies_are_rejected(server, loop, client, body):
+    async def scenario(client):
+        return (await client.post("/chat", data=body, headers={"Content-Type": "application/json"})).status
+
+    assert run(loop, client, scenario) == 400
+
+def test_session_backpressure(server, loop, client, monkeypatch):
+    # Every request is still running when the last one arrives, SESSION_MAX_PENDING=2 admits two of them
+    monkeypatch.setattr(server.llm.llm, 'latency', 0.3)
+
+    async def scenario(client):
+        responses = await asyncio.gather(*[
+            client.post("/chat", json={"question": "Tell me about aliens", "session_id": "busy", "stream": False})
+            for _ in range(4)])
+        return sorted((response.status, response.headers.get("Retry-After")) for response in responses)
+
+    assert run(loop, client, scenario) == [(200, None), (200, None), (429, "1"), (429, "1")]
+
+def test_busy_server_answers_503(server, loop, client, monkeypatch):
+    monkeypatch.setattr(server, 'turn_slots', asyncio.Semaphore(0))
+    monkeypatch.setattr(server, 'SERVER_QUEUE_TIMEOUT', 0.05)
+
+    async def scenario(client):
+        response = await client.post("/chat", json={"question": "Tell me about aliens", "stream": False})
+        return response.status, response.headers.get("Retry-After")
+
+    assert run(loop, client, scenario) == (503, "1")
@@ -0,0 +1,297 @@
+import asyncio
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+import pytest
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from pydantic import ConfigDict, Field
+
+from fakes import FakeChatModel, FakeEmbeddings
+from llm_governor import LLMGovernor
+
+ANSWER_TOKENS = 40
+
+# FakeChatModel held at `gate` before answering, counting its calls and how far each stream was read
+class GatedChatModel(FakeChatModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+    gate: threading.Event = Field(default_factory=threading.Event)
+    calls: int = 0
+    sent: List[int] = Field(default_factory=list)
+    closed: List[bool] = Field(default_factory=list)
+    # Usage on the last chunk of streams, as the API sends it when asked with stream_options
+    report_usage: bool = False
+    options: List[Dict[str, Any]] = Field(default_factory=list)
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        self.calls += 1
+        self.options.append(kwargs)
+        self.gate.wait(5)
+        call = len(self.sent)
+        self.sent.append(0)
+        self.closed.append(False)
+        try:
+            for token in self._tokens(self._response(messages)):
+                time.sleep(self.token_latency)
+                self.sent[call] += 1
+                yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if kwargs.get('stream_options') and self.report_usage:
+                yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=self._usage(
+                    messages, self._response(messages))))
+        except GeneratorExit:
+            self.closed[call] = True
+            raise
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        self.calls += 1
+        self.options.append(kwargs)
+        while not self.gate.is_set():
+            await asyncio.sleep(0.001)
+        call = len(self.sent)
+        self.sent.append(0)
+        self.closed.append(False)
+        try:
+            for token in self._tokens(self._response(messages)):
+                await asyncio.sleep(self.token_latency)
+                self.sent[call] += 1
+                yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if kwargs.get('stream_options') and self.report_usage:
+                yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=self._usage(
+                    messages, self._response(messages))))
+        except GeneratorExit:
+            self.closed[call] = True
+            raise
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                  **kwargs: Any) -> ChatResult:
+        self.calls += 1
+        self.gate.wait(5)
+        return super()._generate(messages, stop=stop, **kwargs)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                         **kwargs: Any) -> ChatResult:
+        self.calls += 1
+        while not self.gate.is_set():
+            await asyncio.sleep(0.001)
+        return await super()._agenerate(messages, stop=stop, **kwargs)
+
+def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+async def await_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.001)
+
+@pytest.fixture
+def governor():
+    return LLMGovernor({'chat': (600, 100000)})
+
+@pytest.fixture
+def model():
+    return GatedChatModel(latency=0, token_latency=0.001, answer_tokens=ANSWER_TOKENS)
+
+def text(chunks) -> str:
+    return "".join(chunk.content for chunk in chunks)
+
+def in_threads(function, n: int) -> List[threading.Thread]:
+    threads = [threading.Thread(target=function) for _ in range(n)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+@pytest.mark.parametrize("call", [
+    lambda chat: chat.invoke("hello").content,
+    lambda chat: text(chat.stream("hello")),
+])
+def test_concurrent_calls_make_one_upstream_call(governor, model, call):
+    chat = governor.chat_model(model, 'chat')
+    answers = []
+    threads = in_threads(lambda: answers.append(call(chat)), 4)
+    wait_for(lambda: governor.coalescer.stats()['coalesced'] == 3)
+    model.gate.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert model.calls == 1
+    assert len(answers) == 4 and len(set(answers)) == 1
+    assert len(answers[0].split()) == ANSWER_TOKENS
+    assert governor.coalescer.stats() == {'calls': 1, 'coalesced': 3, 'in_flight': 0}
+
+@pytest.mark.parametrize("call", [
+    lambda chat: chat.ainvoke("hello"),
+    lambda chat: collect(chat.astream("hello")),
+])
+def test_concurrent_async_calls_make_one_upstream_call(governor, model, call):
+    chat = governor.chat_model(model, 'chat')
+
+    async def scenario():
+        calls = [asyncio.ensure_future(call(chat)) for _ in range(4)]
+        await await_for(lambda: governor.coalescer.stats()['coalesced'] == 3)
+        model.gate.set()
+        return await asyncio.gather(*calls)
+
+    answers = [getattr(answer, 'content', answer) for answer in asyncio.run(scenario())]
+    assert model.calls == 1
+    assert len(set(answers)) == 1 and len(answers[0].split()) == ANSWER_TOKENS
+
+async def collect(chunks) -> str:
+    return text([chunk async for chunk in chunks])
+
+def test_sync_stream_follows_async_stream(governor, model):
+    chat = governor.chat_model(model, 'chat')
+    answers = []
+
+    async def scenario():
+        leader = asyncio.ensure_future(collect(chat.astream("hello")))
+        await await_for(lambda: governor.coalescer.stats()['in_flight'] == 1)
+        follower = in_threads(lambda: answers.append(text(chat.stream("hello"))), 1)[0]
+        await await_for(lambda: governor.coalescer.stats()['coalesced'] == 1)
+        model.gate.set()
+        answers.append(await leader)
+        await asyncio.to_thread(follower.join, 5)
+
+    asyncio.run(scenario())
+    assert model.calls == 1
+    assert len(answers) == 2 and answers[0] == answers[1]
+
+def test_cancelled_async_leader_completes_followers(governor, model):
+    chat = governor.chat_model(model, 'chat')
+
+    async def scenario():
+        leader = asyncio.ensure_future(collect(chat.astream("hello")))
+        await await_for(lambda: governor.coalescer.stats()['in_flight'] == 1)
+        follower = asyncio.ensure_future(collect(chat.astream("hello")))
+        await await_for(lambda: governor.coalescer.stats()['coalesced'] == 1)
+        leader.cancel()
+        model.gate.set()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    answer = asyncio.run(scenario())
+    assert model.calls == 1
+    assert len(answer.split()) == ANSWER_TOKENS
+    assert model.closed == [False]
+
+def test_closed_sync_leader_completes_followers(governor, model):
+    chat = governor.chat_model(model, 'chat')
+    model.gate.set()
+    leader = chat.stream("hello")
+    first = next(leader)
+    answers = []
+    follower = in_threads(lambda: answers.append(text(chat.stream("hello"))), 1)[0]
+    wait_for(lambda: governor.coalescer.stats()['coalesced'] == 1)
+    leader.close()
+    follower.join(5)
+
+    assert model.calls == 1
+    assert answers[0].startswith(first.content) and len(answers[0].split()) == ANSWER_TOKENS
+    assert model.closed == [False]
+
+def test_sync_stream_stops_when_every_reader_has_gone(governor, model):
+    chat = governor.chat_model(model, 'chat')
+    model.token_latency = 0.01
+    leader = chat.stream("hello")
+    threading.Timer(0.05, model.gate.set).start()
+    next(leader)
+    follower = chat.stream("hello")
+    next(follower)
+    leader.close()
+    follower.close()
+
+    wait_for(lambda: model.closed == [True])
+    assert model.sent[0] < ANSWER_TOKENS
+    assert governor.coalescer.stats()['in_flight'] == 0
+
+def test_async_stream_stops_when_every_reader_has_gone(governor, model):
+    chat = governor.chat_model(model, 'chat')
+    model.token_latency = 0.01
+
+    async def scenario():
+        leader, follower = chat.astream("hello"), chat.astream("hello")
+        model.gate.set()
+        await anext(leader)
+        await anext(follower)
+        await leader.aclose()
+        await follower.aclose()
+        await await_for(lambda: model.closed == [True])
+
+    asyncio.run(scenario())
+    assert model.sent[0] < ANSWER_TOKENS
+    assert governor.coalescer.stats()['in_flight'] == 0
+
+@pytest.mark.parametrize("report_usage", [True, False])
+def test_streamed_tokens_are_settled(governor, model, report_usage, monkeypatch):
+    chat = governor.chat_model(model, 'chat', stream_usage=True)
+    refunds = []
+    monkeypatch.setattr(governor.limiters['chat'], 'refund', refunds.append)
+    model.report_usage = report_usage
+    model.gate.set()
+    answer = text(chat.stream("hello"))
+
+    # Both count the prompt, and the answer as a token per chunk when no usage is reported
+    assert model.options == [{'stream_options': {'include_usage': True}}]
+    assert len(answer.split()) == ANSWER_TOKENS
+    assert refunds == [chat.completion_tokens - ANSWER_TOKENS]
+
+def test_stream_options_are_only_sent_when_asked(governor, model):
+    model.gate.set()
+    text(governor.chat_model(model, 'chat').stream("hello"))
+    governor.chat_model(model, 'chat', stream_usage=True).invoke("hello")
+    assert model.options == [{}]
+
+# FakeEmbeddings held at `gate`, counting the requests it gets
+class GatedEmbeddings(FakeEmbeddings):
+    def __init__(self):
+        super().__init__()
+        self.gate = threading.Event()
+        self.batches = []
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.batches.append(list(texts))
+        self.gate.wait(5)
+        return super().embed_documents(texts)
+
+def test_concurrent_queries_are_batched():
+    governor = LLMGovernor({'embedding': (600, 100000)}, batch_window=5.0)
+    embedding = GatedEmbeddings()
+    governed = governor.embeddings(embedding, 'embedding')
+    governed.max_batch = 4
+    vectors = {}
+
+    def query(question: str):
+        vectors[question] = governed.embed_query(question)
+
+    # The first query goes straight out, the ones arriving while it is out wait for a batch of max_batch
+    threads = in_threads(lambda: query("first"), 1)
+    wait_for(lambda: len(embedding.batches) == 1)
+    questions = [f"question {n}" for n in range(4)]
+    threads += [threading.Thread(target=query, args=(question,)) for question in questions]
+    for thread in threads[1:]:
+        thread.start()
+    wait_for(lambda: len(embedding.batches) == 2)
+    embedding.gate.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert embedding.batches[0] == ["first"] and sorted(embedding.batches[1]) == questions
+    assert governed.stats() == {'requests': 2, 'texts': 5, 'coalesced': 0}
+    assert all(vectors[question] == FakeEmbeddings().embed_query(question) for question in questions + ["first"])
+
+def test_query_alone_does_not_wait_for_the_window():
+    governor = LLMGovernor({}, batch_window=5.0)
+    embedding = GatedEmbeddings()
+    embedding.gate.set()
+    governed = governor.embeddings(embedding, 'embedding')
+    started = time.monotonic()
+    governed.embed_query("hello")
+    assert time.monotonic() - started < 1.0
+    assert embedding.batches == [["hello"]]
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from movie_neighbours import MovieNeighbourGraph, SimilarMovies
+
+MOVIES = {
+    '1': ("", {'Title': 'Top Gun', 'year': 1986}),
+    '2': ("", {'Title': 'The Matrix', 'year': 1999}),
+    '3': ("", {'Title': 'Psycho', 'year': 1960}),
+    '4': ("", {'Title': 'Psycho', 'year': 1998}),
+}
+
+@pytest.fixture
+def similar():
+    ids = list(MOVIES)
+    graph = MovieNeighbourGraph.build(ids, np.eye(len(ids), dtype=np.float32), n=2)
+    return SimilarMovies(graph, MOVIES)
+
+@pytest.mark.parametrize("question, movie_id", [
+    ("find me movies like Top Gun", '1'),
+    ("Can you recommend films like Top Gun?", '1'),
+    ("something similar to 'The Matrix' please", '2'),
+    ("anything in the style of the matrix", '2'),
+    ("films like Psycho (1998)", '4'),
+    ("movies like Psycho", '3'),
+])
+def test_like_questions_resolve_to_the_title(similar, question, movie_id):
+    assert similar.resolve(question) == movie_id
+
+@pytest.mark.parametrize("question", [
+    "Do you like Top Gun?",
+    "I'd like to know the plot of Top Gun",
+    "Would you like to watch The Matrix?",
+    "Tom Cruise movies like Top Gun",
+    "movies like that",
+    "films like Unknown Movie",
+])
+def test_other_questions_go_to_retrieval(similar, question):
+    assert similar.resolve(question) is None
@@ -0,0 +1,44 @@
+import pytest
+
+from question_rewrite import needs_rewrite, wants_rewrite
+
+FOLLOW_UPS = [
+    "What years has he been in movies?",
+    "Show those as a table",
+    "And 1987?",
+    "What about comedies?",
+    "Who directed the movie?",
+    "When was the sequel released?",
+    "Who starred in the film?",
+    "Which is the best?",
+    "Which one is the most popular?",
+    "Which is the longest?",
+    "Who played the villain?",
+    "Who played the main villain?",
+    "What is the runtime?",
+    "Who wrote the screenplay?",
+    "Tell me about the plot",
+    "How does the original end?",
+]
+
+STANDALONE = [
+    "Recommend a science fiction movie from 1985",
+    "Who directed Top Gun?",
+    "What are the best comedies of 1990?",
+    "Which movies did Tom Hanks star in during the 90s?",
+    "Is The Godfather worth watching?",
+    "Find movies about aliens invading Earth",
+    "What is the highest rated horror movie from 1980?",
+]
+
+@pytest.mark.parametrize("question", FOLLOW_UPS)
+def test_follow_ups_are_rewritten(question):
+    assert needs_rewrite(question)
+
+@pytest.mark.parametrize("question", STANDALONE)
+def test_standalone_questions_skip_the_rewrite(question):
+    assert not needs_rewrite(question)
+
+def test_first_turn_is_never_rewritten():
+    assert not wants_rewrite({"input": "Who directed the movie?", "chat_history": []})
+    assert wants_rewrite({"input": "Who directed Top Gun?", "chat_history": ["earlier turn"]}, fast_path=False)
@@ -0,0 +1,42 @@
+import threading
+import time
+
+from rate_limit import BACKGROUND, BATCH, INTERACTIVE, RateLimiter
+
+def test_interactive_requests_go_ahead_of_batch_ones():
+    # Ten requests a second, none left: the waiting requests are served in priority order as the bucket refills
+    limiter = RateLimiter(600, 100000)
+    limiter._requests = 0
+    served = []
+
+    def request(name: str, priority: int):
+        limiter.acquire(10, priority)
+        served.append(name)
+
+    threads = [threading.Thread(target=request, args=(f"batch {n}", BATCH)) for n in range(2)]
+    for thread in threads:
+        thread.start()
+    while len(limiter._waiting) < 2:
+        time.sleep(0.001)
+    threads.append(threading.Thread(target=request, args=("interactive", INTERACTIVE)))
+    threads[-1].start()
+    for thread in threads:
+        thread.join(5)
+
+    assert served == ["interactive", "batch 0", "batch 1"]
+
+def test_batch_requests_leave_the_reserve():
+    limiter = RateLimiter(600, 1000, reserve=0.2)
+    limiter._tokens = 250
+    with limiter._changed:
+        ticket = limiter._enqueue(BATCH)
+        # 250 - 100 would leave less than the 200 token reserve
+        assert limiter._try_acquire(ticket, 100) > 0
+        assert limiter._try_acquire(ticket, 40) == 0
+        limiter._tokens = 200
+        ticket = limiter._enqueue(BACKGROUND)
+        assert limiter._try_acquire(ticket, 1) > 0
+        limiter._dequeue(ticket)
+    # Interactive requests may use the reserve
+    limiter.acquire(150, INTERACTIVE)
+    assert limiter._tokens < 100
@@ -0,0 +1,121 @@
+import time
+
+import fakeredis
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+import session_store
+from chat_history import SUMMARY_PREFIX, ChatHistoryManager
+from fakes import FakeChatModel
+from session_store import InMemorySessionStore, RedisSessionStore, encode_message, entry_tokens
+
+def turn(n: int):
+    # Messages of the same length, so every message costs the same number of tokens
+    return [HumanMessage(content=f"question {n:03d}"), AIMessage(content=f"ans {n:03d}")]
+
+TOKENS = entry_tokens(encode_message(turn(0)[0]))
+assert TOKENS == entry_tokens(encode_message(turn(0)[1]))
+
+@pytest.fixture(params=["memory", "redis"])
+def store(request):
+    if request.param == "memory":
+        return InMemorySessionStore()
+    # A small page size, so loads read several pages
+    return RedisSessionStore(fakeredis.FakeRedis(), page_size=4)
+
+def fill(store, turns: int, session_id: str = "s"):
+    for n in range(turns):
+        store.append(session_id, turn(n))
+
+@pytest.mark.parametrize("max_tokens, expected", [
+    (3 * TOKENS - 1, 3),
+    (3 * TOKENS, 3),
+    (3 * TOKENS + 1, 4),
+    (40 * TOKENS, 20),
+])
+def test_window_stops_at_the_budget(store, max_tokens, expected):
+    fill(store, 10)
+    window = store.load("s", max_tokens)
+    assert window.total == 20 and len(window.messages) == expected
+    assert window.first == 20 - expected
+    assert [message.content for message in window.messages] == \
+        [message.content for message in store.range("s", window.first, 20)]
+
+@pytest.mark.parametrize("summarized", [0, 5, 13, 19, 20])
+def test_window_never_includes_summarised_messages(store, summarized):
+    fill(store, 10)
+    assert store.set_summary("s", "summary", summarized, 0) == (summarized > 0)
+    for max_tokens in (TOKENS, 4 * TOKENS, 40 * TOKENS):
+        window = store.load("s", max_tokens)
+        assert window.summarized == summarized and window.first >= summarized
+        assert window.first + len(window.messages) == 20
+        if max_tokens == 40 * TOKENS:
+            assert window.first == summarized
+
+def test_summary_never_moves_backwards(store):
+    fill(store, 5)
+    assert store.set_summary("s", "first six", 6, 0)
+    assert not store.set_summary("s", "first four", 4, 0)
+    assert not store.set_summary("s", "first six again", 6, 0)
+    window = store.load("s", 100 * TOKENS)
+    assert (window.summary, window.summarized) == ("first six", 6)
+    # A summary of None only moves the boundary (the history is dropped, not summarised)
+    assert store.set_summary("s", None, 8, 0)
+    assert store.load("s", 100 * TOKENS)[:2] == ("first six", 8)
+
+def test_reset_discards_a_summary_in_flight(store):
+    fill(store, 5)
+    window = store.load("s", TOKENS)
+    store.reset("s")
+    assert not store.set_summary("s", "stale", 8, window.generation)
+    window = store.load("s", TOKENS)
+    assert (window.summary, window.summarized, window.total, window.generation) == (None, 0, 0, 1)
+
+def test_concurrent_summary_from_another_replica_wins(monkeypatch):
+    client = fakeredis.FakeRedis()
+    store = RedisSessionStore(client)
+    fill(store, 5)
+    decode_state = session_store._decode_state
+    reads = []
+
+    def replica_summarises_first(state):
+        # Another replica saves a summary further along between this one's read and its write
+        if not reads:
+            client.hset("chat_session:s:state", mapping={"summary": "other replica", "summarized": 8})
+        reads.append(state)
+        return decode_state(state)
+
+    monkeypatch.setattr(session_store, "_decode_state", replica_summarises_first)
+    assert not store.set_summary("s", "this replica", 6, 0)
+    # The write was discarded by WATCH, and the retry saw the newer summary
+    assert len(reads) == 2
+    monkeypatch.undo()
+    assert store.load("s", TOKENS)[:2] == ("other replica", 8)
+
+def wait_for_compaction(history: ChatHistoryManager):
+    deadline = time.monotonic() + 5
+    while history._compacting and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+def test_history_is_summarised_in_the_background(store):
+    history = ChatHistoryManager(max_tokens=4 * TOKENS, llm=FakeChatModel(latency=0, token_latency=0, answer_tokens=5),
+                                 store=store, session_id="s")
+    for n in range(4):
+        history.add_turn(*[message.content for message in turn(n)])
+        wait_for_compaction(history)
+    window = store.load("s", 4 * TOKENS)
+    assert window.summarized == 4 and window.summary
+    messages = history.messages()
+    assert isinstance(messages[0], SystemMessage) and messages[0].content == SUMMARY_PREFIX + window.summary
+    assert [message.content for message in messages[1:]] == [message.content for message in turn(2) + turn(3)]
+
+def test_reset_during_compaction_discards_the_summary(store):
+    history = ChatHistoryManager(max_tokens=2 * TOKENS, llm=FakeChatModel(latency=0.2, token_latency=0), store=store,
+                                 session_id="s")
+    history.add_turn("question 000", "ans 000")
+    history.add_turn("question 001", "ans 001")
+    assert history._compacting
+    history.reset()
+    wait_for_compaction(history)
+    window = store.load("s", 2 * TOKENS)
+    assert (window.summary, window.summarized, window.total) == (None, 0, 0)